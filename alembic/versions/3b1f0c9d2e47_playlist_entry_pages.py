@@ -0,0 +1,26 @@
+"""Playlist entry pages
+
+Revision ID: 3b1f0c9d2e47
+Revises: acccc76a579c
+Create Date: 2026-10-18 16:05:12.417203
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3b1f0c9d2e47'
+down_revision: Union[str, None] = 'acccc76a579c'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index('ix_playlist_songs_playlist_id_id', 'playlist_songs', ['playlist_id', 'id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_playlist_songs_playlist_id_id', table_name='playlist_songs')
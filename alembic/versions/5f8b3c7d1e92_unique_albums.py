@@ -0,0 +1,42 @@
+"""Unique albums per artist
+
+Revision ID: 5f8b3c7d1e92
+Revises: 9e6d2f4a8c31
+Create Date: 2026-10-19 10:05:41.218734
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5f8b3c7d1e92'
+down_revision: Union[str, None] = '9e6d2f4a8c31'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Every album with the id of the first album of the same artist and title.
+CANONICAL = """
+    SELECT id, first_value(id) OVER (
+        PARTITION BY artist_id, title ORDER BY id
+    ) AS keep_id
+    FROM albums
+"""
+
+
+def upgrade() -> None:
+    # Move songs of duplicate albums to the album that is kept; bumping
+    # updated_at makes the next incremental sync reindex them.
+    op.execute(
+        "UPDATE songs SET album_id = canonical.keep_id, updated_at = timezone('utc', now()) "
+        f"FROM ({CANONICAL}) canonical "
+        "WHERE songs.album_id = canonical.id AND canonical.id <> canonical.keep_id"
+    )
+    op.execute(f"DELETE FROM albums WHERE id IN (SELECT id FROM ({CANONICAL}) canonical WHERE id <> keep_id)")
+    op.create_unique_constraint('uq_albums_artist_id_title', 'albums', ['artist_id', 'title'])
+
+
+def downgrade() -> None:
+    op.drop_constraint('uq_albums_artist_id_title', 'albums', type_='unique')
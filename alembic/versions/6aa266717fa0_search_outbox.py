@@ -0,0 +1,36 @@
+"""Search outbox
+
+Revision ID: 6aa266717fa0
+Revises: 9194f55dadaa
+Create Date: 2026-10-18 11:02:17.530921
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '6aa266717fa0'
+down_revision: Union[str, None] = '9194f55dadaa'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('search_outbox',
+    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('index_name', sa.String(), nullable=True),
+    sa.Column('doc_id', sa.String(), nullable=True),
+    sa.Column('op', sa.String(), nullable=True),
+    sa.Column('payload', sa.JSON(), nullable=True),
+    sa.Column('attempts', sa.Integer(), nullable=True),
+    sa.Column('last_error', sa.String(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('search_outbox')
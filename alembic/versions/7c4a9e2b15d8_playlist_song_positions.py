@@ -0,0 +1,45 @@
+"""Playlist song positions
+
+Revision ID: 7c4a9e2b15d8
+Revises: d52e8a61f0b3
+Create Date: 2026-10-18 17:32:09.551836
+
+"""
+from itertools import groupby
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+from positions import keys_between
+
+
+# revision identifiers, used by Alembic.
+revision: str = '7c4a9e2b15d8'
+down_revision: Union[str, None] = 'd52e8a61f0b3'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('playlist_songs', sa.Column('position', sa.String(collation='C'), nullable=True))
+    # Existing entries keep the order they were added in.
+    conn = op.get_bind()
+    rows = conn.execute(sa.text(
+        'SELECT playlist_id, id FROM playlist_songs ORDER BY playlist_id, updated_at, id'
+    ))
+    updates = []
+    for _, entries in groupby(rows, key=lambda row: row.playlist_id):
+        ids = [entry.id for entry in entries]
+        updates.extend({'id': entry_id, 'position': key} for entry_id, key in zip(ids, keys_between(None, None, len(ids))))
+    if updates:
+        conn.execute(sa.text('UPDATE playlist_songs SET position = :position WHERE id = :id'), updates)
+    op.alter_column('playlist_songs', 'position', nullable=False)
+    op.drop_index('ix_playlist_songs_playlist_id_id', table_name='playlist_songs')
+    op.create_index('ix_playlist_songs_playlist_id_position', 'playlist_songs', ['playlist_id', 'position', 'id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_playlist_songs_playlist_id_position', table_name='playlist_songs')
+    op.create_index('ix_playlist_songs_playlist_id_id', 'playlist_songs', ['playlist_id', 'id'], unique=False)
+    op.drop_column('playlist_songs', 'position')
@@ -0,0 +1,40 @@
+"""Playlist minhash signatures
+
+Revision ID: 9e6d2f4a8c31
+Revises: 7c4a9e2b15d8
+Create Date: 2026-10-18 21:14:52.307215
+
+"""
+from itertools import groupby
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+from minhash import signature, to_bytes
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9e6d2f4a8c31'
+down_revision: Union[str, None] = '7c4a9e2b15d8'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('playlists', sa.Column('minhash', sa.LargeBinary(), nullable=True))
+    # Empty playlists keep a NULL signature, which stands for the empty set.
+    conn = op.get_bind()
+    rows = conn.execute(sa.text(
+        'SELECT playlist_id, song_id FROM playlist_songs ORDER BY playlist_id'
+    ))
+    updates = [
+        {'id': playlist_id, 'minhash': to_bytes(signature(row.song_id for row in entries))}
+        for playlist_id, entries in groupby(rows, key=lambda row: row.playlist_id)
+    ]
+    if updates:
+        conn.execute(sa.text('UPDATE playlists SET minhash = :minhash WHERE id = :id'), updates)
+
+
+def downgrade() -> None:
+    op.drop_column('playlists', 'minhash')
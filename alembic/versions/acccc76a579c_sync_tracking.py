@@ -0,0 +1,51 @@
+"""Sync tracking
+
+Revision ID: acccc76a579c
+Revises: 6aa266717fa0
+Create Date: 2026-10-18 13:40:52.284611
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'acccc76a579c'
+down_revision: Union[str, None] = '6aa266717fa0'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+TRACKED_TABLES = ['songs', 'playlists', 'playlist_songs', 'song_ratings']
+
+
+def upgrade() -> None:
+    for table in TRACKED_TABLES:
+        # Existing rows are stamped with the migration time, so the first
+        # incremental sync picks all of them up.
+        op.add_column(table, sa.Column('updated_at', sa.DateTime(), server_default=sa.text("timezone('utc', now())"), nullable=True))
+        op.create_index(op.f(f'ix_{table}_updated_at'), table, ['updated_at'], unique=False)
+    op.create_table('sync_watermarks',
+    sa.Column('name', sa.String(), nullable=False),
+    sa.Column('value', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('name')
+    )
+    op.create_table('sync_tombstones',
+    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('entity', sa.String(), nullable=True),
+    sa.Column('entity_id', sa.String(), nullable=True),
+    sa.Column('parent_id', sa.String(), nullable=True),
+    sa.Column('deleted_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_sync_tombstones_deleted_at'), 'sync_tombstones', ['deleted_at'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_sync_tombstones_deleted_at'), table_name='sync_tombstones')
+    op.drop_table('sync_tombstones')
+    op.drop_table('sync_watermarks')
+    for table in reversed(TRACKED_TABLES):
+        op.drop_index(op.f(f'ix_{table}_updated_at'), table_name=table)
+        op.drop_column(table, 'updated_at')
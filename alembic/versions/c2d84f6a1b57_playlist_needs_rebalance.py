@@ -0,0 +1,36 @@
+"""Playlist needs_rebalance flag
+
+Revision ID: c2d84f6a1b57
+Revises: b7e41a9c3d20
+Create Date: 2026-10-19 14:08:26.914302
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c2d84f6a1b57'
+down_revision: Union[str, None] = 'b7e41a9c3d20'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# PLAYLIST_POSITION_MAX_LENGTH's default when this migration was written.
+POSITION_MAX_LENGTH = 16
+
+
+def upgrade() -> None:
+    op.add_column('playlists', sa.Column('needs_rebalance', sa.Boolean(), server_default=sa.false(), nullable=False))
+    op.create_index(op.f('ix_playlists_needs_rebalance'), 'playlists', ['needs_rebalance'], unique=False)
+    # Flag the playlists the rebalancer's old full scan would have found.
+    op.execute(sa.text(
+        'UPDATE playlists SET needs_rebalance = true WHERE id IN '
+        '(SELECT playlist_id FROM playlist_songs WHERE length(position) > :limit)'
+    ).bindparams(limit=POSITION_MAX_LENGTH))
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_playlists_needs_rebalance'), table_name='playlists')
+    op.drop_column('playlists', 'needs_rebalance')
@@ -0,0 +1,43 @@
+"""Unique playlist songs
+
+Revision ID: d52e8a61f0b3
+Revises: 3b1f0c9d2e47
+Create Date: 2026-10-18 16:48:37.905114
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd52e8a61f0b3'
+down_revision: Union[str, None] = '3b1f0c9d2e47'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+DUPLICATES = """
+    SELECT id, playlist_id FROM (
+        SELECT id, playlist_id, row_number() OVER (
+            PARTITION BY playlist_id, song_id ORDER BY updated_at, id
+        ) AS n
+        FROM playlist_songs
+    ) ranked
+    WHERE n > 1
+"""
+
+
+def upgrade() -> None:
+    # Keep the first entry of each (playlist, song) pair. Tombstones make the
+    # next incremental sync rewrite the affected playlist documents.
+    op.execute(
+        "INSERT INTO sync_tombstones (entity, entity_id, parent_id, deleted_at) "
+        f"SELECT 'playlist_songs', id, playlist_id, timezone('utc', now()) FROM ({DUPLICATES}) duplicates"
+    )
+    op.execute(f"DELETE FROM playlist_songs WHERE id IN (SELECT id FROM ({DUPLICATES}) duplicates)")
+    op.create_unique_constraint('uq_playlist_songs_playlist_id_song_id', 'playlist_songs', ['playlist_id', 'song_id'])
+
+
+def downgrade() -> None:
+    op.drop_constraint('uq_playlist_songs_playlist_id_song_id', 'playlist_songs', type_='unique')
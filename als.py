@@ -0,0 +1,276 @@
+"""
+Alternating least squares on explicit song ratings.
+
+Ratings are a sparse users x songs matrix in CSR form. Each half-iteration
+solves a small regularized least squares problem per user (or per song) with
+the other side's factors fixed; rows are solved in blocks, vectorized with
+NumPy, and blocks are spread over a process pool. Workers read the ratings
+and the fixed factors from `.npy` files memory mapped in a work directory,
+so tasks only carry row ranges.
+
+Trained models are a directory of `.npy` files: factors plus the sorted id
+arrays their rows belong to. They are loaded with `mmap_mode="r"`, so every
+process serving the same model shares one copy through the page cache.
+
+Run `python als.py` to benchmark training and scoring on synthetic ratings
+scaled up from dataset.csv.
+
+This module only depends on NumPy so process pool workers import it fast.
+"""
+import csv
+import multiprocessing
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+MODEL_FILES = ("user_ids", "user_factors", "song_ids", "song_factors")
+
+
+def _solve_rows(indptr, indices, values, fixed, regularization):
+    """
+    Factors for the rows of a CSR block given the other side's `fixed`
+    factors: (Y_I' Y_I + reg * n I) x = Y_I' r for every row at once.
+
+    Rows are bucketed by rating count (powers of two) and each bucket's
+    ratings are padded to a dense (rows x width x rank) array, so the Gram
+    matrices are one batched matmul per bucket.
+    """
+    counts = np.diff(indptr)
+    rank = fixed.shape[1]
+    solved = np.zeros((len(counts), rank), dtype=np.float32)
+    buckets = np.ceil(np.log2(np.maximum(counts, 1))).astype(np.int64)
+    identity = np.eye(rank, dtype=np.float32)
+    for bucket in np.unique(buckets[counts > 0]):
+        rows = np.flatnonzero((buckets == bucket) & (counts > 0))
+        width = np.arange(counts[rows].max())
+        present = width[None, :] < counts[rows][:, None]
+        positions = indptr[rows][:, None] + np.where(present, width[None, :], 0)
+        items = fixed[indices[positions]] * present[..., None]
+        ratings = (values[positions] * present)[..., None]
+        transposed = items.transpose(0, 2, 1)
+        gram = transposed @ items
+        gram += regularization * counts[rows][:, None, None] * identity
+        rhs = transposed @ ratings
+        solved[rows] = np.linalg.solve(gram.astype(np.float64), rhs)[..., 0]
+    return solved
+
+
+def _solve_block(task):
+    """
+    Process pool entry point: solve rows [start, stop) of one side.
+    """
+    workdir, side, fixed_name, start, stop, regularization = task
+    indptr = np.load(os.path.join(workdir, f"{side}_indptr.npy"), mmap_mode="r")
+    indices = np.load(os.path.join(workdir, f"{side}_indices.npy"), mmap_mode="r")
+    values = np.load(os.path.join(workdir, f"{side}_values.npy"), mmap_mode="r")
+    fixed = np.load(os.path.join(workdir, f"{fixed_name}.npy"), mmap_mode="r")
+    return start, _solve_rows(
+        np.asarray(indptr[start : stop + 1]), indices, values, fixed, regularization
+    )
+
+
+def _blocks(indptr, block_ratings):
+    """
+    Row ranges holding about `block_ratings` ratings each, which bounds the
+    padded (ratings x rank) scratch space of a block.
+    """
+    bounds = np.searchsorted(
+        indptr, np.arange(0, indptr[-1], block_ratings), side="right"
+    )
+    bounds = np.unique(np.concatenate([[0], bounds - 1, [len(indptr) - 1]]))
+    return [(int(a), int(b)) for a, b in zip(bounds[:-1], bounds[1:]) if b > a]
+
+
+def _transpose(indptr, indices, values, n_columns):
+    order = np.argsort(indices, kind="stable")
+    rows = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+    t_indptr = np.zeros(n_columns + 1, dtype=np.int64)
+    np.cumsum(np.bincount(indices, minlength=n_columns), out=t_indptr[1:])
+    return t_indptr, rows[order].astype(np.int32), values[order]
+
+
+def train(
+    indptr,
+    indices,
+    values,
+    n_songs,
+    rank=32,
+    regularization=0.1,
+    iterations=10,
+    workers=None,
+    block_ratings=8192,
+    seed=0,
+):
+    """
+    Factorize a users x songs CSR ratings matrix.
+
+    Returns (user factors, song factors) as float32 arrays. With `workers`
+    of 0 or 1 everything runs in the calling process.
+    """
+    rng = np.random.default_rng(seed)
+    n_users = len(indptr) - 1
+    factors = {
+        "users": np.zeros((n_users, rank), dtype=np.float32),
+        "songs": (rng.standard_normal((n_songs, rank)) * 0.1).astype(np.float32),
+    }
+    sides = {
+        "users": (np.asarray(indptr), np.asarray(indices), np.asarray(values)),
+        "songs": _transpose(
+            np.asarray(indptr), np.asarray(indices), np.asarray(values), n_songs
+        ),
+    }
+    workers = os.cpu_count() if workers is None else workers
+    with tempfile.TemporaryDirectory(prefix="als-") as workdir:
+        for side, arrays in sides.items():
+            for name, array in zip(("indptr", "indices", "values"), arrays):
+                np.save(os.path.join(workdir, f"{side}_{name}.npy"), array)
+        # Workers come from a fork server rather than being forked from the
+        # caller, which may be a threaded web server holding locks.
+        pool = (
+            ProcessPoolExecutor(
+                workers, mp_context=multiprocessing.get_context("forkserver")
+            )
+            if workers > 1
+            else None
+        )
+        try:
+            for _ in range(iterations):
+                for side, fixed_name in (("users", "songs"), ("songs", "users")):
+                    fixed_path = os.path.join(workdir, f"{fixed_name}.npy")
+                    np.save(fixed_path, factors[fixed_name])
+                    tasks = [
+                        (workdir, side, fixed_name, start, stop, regularization)
+                        for start, stop in _blocks(sides[side][0], block_ratings)
+                    ]
+                    results = (pool.map if pool else map)(_solve_block, tasks)
+                    for start, block in results:
+                        factors[side][start : start + len(block)] = block
+        finally:
+            if pool:
+                pool.shutdown()
+    return factors["users"], factors["songs"]
+
+
+def save_model(path, user_ids, user_factors, song_ids, song_factors):
+    """
+    Write a model directory. Ids are saved sorted, with factor rows in the
+    same order, so lookups are binary searches over the mapped arrays.
+    """
+    os.makedirs(path, exist_ok=True)
+    arrays = dict(zip(MODEL_FILES, (user_ids, user_factors, song_ids, song_factors)))
+    for ids_name, factors_name in zip(MODEL_FILES[::2], MODEL_FILES[1::2]):
+        order = np.argsort(arrays[ids_name])
+        arrays[ids_name] = np.asarray(arrays[ids_name])[order]
+        arrays[factors_name] = np.ascontiguousarray(arrays[factors_name][order])
+    for name, array in arrays.items():
+        np.save(os.path.join(path, f"{name}.npy"), array)
+
+
+class FactorModel:
+    """
+    A saved model, memory mapped read-only.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        for name in MODEL_FILES:
+            array = np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+            setattr(self, name, array)
+
+    @staticmethod
+    def _rows(ids, wanted):
+        wanted = np.asarray(list(wanted), dtype=ids.dtype)
+        if not len(ids) or not len(wanted):
+            return np.empty(0, dtype=np.int64)
+        rows = np.minimum(np.searchsorted(ids, wanted), len(ids) - 1)
+        return rows[ids[rows] == wanted]
+
+    def recommend(self, user_id, exclude_ids=(), size=10):
+        """
+        Up to `size` (song id, predicted rating) pairs for `user_id`, best
+        first, leaving out `exclude_ids`. Empty if the user is unknown.
+        """
+        user = self._rows(self.user_ids, [user_id])
+        if not len(user):
+            return []
+        scores = self.song_factors @ self.user_factors[user[0]]
+        scores[self._rows(self.song_ids, exclude_ids)] = -np.inf
+        size = min(size, int(np.isfinite(scores).sum()))
+        if size <= 0:
+            return []
+        top = np.argpartition(-scores, size - 1)[:size]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [(str(self.song_ids[i]), float(scores[i])) for i in top]
+
+
+def synthetic_ratings(
+    base_csv="dataset.csv", scale=200, n_users=50000, per_user=40, rank=8, seed=0
+):
+    """
+    Ratings from 1 to 5 for `n_users` users over the songs of `base_csv`
+    repeated `scale` times, drawn from a hidden low-rank taste model in
+    which songs of the same genre are alike.
+
+    Returns (indptr, indices, values, n_songs).
+    """
+    rng = np.random.default_rng(seed)
+    with open(base_csv, newline="", encoding="utf-8-sig") as f:
+        genres = [row["genre"] for row in csv.DictReader(f)]
+    _, genre_ids = np.unique(genres, return_inverse=True)
+    genre_ids = np.tile(genre_ids, scale)
+    n_songs = len(genre_ids)
+    genre_taste = rng.standard_normal((genre_ids.max() + 1, rank))
+    songs = genre_taste[genre_ids] + 0.5 * rng.standard_normal((n_songs, rank))
+    users = rng.standard_normal((n_users, rank))
+    indices = np.concatenate(
+        [np.sort(rng.choice(n_songs, per_user, replace=False)) for _ in range(n_users)]
+    ).astype(np.int32)
+    rows = np.repeat(np.arange(n_users), per_user)
+    raw = np.einsum("ij,ij->i", users[rows], songs[indices]) / np.sqrt(rank)
+    values = np.clip(np.round(3 + 1.2 * raw), 1, 5).astype(np.float32)
+    indptr = np.arange(0, n_users * per_user + 1, per_user, dtype=np.int64)
+    return indptr, indices, values, n_songs
+
+
+def benchmark(scale=200, n_users=50000, per_user=40, workers=None, queries=200):
+    indptr, indices, values, n_songs = synthetic_ratings(
+        scale=scale, n_users=n_users, per_user=per_user
+    )
+    print(f"{n_users} users, {n_songs} songs, {len(values)} ratings")
+    for pool_size in sorted({1, workers or os.cpu_count()}):
+        started = time.perf_counter()
+        user_factors, song_factors = train(
+            indptr, indices, values, n_songs, iterations=5, workers=pool_size
+        )
+        seconds = time.perf_counter() - started
+        print(f"train, 5 iterations, {pool_size} process(es): {seconds:.1f}s")
+    predicted = np.einsum(
+        "ij,ij->i",
+        user_factors[np.repeat(np.arange(n_users), np.diff(indptr))],
+        song_factors[indices],
+    )
+    print(f"train RMSE: {np.sqrt(np.mean((predicted - values) ** 2)):.3f}")
+
+    with tempfile.TemporaryDirectory(prefix="als-model-") as path:
+        user_ids = np.array([f"user-{i:08d}" for i in range(n_users)])
+        song_ids = np.array([f"song-{i:08d}" for i in range(n_songs)])
+        save_model(path, user_ids, user_factors, song_ids, song_factors)
+        model = FactorModel(path)
+        latencies = []
+        for user in np.random.default_rng(1).choice(n_users, queries):
+            rated = song_ids[indices[indptr[user] : indptr[user + 1]]]
+            started = time.perf_counter()
+            model.recommend(user_ids[user], rated, size=20)
+            latencies.append(time.perf_counter() - started)
+        latencies = np.array(latencies) * 1000
+        print(
+            f"top-20 query: p50 {np.percentile(latencies, 50):.2f}ms, "
+            f"p99 {np.percentile(latencies, 99):.2f}ms"
+        )
+
+
+if __name__ == "__main__":
+    benchmark()
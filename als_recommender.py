@@ -0,0 +1,276 @@
+import json
+import os
+import queue
+import shutil
+import threading
+import time
+
+import numpy as np
+from sqlalchemy import and_, or_, select, update
+from sqlalchemy.orm import Session
+
+import metrics
+from als import FactorModel, save_model, train
+from configurations import *
+
+MANIFEST = "current.json"
+
+
+def rating_matrix(db):
+    """
+    (user ids, song ids, CSR indptr, indices, values) of `song_ratings`, with
+    ids sorted and rows and columns in id order.
+    """
+    rows = db.execute(
+        select(
+            Models.SongRating.user_id,
+            Models.SongRating.song_id,
+            Models.SongRating.rating,
+        ).where(Models.SongRating.rating.isnot(None))
+    ).all()
+    if not rows:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, np.zeros(1, np.int64), empty, empty
+    user_ids, user_rows = np.unique([row[0] for row in rows], return_inverse=True)
+    song_ids, song_cols = np.unique([row[1] for row in rows], return_inverse=True)
+    values = np.array([row[2] for row in rows], dtype=np.float32)
+    order = np.lexsort((song_cols, user_rows))
+    indptr = np.zeros(len(user_ids) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(user_rows, minlength=len(user_ids)), out=indptr[1:])
+    return user_ids, song_ids, indptr, song_cols[order].astype(np.int32), values[order]
+
+
+def publish(model_dir, version, keep=2):
+    """
+    Make `version` the model served from `model_dir` and remove all but the
+    `keep` newest versions. Processes still mapping a removed version keep
+    their copy until they reload.
+    """
+    manifest = os.path.join(model_dir, MANIFEST)
+    with open(manifest + ".tmp", "w") as f:
+        json.dump({"version": version}, f)
+    os.replace(manifest + ".tmp", manifest)
+    versions = sorted(
+        name
+        for name in os.listdir(model_dir)
+        if os.path.isdir(os.path.join(model_dir, name))
+    )
+    for name in versions[:-keep]:
+        if name != version:
+            shutil.rmtree(os.path.join(model_dir, name), ignore_errors=True)
+
+
+def train_from_database(engine, model_dir=ALS_MODEL_DIR):
+    """
+    Train on `song_ratings` in a process pool of ALS_WORKERS and publish the
+    factors as the current model.
+
+    Returns the new model version, or None if there are no ratings yet.
+    """
+    started = time.perf_counter()
+    with Session(engine) as db:
+        user_ids, song_ids, indptr, indices, values = rating_matrix(db)
+    if not len(values):
+        return None
+    user_factors, song_factors = train(
+        indptr,
+        indices,
+        values,
+        len(song_ids),
+        rank=ALS_RANK,
+        regularization=ALS_REGULARIZATION,
+        iterations=ALS_ITERATIONS,
+        workers=ALS_WORKERS,
+    )
+    version = datetime.utcnow().strftime("%Y%m%d%H%M%S%f")
+    save_model(
+        os.path.join(model_dir, version),
+        user_ids,
+        user_factors,
+        song_ids,
+        song_factors,
+    )
+    publish(model_dir, version)
+    metrics.observe("als_train_seconds", time.perf_counter() - started)
+    return version
+
+
+class RatingRecommender:
+    """
+    Serves the current ALS model from ALS_MODEL_DIR, memory mapped, and
+    switches to a newly published model within ALS_RELOAD_INTERVAL seconds.
+    """
+
+    def __init__(self, model_dir=ALS_MODEL_DIR):
+        self.model_dir = model_dir
+        self.model = None
+        self.version = None
+        self._thread = None
+
+    @property
+    def ready(self):
+        return self.model is not None
+
+    def load(self):
+        try:
+            with open(os.path.join(self.model_dir, MANIFEST)) as f:
+                version = json.load(f)["version"]
+        except FileNotFoundError:
+            return
+        if version != self.version:
+            self.model = FactorModel(os.path.join(self.model_dir, version))
+            self.version = version
+            metrics.incr("als_model_loaded")
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(
+            target=self._run, name="als-reloader", daemon=True
+        )
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.load()
+            except Exception:
+                metrics.incr("als_model_load_failed")
+            time.sleep(ALS_RELOAD_INTERVAL)
+
+    def recommend(self, user_id, exclude_ids, size):
+        return self.model.recommend(user_id, exclude_ids, size)
+
+
+rating_recommender = RatingRecommender()
+
+
+def training_status(job):
+    return {
+        "job_id": job.id,
+        "status": job.status,
+        "version": job.version,
+        "seconds": round(job.seconds, 3) if job.seconds is not None else None,
+        "error": job.error,
+    }
+
+
+class TrainingWorker:
+    """
+    Background thread that trains the ALS model for queued training jobs,
+    one at a time, and switches `recommender` to each new model.
+
+    Jobs are rows of `training_jobs`, so any process can report on them.
+    A job is claimed atomically before it runs, so it is trained once even
+    when every process finds it queued. Like import jobs, a running job's
+    `updated_at` is its lease, renewed while it trains; a job whose process
+    died is taken over by another worker once it is ALS_TRAIN_LEASE seconds
+    old, and workers re-scan for such jobs as often.
+    """
+
+    def __init__(self, engine, recommender, model_dir=ALS_MODEL_DIR):
+        self.engine = engine
+        self.recommender = recommender
+        self.model_dir = model_dir
+        self.jobs = queue.Queue()
+        self._thread = None
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(
+            target=self._run, name="als-trainer", daemon=True
+        )
+        self._thread.start()
+        self.resume_pending()
+
+    def submit(self, job_id):
+        self.jobs.put(job_id)
+
+    def _claimable(self):
+        job = Models.TrainingJob
+        stale = datetime.utcnow() - timedelta(seconds=ALS_TRAIN_LEASE)
+        return or_(
+            job.status == "queued",
+            and_(job.status == "running", job.updated_at < stale),
+        )
+
+    def resume_pending(self):
+        with Session(self.engine) as db:
+            pending = db.scalars(
+                select(Models.TrainingJob.id)
+                .where(self._claimable())
+                .order_by(Models.TrainingJob.created_at)
+            ).all()
+        for job_id in pending:
+            self.submit(job_id)
+
+    def _set(self, job_id, *conditions, **values):
+        with self.engine.begin() as conn:
+            return conn.execute(
+                update(Models.TrainingJob)
+                .where(Models.TrainingJob.id == job_id, *conditions)
+                .values(**values)
+            ).rowcount
+
+    def _run(self):
+        while True:
+            try:
+                job_id = self.jobs.get(timeout=ALS_TRAIN_LEASE)
+            except queue.Empty:
+                self.resume_pending()
+                continue
+            try:
+                self.run_job(job_id)
+            except Exception as e:
+                metrics.incr("als_train_failed")
+                self._set(job_id, status="failed", error=str(e))
+            finally:
+                self.jobs.task_done()
+
+    def _renew(self, job_id, done):
+        while not done.wait(ALS_TRAIN_LEASE / 3):
+            try:
+                self._set(
+                    job_id,
+                    Models.TrainingJob.status == "running",
+                    updated_at=datetime.utcnow(),
+                )
+            except Exception:
+                metrics.incr("als_train_lease_renew_failed")
+
+    def run_job(self, job_id):
+        claimed = self._set(
+            job_id,
+            self._claimable(),
+            status="running",
+            error=None,
+            updated_at=datetime.utcnow(),
+        )
+        if not claimed:
+            return
+        done = threading.Event()
+        threading.Thread(
+            target=self._renew, args=(job_id, done), name="als-lease", daemon=True
+        ).start()
+        try:
+            started = time.perf_counter()
+            version = train_from_database(self.engine, self.model_dir)
+        finally:
+            done.set()
+        if version is None:
+            raise ValueError("There are no ratings to train on")
+        self.recommender.load()
+        self._set(
+            job_id,
+            status="completed",
+            version=version,
+            seconds=time.perf_counter() - started,
+        )
+
+
+training_worker = TrainingWorker(engine, rating_recommender)
+
+
+if __name__ == "__main__":
+    print(train_from_database(engine))
@@ -0,0 +1,358 @@
+import heapq
+import threading
+import time
+from bisect import bisect_left, insort
+from heapq import merge
+
+from sqlalchemy.orm import Session
+
+import metrics
+from error_handler import handle_unavailable
+from indexing import *
+from search_backends import tokenize
+
+# Kinds of suggestions and the song document fields they come from.
+SUGGESTION_KINDS = {
+    "song": ("id", "title"),
+    "artist": ("artist_id", "artist_name"),
+    "album": ("album_id", "album_name"),
+}
+_END = "\uffff"
+
+
+def normalize_prefix(text):
+    return " ".join(tokenize(text))
+
+
+def suggestion_keys(text):
+    """
+    Lookup keys for `text`: the normalized text from each word on, so
+    "Bohemian Rhapsody" is found by "bo" and by "rha".
+    """
+    tokens = tokenize(text)
+    return {" ".join(tokens[i:]) for i in range(len(tokens))}
+
+
+class PrefixIndex:
+    """
+    Popularity ranked prefix lookups over song titles, artists and albums.
+
+    Keys live in a sorted list searched with `bisect`. Changes go to a small
+    sorted delta list and a removed set that are merged into the main list
+    once they grow past `compact_at`. Readers take the current
+    (main, delta, removed) snapshot without locking; writers replace the
+    snapshot instead of mutating it. Rankings per prefix are cached and
+    patched in place as entries change; the cache is only changed under the
+    writers' lock, which readers take briefly to store a ranking they missed.
+    """
+
+    def __init__(
+        self, max_results=AUTOCOMPLETE_MAX_SIZE, compact_at=10000, cache_size=50000
+    ):
+        self.max_results = max_results
+        self.depth = 4 * max_results
+        self.compact_at = compact_at
+        self.cache_size = cache_size
+        self.entries = {}
+        self.songs = {}
+        self.members = {"artist": {}, "album": {}}
+        self._view = ([], [], frozenset())
+        self._top = {}
+        self._version = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    @classmethod
+    def from_documents(cls, docs, **kwargs):
+        index = cls(**kwargs)
+        for doc in docs:
+            index._add_song(doc)
+        index._view = (
+            sorted(
+                (key, kind, entry_id)
+                for (kind, entry_id), entry in index.entries.items()
+                for key in suggestion_keys(entry[0])
+            ),
+            [],
+            frozenset(),
+        )
+        index.warm()
+        return index
+
+    @staticmethod
+    def _entry_keys(doc):
+        return {
+            (kind, doc[id_field])
+            for kind, (id_field, _) in SUGGESTION_KINDS.items()
+            if doc.get(id_field) is not None
+        }
+
+    def _add_song(self, doc):
+        self.songs[doc["id"]] = doc
+        popularity = doc.get("popularity") or 0
+        for kind, (id_field, text_field) in SUGGESTION_KINDS.items():
+            entry_id = doc.get(id_field)
+            if entry_id is None or not doc.get(text_field):
+                continue
+            entry = self.entries.setdefault((kind, entry_id), [doc[text_field], 0])
+            entry[0] = doc[text_field]
+            if kind == "song":
+                entry[1] = popularity
+            else:
+                self.members[kind].setdefault(entry_id, set()).add(doc["id"])
+                entry[1] += popularity
+
+    def _drop_song(self, doc):
+        del self.songs[doc["id"]]
+        popularity = doc.get("popularity") or 0
+        for kind, entry_id in self._entry_keys(doc):
+            entry = self.entries.get((kind, entry_id))
+            if entry is None:
+                continue
+            if kind == "song":
+                del self.entries[(kind, entry_id)]
+                continue
+            entry[1] -= popularity
+            members = self.members[kind].get(entry_id, set())
+            members.discard(doc["id"])
+            if not members:
+                self.members[kind].pop(entry_id, None)
+                del self.entries[(kind, entry_id)]
+
+    def apply(self, docs, deleted_ids):
+        """
+        Apply (possibly partial) song documents and song deletions.
+        """
+        with self._lock:
+            before = {}
+
+            def remember(keys):
+                for key in keys:
+                    if key not in before:
+                        entry = self.entries.get(key)
+                        before[key] = entry[0] if entry else None
+
+            for doc_id in deleted_ids:
+                old = self.songs.get(doc_id)
+                if old is not None:
+                    remember(self._entry_keys(old))
+                    self._drop_song(old)
+            for doc in docs:
+                old = self.songs.get(doc["id"])
+                new = {**old, **doc} if old else doc
+                remember(self._entry_keys(old or {}) | self._entry_keys(new))
+                if old is not None:
+                    self._drop_song(old)
+                self._add_song(new)
+            self._update_keys(before)
+
+    def _update_keys(self, before):
+        main, delta, removed = self._view
+        delta, removed = list(delta), set(removed)
+        for (kind, entry_id), old_text in before.items():
+            entry = self.entries.get((kind, entry_id))
+            new_text = entry[0] if entry else None
+            old_keys = suggestion_keys(old_text) if old_text else set()
+            new_keys = suggestion_keys(new_text) if new_text else set()
+            for key in old_keys - new_keys:
+                item = (key, kind, entry_id)
+                position = bisect_left(delta, item)
+                if position < len(delta) and delta[position] == item:
+                    del delta[position]
+                else:
+                    removed.add(item)
+            for key in new_keys - old_keys:
+                item = (key, kind, entry_id)
+                if item in removed:
+                    removed.discard(item)
+                else:
+                    insort(delta, item)
+            self._patch_top(kind, entry_id, entry, old_keys | new_keys, new_keys)
+
+        if len(delta) + len(removed) > self.compact_at:
+            main = list(merge((item for item in main if item not in removed), delta))
+            delta, removed = [], set()
+        self._view = (main, delta, frozenset(removed))
+        self._version += 1
+
+    def _patch_top(self, kind, entry_id, entry, keys, new_keys):
+        """
+        Update the cached rankings of every prefix of `keys` for a changed
+        entry. A ranking holds up to `depth` entries, so it survives removals
+        until fewer than `max_results` known entries are left.
+        """
+        ranked = (-entry[1], entry[0], kind, entry_id) if entry else None
+        prefixes = {key[:end] for key in keys for end in range(1, len(key) + 1)}
+        for prefix in prefixes:
+            cached = self._top.get(prefix)
+            if cached is None:
+                continue
+            items, complete = cached
+            items = [item for item in items if item[2:] != (kind, entry_id)]
+            if ranked and any(key.startswith(prefix) for key in new_keys):
+                if complete or (items and ranked < items[-1]):
+                    insort(items, ranked)
+                    if len(items) > self.depth:
+                        items.pop()
+                        complete = False
+            if complete or len(items) >= self.max_results:
+                self._top[prefix] = (items, complete)
+            else:
+                del self._top[prefix]
+
+    def _matches(self, prefix):
+        main, delta, removed = self._view
+        for keys in (main, delta):
+            start = bisect_left(keys, (prefix,))
+            stop = bisect_left(keys, (prefix + _END,))
+            for i in range(start, stop):
+                if keys is delta or keys[i] not in removed:
+                    yield keys[i][1], keys[i][2]
+
+    def _rank(self, prefix):
+        """
+        (top `depth` entries under `prefix`, whether that is all of them).
+        """
+        entries = self.entries
+        matches = set(self._matches(prefix))
+        items = heapq.nsmallest(
+            self.depth,
+            (
+                (-entry[1], entry[0], kind, entry_id)
+                for kind, entry_id in matches
+                for entry in (entries.get((kind, entry_id)),)
+                if entry is not None
+            ),
+        )
+        return items, len(matches) <= self.depth
+
+    def warm(self, length=2):
+        """
+        Rank every prefix up to `length` characters ahead of time. These are
+        the most expensive lookups, and the first ones a client makes.
+        """
+        main = self._view[0]
+        prefixes = {item[0][:end] for item in main for end in range(1, length + 1)}
+        for prefix in prefixes:
+            self._top[prefix] = self._rank(prefix)
+
+    def suggest(self, text, size=10):
+        """
+        Up to `size` suggestions for the prefix `text`, most popular first.
+        """
+        prefix = normalize_prefix(text)
+        if not prefix:
+            return []
+        cached = self._top.get(prefix)
+        if cached is None:
+            version = self._version
+            cached = self._rank(prefix)
+            with self._lock:
+                if version == self._version:
+                    if len(self._top) >= self.cache_size:
+                        self._top = {
+                            key: value
+                            for key, value in self._top.items()
+                            if len(key) <= 2
+                        }
+                    self._top[prefix] = cached
+        return [
+            {"text": name, "type": kind, "id": entry_id, "popularity": -score}
+            for score, name, kind, entry_id in cached[0][:size]
+        ]
+
+
+class LocalAutocomplete:
+    """
+    Autocomplete served from an in-process `PrefixIndex`, built from the
+    database at startup and kept current from song document changes.
+    """
+
+    def __init__(self):
+        self.index = PrefixIndex()
+        self.ready = False
+        self._lock = threading.Lock()
+        self._replay = None
+        metrics.register_gauge("autocomplete_entries", lambda: len(self.index))
+
+    def start(self, engine):
+        threading.Thread(
+            target=self.rebuild, args=(engine,), name="autocomplete-build", daemon=True
+        ).start()
+
+    def rebuild(self, engine):
+        started = time.perf_counter()
+        with self._lock:
+            self._replay = []
+        try:
+            with Session(engine) as db:
+                index = PrefixIndex.from_documents(iter_song_documents(db))
+        except Exception:
+            with self._lock:
+                self._replay = None
+            metrics.incr("autocomplete_build_failed")
+            raise
+        with self._lock:
+            for docs, deleted_ids in self._replay:
+                index.apply(docs, deleted_ids)
+            self.index, self._replay = index, None
+        self.ready = True
+        metrics.observe("autocomplete_build_seconds", time.perf_counter() - started)
+
+    def apply(self, docs, deleted_ids):
+        with self._lock:
+            self.index.apply(docs, deleted_ids)
+            if self._replay is not None:
+                self._replay.append((list(docs), list(deleted_ids)))
+
+    async def suggest(self, text, size):
+        if not self.ready:
+            handle_unavailable()
+        return self.index.suggest(text, size)
+
+
+class ElasticsearchAutocomplete:
+    """
+    Autocomplete from the completion suggester on the songs index. Song
+    documents are weighted by popularity; each option is reported as the
+    song, artist or album whose name matched.
+    """
+
+    async def suggest(self, text, size):
+        prefix = normalize_prefix(text)
+        if not prefix:
+            return []
+        result = await aes.search(
+            index=SONGS_INDEX,
+            suggest={
+                "names": {
+                    "prefix": prefix,
+                    "completion": {
+                        "field": "suggest",
+                        "size": size,
+                        "skip_duplicates": True,
+                    },
+                }
+            },
+            source=["id", "title", "artist_id", "artist_name", "album_id", "album_name"],
+            filter_path=["suggest.names.options.text", "suggest.names.options._source"],
+        )
+        suggestions = []
+        for option in result.get("suggest", {}).get("names", [{}])[0].get("options", []):
+            doc = option["_source"]
+            for kind, (id_field, text_field) in SUGGESTION_KINDS.items():
+                if doc.get(text_field) == option["text"]:
+                    suggestions.append(
+                        {"text": option["text"], "type": kind, "id": doc[id_field]}
+                    )
+                    break
+        return suggestions
+
+
+local_autocomplete = LocalAutocomplete()
+if AUTOCOMPLETE_BACKEND == "elasticsearch":
+    autocomplete_backend = ElasticsearchAutocomplete()
+else:
+    autocomplete_backend = add_song_listener(local_autocomplete)
@@ -0,0 +1,197 @@
+import time
+import uuid
+from typing import Dict, Iterable, List, Tuple
+
+from sqlalchemy import insert, select, tuple_
+from sqlalchemy.dialects import postgresql, sqlite
+
+import models as Models
+
+
+def _insert_ignore(conn, table):
+    """
+    Build a multi-row INSERT that skips rows hitting a unique constraint.
+    """
+    dialect = conn.dialect.name
+    if dialect == "postgresql":
+        return postgresql.insert(table).on_conflict_do_nothing()
+    if dialect == "sqlite":
+        return sqlite.insert(table).on_conflict_do_nothing()
+    return insert(table)
+
+
+class CatalogLoader:
+    """
+    Bulk loader for catalog rows (title, artist, album, genre).
+
+    Artist, genre and album names are resolved against name -> id maps that
+    are read from the database once and kept up to date as new dimensions
+    are inserted, so each chunk costs a handful of statements instead of
+    several round trips per row.
+    """
+
+    def __init__(self, engine, chunk_size: int = 5000):
+        self.engine = engine
+        self.chunk_size = chunk_size
+        self.artists: Dict[str, str] = {}
+        self.genres: Dict[str, str] = {}
+        self.albums: Dict[Tuple[str, str], str] = {}
+        self.rows_loaded = 0
+        self.elapsed = 0.0
+        self._maps_loaded = False
+
+    def load_maps(self, conn):
+        self.artists = dict(
+            conn.execute(select(Models.Artist.name, Models.Artist.id)).all()
+        )
+        self.genres = dict(
+            conn.execute(select(Models.Genre.name, Models.Genre.id)).all()
+        )
+        self.albums = {
+            (artist_id, title): album_id
+            for album_id, title, artist_id in conn.execute(
+                select(Models.Album.id, Models.Album.title, Models.Album.artist_id)
+            ).all()
+        }
+        self._maps_loaded = True
+
+    def reset_maps(self):
+        """
+        Force the maps to be reloaded, e.g. after a chunk was rolled back.
+        """
+        self._maps_loaded = False
+
+    def _resolve_names(self, conn, model, names: Iterable[str], cache: Dict[str, str]):
+        new_names = sorted({name for name in names if name not in cache})
+        if not new_names:
+            return
+        conn.execute(
+            _insert_ignore(conn, model.__table__),
+            [{"id": str(uuid.uuid4()), "name": name} for name in new_names],
+        )
+        # Another loader may have won the race for some names, so read the
+        # ids back instead of trusting the ones generated above.
+        for i in range(0, len(new_names), self.chunk_size):
+            batch = new_names[i : i + self.chunk_size]
+            cache.update(
+                conn.execute(
+                    select(model.name, model.id).where(model.name.in_(batch))
+                ).all()
+            )
+
+    def _resolve_albums(self, conn, records: List[dict]):
+        new_albums = sorted(
+            {
+                (self.artists[record["artist"]], record["album"])
+                for record in records
+            }
+            - self.albums.keys()
+        )
+        if not new_albums:
+            return
+        conn.execute(
+            _insert_ignore(conn, Models.Album.__table__),
+            [
+                {"id": str(uuid.uuid4()), "title": title, "artist_id": artist_id}
+                for artist_id, title in new_albums
+            ],
+        )
+        # As for artists and genres, read back the ids of albums another
+        # loader may have inserted first.
+        for i in range(0, len(new_albums), self.chunk_size):
+            batch = new_albums[i : i + self.chunk_size]
+            self.albums.update(
+                ((artist_id, title), album_id)
+                for album_id, title, artist_id in conn.execute(
+                    select(
+                        Models.Album.id, Models.Album.title, Models.Album.artist_id
+                    ).where(
+                        tuple_(Models.Album.artist_id, Models.Album.title).in_(batch)
+                    )
+                ).all()
+            )
+
+    def load_chunk(self, conn, records: List[dict]) -> int:
+        """
+        Insert one chunk of catalog records on an open connection.
+
+        The caller owns the transaction, so a chunk is either fully
+        committed or not at all.
+        """
+        if not records:
+            return 0
+        if not self._maps_loaded:
+            self.load_maps(conn)
+
+        self._resolve_names(
+            conn, Models.Artist, (r["artist"] for r in records), self.artists
+        )
+        self._resolve_names(
+            conn, Models.Genre, (r["genre"] for r in records), self.genres
+        )
+        self._resolve_albums(conn, records)
+
+        conn.execute(
+            insert(Models.Song.__table__),
+            [
+                {
+                    "id": str(uuid.uuid4()),
+                    "title": record["title"],
+                    "artist_id": self.artists[record["artist"]],
+                    "genre_id": self.genres[record["genre"]],
+                    "album_id": self.albums[
+                        (self.artists[record["artist"]], record["album"])
+                    ],
+                }
+                for record in records
+            ],
+        )
+        return len(records)
+
+    def load_records(self, records: Iterable[dict]) -> dict:
+        """
+        Load records in chunks of `chunk_size`, committing once per chunk.
+        """
+        chunk = []
+        for record in records:
+            chunk.append(record)
+            if len(chunk) >= self.chunk_size:
+                self._commit_chunk(chunk)
+                chunk = []
+        if chunk:
+            self._commit_chunk(chunk)
+        return self.stats()
+
+    def load_frame(self, df) -> dict:
+        return self.load_records(frame_records(df))
+
+    def _commit_chunk(self, chunk: List[dict]):
+        started = time.perf_counter()
+        try:
+            with self.engine.begin() as conn:
+                self.rows_loaded += self.load_chunk(conn, chunk)
+        except Exception:
+            self.reset_maps()
+            raise
+        finally:
+            self.elapsed += time.perf_counter() - started
+
+    def stats(self) -> dict:
+        return {
+            "rows": self.rows_loaded,
+            "seconds": round(self.elapsed, 3),
+            "rows_per_sec": round(self.rows_loaded / self.elapsed, 1)
+            if self.elapsed
+            else 0.0,
+        }
+
+
+def frame_records(df) -> List[dict]:
+    """
+    Convert a catalog DataFrame into plain records with stripped strings.
+    """
+    df = df[["title", "artist", "album", "genre"]].dropna()
+    return [
+        {key: str(value).strip() for key, value in record.items()}
+        for record in df.to_dict("records")
+    ]
@@ -0,0 +1,104 @@
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+
+_MISSING = object()
+
+
+class TTLCache:
+    """
+    Thread-safe LRU cache with a size bound and a per-entry time to live.
+
+    Hit and miss counts are exposed on /metrics under `{name}_cache`.
+    """
+
+    def __init__(self, maxsize, ttl, name=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        if name:
+            metrics.register_gauge(f"{name}_cache", self.stats)
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is not _MISSING and entry[0] > now:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not _MISSING:
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        if ttl <= 0 or self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def refresh(self, key, value):
+        """
+        Replace the value of a live entry; absent keys are left absent.
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._data[key] = (entry[0], value)
+
+    def pop(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return entry[1] if entry else None
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+_catalog_version = 0
+_catalog_lock = threading.Lock()
+
+
+def catalog_version():
+    return _catalog_version
+
+
+def bump_catalog_version():
+    """
+    Invalidate every cache entry keyed on the catalog version, e.g. after
+    the songs index is rebuilt or the outbox sent song changes to it. Call
+    it only once Elasticsearch has the change, or the next miss caches the
+    old result under the new version.
+
+    The version is per process: other workers only drop their entries when
+    their own outbox worker sends a song change, and otherwise serve stale
+    results for up to SEARCH_CACHE_TTL.
+    """
+    global _catalog_version
+    with _catalog_lock:
+        _catalog_version += 1
+    return _catalog_version
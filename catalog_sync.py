@@ -0,0 +1,249 @@
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, event, select, union
+from sqlalchemy.orm import Session
+
+from cache import bump_catalog_version
+from indexing import *
+
+TOMBSTONE_PARENTS = {
+    Models.Song: lambda song: None,
+    Models.Playlist: lambda playlist: None,
+    Models.PlaylistSong: lambda entry: entry.playlist_id,
+    Models.SongRating: lambda rating: rating.song_id,
+}
+
+
+@event.listens_for(Session, "before_flush")
+def record_tombstones(db, flush_context, instances):
+    """
+    Remember deleted rows so the incremental sync can propagate deletions.
+    """
+    for obj in list(db.deleted):
+        parent = TOMBSTONE_PARENTS.get(type(obj))
+        if parent is not None:
+            db.add(
+                Models.SyncTombstone(
+                    entity=obj.__tablename__,
+                    entity_id=obj.id,
+                    parent_id=parent(obj),
+                )
+            )
+
+
+def get_watermark(db, name):
+    mark = db.get(Models.SyncWatermark, name)
+    return mark.value if mark else None
+
+
+def set_watermark(db, name, value):
+    mark = db.get(Models.SyncWatermark, name)
+    if mark is None:
+        db.add(Models.SyncWatermark(name=name, value=value))
+    else:
+        mark.value = value
+
+
+def _sync_window(db, name):
+    """
+    (since, until) for a sync run. The window overlaps the previous one by
+    SYNC_OVERLAP_SECONDS so rows from transactions that were still open when
+    it ran are not missed; reindexing them twice is harmless.
+    """
+    since = get_watermark(db, name)
+    if since is not None:
+        since -= timedelta(seconds=SYNC_OVERLAP_SECONDS)
+    return since, datetime.utcnow()
+
+
+def _changed(column, since, until):
+    clause = column < until
+    return clause if since is None else clause & (column >= since)
+
+
+def _tombstones(db, entity, since, until, parent=False):
+    column = Models.SyncTombstone.parent_id if parent else Models.SyncTombstone.entity_id
+    return set(
+        db.scalars(
+            select(column).where(
+                Models.SyncTombstone.entity == entity,
+                _changed(Models.SyncTombstone.deleted_at, since, until),
+            )
+        )
+    )
+
+
+def _batches(ids, size=DB_YIELD_PER):
+    ids = sorted(ids)
+    for i in range(0, len(ids), size):
+        yield ids[i : i + size]
+
+
+def _sync_documents(index_name, changed, deleted, build, notify=None):
+    """
+    Reindex `changed` ids with documents from `build` and delete the ids
+    that are gone from the database. `notify(docs, deleted_ids)` is also
+    given every batch, for in-process consumers of the documents.
+    """
+
+    def actions():
+        for batch in _batches(changed):
+            docs = {doc["id"]: doc for doc in build(batch)}
+            if notify:
+                notify(docs.values(), [i for i in batch if i not in docs])
+            for doc_id in batch:
+                if doc_id in docs:
+                    yield {"_index": index_name, "_id": doc_id, "_source": docs[doc_id]}
+                else:
+                    deleted.add(doc_id)
+        gone = deleted - set(changed)
+        if notify:
+            notify((), gone)
+        for doc_id in gone:
+            yield {"_op_type": "delete", "_index": index_name, "_id": doc_id}
+
+    indexed, errors = bulk_index(actions())
+    errors = [
+        item
+        for item in errors
+        if not ("delete" in item and item["delete"].get("status") == 404)
+    ]
+    if errors:
+        raise RuntimeError(f"{len(errors)} documents failed to sync: {errors[:3]}")
+    return indexed
+
+
+def sync_songs(engine):
+    """
+    Reindex songs changed (re-rated or added to playlists) since the `songs`
+    watermark and delete removed ones.
+    """
+    started = time.perf_counter()
+    with Session(engine) as db:
+        since, until = _sync_window(db, SONGS_INDEX)
+        changed = set(
+            db.scalars(
+                union(
+                    select(Models.Song.id).where(
+                        _changed(Models.Song.updated_at, since, until)
+                    ),
+                    select(Models.SongRating.song_id).where(
+                        _changed(Models.SongRating.updated_at, since, until)
+                    ),
+                    select(Models.PlaylistSong.song_id).where(
+                        _changed(Models.PlaylistSong.updated_at, since, until)
+                    ),
+                )
+            )
+        )
+        changed |= _tombstones(db, "song_ratings", since, until, parent=True)
+        deleted = _tombstones(db, "songs", since, until)
+        changed -= deleted
+
+        indexed = _sync_documents(
+            SONGS_INDEX,
+            changed,
+            deleted,
+            lambda ids: iter_song_documents(db, song_ids=ids),
+            notify=notify_song_documents,
+        )
+        set_watermark(db, SONGS_INDEX, until)
+        db.commit()
+    bump_catalog_version()
+    return _sync_stats(indexed, deleted, started)
+
+
+def sync_playlists(engine):
+    """
+    Reindex playlists whose row or membership changed since the
+    `playlist-info` watermark and delete removed ones.
+    """
+    started = time.perf_counter()
+    with Session(engine) as db:
+        since, until = _sync_window(db, PLAYLISTS_INDEX)
+        changed = set(
+            db.scalars(
+                union(
+                    select(Models.Playlist.id).where(
+                        _changed(Models.Playlist.updated_at, since, until)
+                    ),
+                    select(Models.PlaylistSong.playlist_id).where(
+                        _changed(Models.PlaylistSong.updated_at, since, until)
+                    ),
+                )
+            )
+        )
+        changed |= _tombstones(db, "playlist_songs", since, until, parent=True)
+        deleted = _tombstones(db, "playlists", since, until)
+        changed -= deleted
+
+        indexed = _sync_documents(
+            PLAYLISTS_INDEX,
+            changed,
+            deleted,
+            lambda ids: playlist_documents(db, ids),
+        )
+        set_watermark(db, PLAYLISTS_INDEX, until)
+        db.commit()
+    return _sync_stats(indexed, deleted, started)
+
+
+def reindex_all_songs(engine):
+    """
+    Full songs rebuild that also moves the watermark, so the next
+    incremental sync only picks up what changed during and after it.
+
+    Changes committed while the new index was loading were written to the
+    previous version through the alias, so right after the swap they are
+    replayed into the new one with an incremental sync from the start of
+    the build.
+    """
+    until = datetime.utcnow()
+    stats = reindex_songs(engine)
+    with Session(engine) as db:
+        set_watermark(db, SONGS_INDEX, until)
+        db.commit()
+    stats["replayed"] = sync_songs(engine)["indexed"]
+    notify_songs_reindexed(engine)
+    bump_catalog_version()
+    return stats
+
+
+def reindex_all_playlists(engine):
+    until = datetime.utcnow()
+    started = time.perf_counter()
+    with Session(engine) as db:
+        playlist_ids = db.scalars(select(Models.Playlist.id)).all()
+        indexed = _sync_documents(
+            PLAYLISTS_INDEX,
+            playlist_ids,
+            set(),
+            lambda ids: playlist_documents(db, ids),
+        )
+        set_watermark(db, PLAYLISTS_INDEX, until)
+        db.commit()
+    return _sync_stats(indexed, set(), started)
+
+
+def purge_tombstones(engine):
+    """
+    Drop tombstones that both watermarks have moved past.
+    """
+    with Session(engine) as db:
+        marks = [get_watermark(db, name) for name in (SONGS_INDEX, PLAYLISTS_INDEX)]
+        if None in marks:
+            return
+        horizon = min(marks) - timedelta(seconds=SYNC_OVERLAP_SECONDS)
+        db.execute(
+            delete(Models.SyncTombstone).where(Models.SyncTombstone.deleted_at < horizon)
+        )
+        db.commit()
+
+
+def _sync_stats(indexed, deleted, started):
+    return {
+        "indexed": indexed,
+        "deleted": len(deleted),
+        "seconds": round(time.perf_counter() - started, 3),
+    }
@@ -1,16 +1,19 @@
 from fastapi import FastAPI, status, HTTPException, Depends, UploadFile, File
 import uvicorn
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, select
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import Session
-from fastapi_sqlalchemy import DBSessionMiddleware
 import os
+import time
 from dotenv import load_dotenv
 from passlib.context import CryptContext
 from fastapi.security import OAuth2PasswordBearer
 from datetime import timedelta, datetime
 from jose import JWTError, jwt
-from elasticsearch import Elasticsearch
+from elasticsearch import AsyncElasticsearch, Elasticsearch
 import models as Models
+from cache import TTLCache
+from schema import UserDetails
 from fastapi.middleware.cors import CORSMiddleware
 
 load_dotenv(".env")
@@ -28,22 +31,166 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
-engine = create_engine(os.environ["DATABASE_URI"])
-session = Session(engine)
-app.add_middleware(DBSessionMiddleware, db_url=os.environ["DATABASE_URI"])
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+def async_database_uri(uri):
+    """
+    Map a sync SQLAlchemy URL to the matching asyncio driver.
+    """
+    for prefix, async_prefix in (
+        ("postgresql+psycopg2://", "postgresql+asyncpg://"),
+        ("postgresql://", "postgresql+asyncpg://"),
+        ("sqlite://", "sqlite+aiosqlite://"),
+    ):
+        if uri.startswith(prefix):
+            return async_prefix + uri[len(prefix) :]
+    return uri
+
+
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 10))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 20))
+DB_POOL_TIMEOUT = int(os.environ.get("DB_POOL_TIMEOUT", 30))
+DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", 1800))
+
+
+def engine_options(uri):
+    """
+    Connection pool settings for `uri`. SQLite keeps SQLAlchemy's default
+    pool, which does not take size or overflow limits.
+    """
+    if uri.startswith("sqlite"):
+        return {"pool_pre_ping": True}
+    return {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": True,
+    }
+
+
+DATABASE_URI = os.environ["DATABASE_URI"]
+ASYNC_DATABASE_URI = os.environ.get(
+    "ASYNC_DATABASE_URI", async_database_uri(DATABASE_URI)
+)
+DATABASE_REPLICA_URI = os.environ.get("DATABASE_REPLICA_URI")
+
+engine = create_engine(DATABASE_URI, **engine_options(DATABASE_URI))
+async_engine = create_async_engine(
+    ASYNC_DATABASE_URI, **engine_options(ASYNC_DATABASE_URI)
+)
+AsyncSessionLocal = async_sessionmaker(async_engine, expire_on_commit=False)
+if DATABASE_REPLICA_URI:
+    replica_engine = create_async_engine(
+        async_database_uri(DATABASE_REPLICA_URI),
+        **engine_options(DATABASE_REPLICA_URI),
+    )
+else:
+    replica_engine = async_engine
+AsyncReadSessionLocal = async_sessionmaker(replica_engine, expire_on_commit=False)
+
+BCRYPT_ROUNDS = int(os.environ.get("BCRYPT_ROUNDS", 12))
+HASH_CONCURRENCY = int(os.environ.get("HASH_CONCURRENCY", 4))
+HASH_QUEUE_TIMEOUT = float(os.environ.get("HASH_QUEUE_TIMEOUT", 5.0))
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__default_rounds=BCRYPT_ROUNDS,
+    bcrypt__min_rounds=BCRYPT_ROUNDS,
+)
 SECRET_KEY = os.environ["SECRET_KEY"]
 ALGORITHM = os.environ["ALGORITHM"]
 ACCESS_TOKEN_EXPIRE_MINUTES = os.environ["ACCESS_TOKEN_EXPIRE_MINUTES"]
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 ELASTICSEARCH_URL = "https://localhost:9200"
+BULK_CHUNK_SIZE = int(os.environ.get("BULK_CHUNK_SIZE", 5000))
+IMPORT_SPOOL_DIR = os.environ.get("IMPORT_SPOOL_DIR", "import_spool")
+IMPORT_JOB_LEASE = float(os.environ.get("IMPORT_JOB_LEASE", 300))
+DB_YIELD_PER = int(os.environ.get("DB_YIELD_PER", 2000))
+ES_BULK_CHUNK_SIZE = int(os.environ.get("ES_BULK_CHUNK_SIZE", 1000))
+ES_BULK_WORKERS = int(os.environ.get("ES_BULK_WORKERS", 4))
+ES_SONGS_REPLICAS = int(os.environ.get("ES_SONGS_REPLICAS", 1))
+ES_KEEP_VERSIONS = int(os.environ.get("ES_KEEP_VERSIONS", 2))
+ES_FORCEMERGE_TIMEOUT = int(os.environ.get("ES_FORCEMERGE_TIMEOUT", 3600))
+OUTBOX_BATCH_SIZE = int(os.environ.get("OUTBOX_BATCH_SIZE", 500))
+OUTBOX_POLL_INTERVAL = float(os.environ.get("OUTBOX_POLL_INTERVAL", 1.0))
+OUTBOX_MAX_BACKOFF = float(os.environ.get("OUTBOX_MAX_BACKOFF", 60.0))
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get("OUTBOX_MAX_ATTEMPTS", 10))
+SYNC_OVERLAP_SECONDS = int(os.environ.get("SYNC_OVERLAP_SECONDS", 30))
+AUTH_CACHE_SIZE = int(os.environ.get("AUTH_CACHE_SIZE", 10000))
+AUTH_CACHE_TTL = int(os.environ.get("AUTH_CACHE_TTL", 300))
+# Deleting a user only evicts it from the cache of the process that deleted
+# it; the others keep accepting its tokens for up to this many seconds.
+AUTH_USER_CACHE_TTL = int(os.environ.get("AUTH_USER_CACHE_TTL", 30))
+AUTH_TRUST_CLAIMS = os.environ.get("AUTH_TRUST_CLAIMS", "false").lower() == "true"
+SEARCH_CACHE_SIZE = int(os.environ.get("SEARCH_CACHE_SIZE", 5000))
+# Upper bound on how long another worker's cached searches lag a song
+# change, see cache.bump_catalog_version.
+SEARCH_CACHE_TTL = int(os.environ.get("SEARCH_CACHE_TTL", 60))
+SONG_CACHE_SIZE = int(os.environ.get("SONG_CACHE_SIZE", 20000))
+SONG_CACHE_TTL = int(os.environ.get("SONG_CACHE_TTL", 600))
+SONG_BATCH_MAX = int(os.environ.get("SONG_BATCH_MAX", 500))
+SONGS_PAGE_SIZE = int(os.environ.get("SONGS_PAGE_SIZE", 1000))
+SONGS_PIT_KEEP_ALIVE = os.environ.get("SONGS_PIT_KEEP_ALIVE", "1m")
+PLAYLIST_PAGE_SIZE = int(os.environ.get("PLAYLIST_PAGE_SIZE", 500))
+PLAYLIST_POSITION_MAX_LENGTH = int(os.environ.get("PLAYLIST_POSITION_MAX_LENGTH", 16))
+PLAYLIST_REBALANCE_INTERVAL = float(os.environ.get("PLAYLIST_REBALANCE_INTERVAL", 300))
+RECOMMEND_BACKEND = os.environ.get("RECOMMEND_BACKEND", "auto").lower()
+RECOMMEND_NEIGHBORS = int(os.environ.get("RECOMMEND_NEIGHBORS", 50))
+RECOMMEND_REBUILD_INTERVAL = float(os.environ.get("RECOMMEND_REBUILD_INTERVAL", 3600))
+RECOMMEND_MAX_SIZE = int(os.environ.get("RECOMMEND_MAX_SIZE", 100))
+ALS_MODEL_DIR = os.environ.get("ALS_MODEL_DIR", "models/als")
+ALS_RANK = int(os.environ.get("ALS_RANK", 32))
+ALS_REGULARIZATION = float(os.environ.get("ALS_REGULARIZATION", 0.1))
+ALS_ITERATIONS = int(os.environ.get("ALS_ITERATIONS", 10))
+ALS_WORKERS = int(os.environ.get("ALS_WORKERS", os.cpu_count() or 1))
+ALS_RELOAD_INTERVAL = float(os.environ.get("ALS_RELOAD_INTERVAL", 60))
+ALS_TRAIN_LEASE = float(os.environ.get("ALS_TRAIN_LEASE", 300))
+FEATURE_STORE_DIR = os.environ.get("FEATURE_STORE_DIR", "models/features")
+FEATURE_RELOAD_INTERVAL = float(os.environ.get("FEATURE_RELOAD_INTERVAL", 60))
+FEATURE_BLOCK_ROWS = int(os.environ.get("FEATURE_BLOCK_ROWS", 65536))
+PLAYLIST_LSH_BANDS = int(os.environ.get("PLAYLIST_LSH_BANDS", 32))
+PLAYLIST_LSH_REBUILD_INTERVAL = float(
+    os.environ.get("PLAYLIST_LSH_REBUILD_INTERVAL", 300)
+)
+SEARCH_BACKEND = os.environ.get("SEARCH_BACKEND", "auto").lower()
+SEARCH_SPELL_CORRECTION = (
+    os.environ.get("SEARCH_SPELL_CORRECTION", "true").lower() == "true"
+)
+AUTOCOMPLETE_BACKEND = os.environ.get("AUTOCOMPLETE_BACKEND", "local").lower()
+AUTOCOMPLETE_MAX_SIZE = int(os.environ.get("AUTOCOMPLETE_MAX_SIZE", 20))
+ADMIN_USERS = {
+    name.strip() for name in os.environ.get("ADMIN_USERS", "").split(",") if name.strip()
+}
 
 es = Elasticsearch(
     hosts=ELASTICSEARCH_URL,
     basic_auth=("elastic", "Ug7_T=-5myk6MEUPYCeS"),
     verify_certs=False,
 )
+aes = AsyncElasticsearch(
+    hosts=ELASTICSEARCH_URL,
+    basic_auth=("elastic", "Ug7_T=-5myk6MEUPYCeS"),
+    verify_certs=False,
+)
+
+
+def is_admin(user):
+    return user is not None and (user.id in ADMIN_USERS or user.username in ADMIN_USERS)
+
+
+async def get_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+async def get_read_db():
+    """
+    Session for read-only endpoints, served by DATABASE_REPLICA_URI when it
+    is set and by the primary otherwise.
+    """
+    async with AsyncReadSessionLocal() as db:
+        yield db
 
 
 def access_token_generate(usr: dict, expiry_time: timedelta):
@@ -57,7 +204,20 @@ def access_token_generate(usr: dict, expiry_time: timedelta):
     return encoded_jwt
 
 
-def verify_token(token: str = Depends(oauth2_scheme)):
+token_cache = TTLCache(AUTH_CACHE_SIZE, AUTH_CACHE_TTL, name="auth_token")
+user_cache = TTLCache(AUTH_CACHE_SIZE, AUTH_USER_CACHE_TTL, name="auth_user")
+
+
+def verify_claims(token: str = Depends(oauth2_scheme)):
+    """
+    Decoded JWT claims, cached per token until the token expires or
+    AUTH_CACHE_TTL passes, whichever comes first; tokens without an `exp`
+    claim are cached for AUTH_CACHE_TTL.
+    """
+    payload = token_cache.get(token)
+    if payload is not None:
+        return payload
+
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -70,12 +230,48 @@ def verify_token(token: str = Depends(oauth2_scheme)):
     except JWTError:
         raise credentials_exception
 
-    return userUUID
+    ttl = AUTH_CACHE_TTL
+    if payload.get("exp") is not None:
+        ttl = min(ttl, payload["exp"] - time.time())
+    token_cache.set(token, payload, ttl)
+    return payload
 
 
-def active_user(current_user: str = Depends(verify_token)):
-    return {
-        "user": session.query(Models.User)
-        .filter(Models.User.id == current_user)
-        .first()
-    }
+def verify_token(payload: dict = Depends(verify_claims)):
+    return payload["sub"]
+
+
+def invalidate_user(user_id):
+    user_cache.pop(user_id)
+
+
+@event.listens_for(Models.User, "after_delete")
+def _evict_deleted_user(mapper, connection, target):
+    invalidate_user(target.id)
+
+
+async def active_user(
+    payload: dict = Depends(verify_claims), db: AsyncSession = Depends(get_read_db)
+):
+    """
+    The authenticated user.
+
+    With AUTH_TRUST_CLAIMS the user is rebuilt from the token claims without
+    touching the database, so a deleted user stays valid until the token
+    expires. Otherwise the user row is cached per `sub` for
+    AUTH_USER_CACHE_TTL. Deleting a user evicts it in this process only, so
+    that TTL is how long other processes may still accept a deleted user.
+    """
+    current_user = payload["sub"]
+    if AUTH_TRUST_CLAIMS and "username" in payload:
+        return {"user": UserDetails(id=current_user, username=payload["username"])}
+
+    user = user_cache.get(current_user)
+    if user is None:
+        found = await db.scalar(
+            select(Models.User).filter(Models.User.id == current_user)
+        )
+        if found is not None:
+            user = UserDetails(id=found.id, username=found.username)
+            user_cache.set(current_user, user)
+    return {"user": user}
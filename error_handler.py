@@ -29,3 +29,9 @@ def handle_unauth():
     raise HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid Credentials"
     )
+
+
+def handle_unavailable():
+    raise HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Server Busy"
+    )
@@ -0,0 +1,130 @@
+from fastapi import HTTPException
+from sqlalchemy.orm import joinedload, load_only
+
+import models as Models
+
+# Attributes a `fields=` parameter may ask for.
+SONG_DOC_FIELDS = (
+    "id",
+    "title",
+    "artist_name",
+    "artist_id",
+    "genre_name",
+    "genre_id",
+    "album_name",
+    "album_id",
+    "total_ratings",
+    "popularity",
+)
+PLAYLIST_FIELDS = ("id", "name", "user", "songs")
+PLAYLIST_SONG_FIELDS = ("id", "title", "artist", "genre", "album")
+
+
+def parse_fieldset(fields, allowed):
+    """
+    The attributes listed in a comma separated `fields` parameter, or None
+    when it is not given. Unknown attributes are rejected with a 400.
+    """
+    if not fields:
+        return None
+    requested = list(dict.fromkeys(f.strip() for f in fields.split(",") if f.strip()))
+    unknown = [field for field in requested if field not in allowed]
+    if unknown:
+        raise HTTPException(
+            status_code=400, detail=f"Unknown fields: {', '.join(unknown)}"
+        )
+    return requested
+
+
+def project(doc, fields):
+    if fields is None:
+        return doc
+    return {field: doc[field] for field in fields if field in doc}
+
+
+def parse_playlist_fieldset(fields):
+    """
+    (playlist attributes, song attributes) for /playlistSongs. Song
+    attributes are given as `songs.<attribute>` and imply `songs`.
+    """
+    requested = parse_fieldset(
+        fields,
+        PLAYLIST_FIELDS + tuple(f"songs.{field}" for field in PLAYLIST_SONG_FIELDS),
+    )
+    if requested is None:
+        return None, None
+    song_fields = [f[len("songs.") :] for f in requested if f.startswith("songs.")]
+    top = [f for f in requested if not f.startswith("songs.")]
+    if song_fields and "songs" not in top:
+        top.append("songs")
+    elif "songs" in top and not song_fields:
+        song_fields = list(PLAYLIST_SONG_FIELDS)
+    return top, song_fields
+
+
+def playlist_load_options(top):
+    """
+    Loader options for the playlist row itself: only the requested columns,
+    and the owner when `user` is requested. Entries are paged separately.
+    """
+    if top is None:
+        return [joinedload(Models.Playlist.user)]
+    columns = [getattr(Models.Playlist, f) for f in ("id", "name") if f in top]
+    options = [load_only(Models.Playlist.id, *columns)]
+    if "user" in top:
+        options.append(joinedload(Models.Playlist.user))
+    return options
+
+
+def playlist_song_options(song_fields):
+    """
+    Loader options for a page of playlist entries that join in only the
+    song columns and relationships needed for the requested attributes.
+    """
+    relations = {
+        "artist": Models.Song.artist,
+        "genre": Models.Song.genre,
+        "album": Models.Song.album,
+    }
+    if song_fields is None:
+        return [
+            joinedload(Models.PlaylistSong.song).options(
+                *[joinedload(relation) for relation in relations.values()]
+            )
+        ]
+    song_columns = [
+        getattr(Models.Song, f) for f in ("id", "title") if f in song_fields
+    ]
+    return [
+        joinedload(Models.PlaylistSong.song).options(
+            load_only(Models.Song.id, *song_columns),
+            *[joinedload(relations[f]) for f in song_fields if f in relations],
+        )
+    ]
+
+
+def _song_dict(song, fields):
+    out = {}
+    for field in fields:
+        if field in ("id", "title"):
+            out[field] = getattr(song, field)
+        elif field == "album":
+            out[field] = {"title": song.album.title, "id": song.album.id}
+        else:
+            related = getattr(song, field)
+            out[field] = {"name": related.name, "id": related.id}
+    return out
+
+
+def playlist_dict(playlist, top, song_fields):
+    out = {}
+    for field in top:
+        if field == "user":
+            out[field] = {"username": playlist.user.username, "id": playlist.user.id}
+        elif field == "songs":
+            out[field] = [
+                {"song": _song_dict(entry.song, song_fields)} for entry in playlist.songs
+            ]
+        else:
+            out[field] = getattr(playlist, field)
+    return out
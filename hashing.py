@@ -0,0 +1,59 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from configurations import *
+from error_handler import handle_unavailable
+
+# bcrypt releases the GIL while hashing, so a thread pool gives real
+# parallelism while keeping the work off the event loop.
+_executor = ThreadPoolExecutor(
+    max_workers=HASH_CONCURRENCY, thread_name_prefix="password-hash"
+)
+_slots = None
+_waiting = 0
+
+metrics.register_gauge("password_hash_queue_depth", lambda: _waiting)
+
+
+async def _run(fn, *args):
+    """
+    Run `fn` on the hashing pool, waiting at most HASH_QUEUE_TIMEOUT seconds
+    for a free slot before answering 503.
+    """
+    global _slots, _waiting
+    if _slots is None:
+        _slots = asyncio.Semaphore(HASH_CONCURRENCY)
+
+    queued = time.perf_counter()
+    _waiting += 1
+    try:
+        await asyncio.wait_for(_slots.acquire(), HASH_QUEUE_TIMEOUT)
+    except asyncio.TimeoutError:
+        metrics.incr("password_hash_rejected")
+        handle_unavailable()
+    finally:
+        _waiting -= 1
+
+    started = time.perf_counter()
+    metrics.observe("password_hash_wait_seconds", started - queued)
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_executor, fn, *args)
+    finally:
+        _slots.release()
+        metrics.observe("password_hash_seconds", time.perf_counter() - started)
+
+
+async def hash_password(password):
+    return await _run(pwd_context.hash, password)
+
+
+async def verify_password(password, password_hash):
+    """
+    Check `password` against `password_hash`.
+
+    Returns (valid, new_hash). `new_hash` is set when the stored hash uses
+    outdated settings and should be replaced.
+    """
+    return await _run(pwd_context.verify_and_update, password, password_hash)
@@ -0,0 +1,184 @@
+import os
+import queue
+import shutil
+import threading
+import time
+
+import pandas as pd
+from sqlalchemy import and_, or_, update
+from sqlalchemy.orm import Session
+
+from configurations import *
+from bulk_loader import CatalogLoader, frame_records
+
+PENDING_STATUSES = ("queued", "running")
+
+
+class JobLost(Exception):
+    """
+    Another runner took the job over after this one's lease ran out.
+    """
+
+
+def spool_upload(upload, filename):
+    """
+    Copy an upload to the spool directory without reading it into memory.
+    """
+    os.makedirs(IMPORT_SPOOL_DIR, exist_ok=True)
+    path = os.path.join(IMPORT_SPOOL_DIR, filename)
+    with open(path, "wb") as out:
+        shutil.copyfileobj(upload, out, length=1024 * 1024)
+    return path
+
+
+def job_status(job):
+    return {
+        "job_id": job.id,
+        "filename": job.filename,
+        "status": job.status,
+        "chunks_done": job.chunks_done,
+        "rows_done": job.rows_done,
+        "seconds": round(job.seconds or 0.0, 3),
+        "rows_per_sec": round(job.rows_done / job.seconds, 1) if job.seconds else 0.0,
+        "error": job.error,
+    }
+
+
+class ImportWorker:
+    """
+    Background thread that loads spooled catalog CSVs chunk by chunk.
+
+    Each chunk is inserted in the same transaction that advances the job's
+    `chunks_done`, so a job that dies part way resumes right after its last
+    committed chunk.
+
+    Every process runs a worker, so a job is claimed atomically before it
+    runs. A running job's `updated_at` is its lease, renewed by every chunk;
+    other workers only take it over once it is IMPORT_JOB_LEASE seconds
+    old, and re-scan for such jobs as often. A chunk only commits if
+    `chunks_done` is still where the runner left it, so a runner that lost
+    its job stops instead of loading a chunk twice.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.jobs = queue.Queue()
+        self._thread = None
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(
+            target=self._run, name="import-worker", daemon=True
+        )
+        self._thread.start()
+        self.resume_pending()
+
+    def submit(self, job_id):
+        self.jobs.put(job_id)
+
+    def resume_pending(self):
+        with Session(self.engine) as db:
+            pending = (
+                db.query(Models.ImportJob.id)
+                .filter(Models.ImportJob.status.in_(PENDING_STATUSES))
+                .order_by(Models.ImportJob.created_at)
+                .all()
+            )
+        for (job_id,) in pending:
+            self.submit(job_id)
+
+    def _run(self):
+        while True:
+            try:
+                job_id = self.jobs.get(timeout=IMPORT_JOB_LEASE)
+            except queue.Empty:
+                self.resume_pending()
+                continue
+            try:
+                self.run_job(job_id)
+            except JobLost:
+                pass
+            except Exception as e:
+                self._set(job_id, status="failed", error=str(e))
+            finally:
+                self.jobs.task_done()
+
+    def claim(self, job_id):
+        """
+        Mark a queued job, or a running one whose lease ran out, as running
+        in this worker. Returns False if the job is not up for grabs.
+        """
+        now = datetime.utcnow()
+        job = Models.ImportJob
+        with self.engine.begin() as conn:
+            claimed = conn.execute(
+                update(job)
+                .where(
+                    job.id == job_id,
+                    or_(
+                        job.status == "queued",
+                        and_(
+                            job.status == "running",
+                            job.updated_at < now - timedelta(seconds=IMPORT_JOB_LEASE),
+                        ),
+                    ),
+                )
+                .values(status="running", error=None, updated_at=now)
+            ).rowcount
+        return claimed == 1
+
+    def _set(self, job_id, **values):
+        with self.engine.begin() as conn:
+            conn.execute(
+                update(Models.ImportJob)
+                .where(Models.ImportJob.id == job_id)
+                .values(**values)
+            )
+
+    def run_job(self, job_id):
+        if not self.claim(job_id):
+            return
+        with Session(self.engine) as db:
+            job = db.get(Models.ImportJob, job_id)
+            path, chunk_size = job.path, job.chunk_size
+            chunks_done, rows_done = job.chunks_done, job.rows_done
+            seconds = job.seconds or 0.0
+
+        loader = CatalogLoader(self.engine, chunk_size=chunk_size)
+        reader = pd.read_csv(path, chunksize=chunk_size)
+
+        for chunk_no, df in enumerate(reader):
+            if chunk_no < chunks_done:
+                continue
+            started = time.perf_counter()
+            records = frame_records(df)
+            try:
+                with self.engine.begin() as conn:
+                    loaded = loader.load_chunk(conn, records)
+                    seconds += time.perf_counter() - started
+                    advanced = conn.execute(
+                        update(Models.ImportJob)
+                        .where(
+                            Models.ImportJob.id == job_id,
+                            Models.ImportJob.chunks_done == chunk_no,
+                        )
+                        .values(
+                            chunks_done=chunk_no + 1,
+                            rows_done=rows_done + loaded,
+                            seconds=seconds,
+                            updated_at=datetime.utcnow(),
+                        )
+                    ).rowcount
+                    if advanced != 1:
+                        raise JobLost(job_id)
+            except Exception:
+                loader.reset_maps()
+                raise
+            rows_done += loaded
+
+        self._set(job_id, status="completed")
+        os.remove(path)
+
+
+import_worker = ImportWorker(engine)
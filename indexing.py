@@ -0,0 +1,367 @@
+import re
+import time
+
+from elasticsearch import NotFoundError
+from elasticsearch.helpers import parallel_bulk, streaming_bulk
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session, joinedload
+
+from operations import *
+
+SONGS_MAPPINGS = {
+    "_source": {"excludes": ["suggest"]},
+    "properties": {
+        "_score": {"type": "float", "store": True},
+        "id": {"type": "keyword"},
+        "artist_id": {"type": "keyword"},
+        "genre_id": {"type": "keyword"},
+        "album_id": {"type": "keyword"},
+        "total_ratings": {"type": "float"},
+        "popularity": {"type": "integer"},
+        "suggest": {"type": "completion"},
+    }
+}
+
+# Settings used while a fresh index is bulk loaded, and the ones it is
+# switched to before it starts serving searches.
+INGEST_SETTINGS = {
+    "refresh_interval": "-1",
+    "number_of_replicas": 0,
+    "translog.durability": "async",
+    "translog.flush_threshold_size": "1gb",
+}
+SERVING_SETTINGS = {
+    "refresh_interval": "1s",
+    "number_of_replicas": ES_SONGS_REPLICAS,
+    "translog.durability": "request",
+    "translog.flush_threshold_size": "512mb",
+}
+
+
+def rating_averages():
+    """
+    Average rating per song as a subquery, computed in a single GROUP BY.
+    """
+    return (
+        select(
+            Models.SongRating.song_id,
+            func.round(func.avg(Models.SongRating.rating), 2).label("total_ratings"),
+        )
+        .group_by(Models.SongRating.song_id)
+        .subquery()
+    )
+
+
+_song_listeners = []
+
+
+def add_song_listener(listener):
+    """
+    Register an in-process consumer of song documents (e.g. the local search
+    index). `listener.apply(docs, deleted_ids)` receives incremental changes
+    and `listener.rebuild(engine)` is called after a full reindex.
+    """
+    _song_listeners.append(listener)
+    return listener
+
+
+def notify_song_documents(docs=(), deleted_ids=()):
+    docs, deleted_ids = list(docs), list(deleted_ids)
+    if not docs and not deleted_ids:
+        return
+    for listener in _song_listeners:
+        listener.apply(docs, deleted_ids)
+
+
+def notify_songs_reindexed(engine):
+    for listener in _song_listeners:
+        listener.rebuild(engine)
+
+
+def playlist_counts():
+    """
+    Number of playlists each song is in as a subquery, used as the song's
+    popularity.
+    """
+    return (
+        select(
+            Models.PlaylistSong.song_id,
+            func.count(Models.PlaylistSong.id).label("popularity"),
+        )
+        .group_by(Models.PlaylistSong.song_id)
+        .subquery()
+    )
+
+
+def song_document(song, total_ratings=None, popularity=None):
+    return {
+        "id": song.id,
+        "title": song.title,
+        "artist_name": song.artist.name,
+        "artist_id": song.artist.id,
+        "genre_name": song.genre.name,
+        "genre_id": song.genre.id,
+        "album_name": song.album.title,
+        "album_id": song.album.id,
+        "total_ratings": float(total_ratings) if total_ratings else 0.00,
+        "popularity": popularity or 0,
+        "suggest": {
+            "input": [song.title, song.artist.name, song.album.title],
+            "weight": popularity or 0,
+        },
+    }
+
+
+def iter_song_documents(db, song_ids=None, batch_size=DB_YIELD_PER):
+    """
+    Stream song documents with artist, genre, album, average rating and
+    popularity loaded in the same statement, fetched `batch_size` rows at a
+    time.
+    """
+    ratings = rating_averages()
+    counts = playlist_counts()
+    stmt = (
+        select(Models.Song, ratings.c.total_ratings, counts.c.popularity)
+        .outerjoin(ratings, ratings.c.song_id == Models.Song.id)
+        .outerjoin(counts, counts.c.song_id == Models.Song.id)
+        .options(
+            joinedload(Models.Song.artist),
+            joinedload(Models.Song.genre),
+            joinedload(Models.Song.album),
+        )
+        .execution_options(yield_per=batch_size)
+    )
+    if song_ids is not None:
+        stmt = stmt.where(Models.Song.id.in_(song_ids))
+    for song, total_ratings, popularity in db.execute(stmt):
+        yield song_document(song, total_ratings, popularity)
+
+
+def playlist_document(playlist, song_ids):
+    return {
+        "id": playlist.id,
+        "name": playlist.name,
+        "user": playlist.user_id,
+        "songs": song_ids,
+    }
+
+
+# Applies a batch of playlist membership changes and moves to the stored
+# document in place, so a change costs the songs it names instead of a
+# resend of the whole `songs` array. Safe to retry: removed ids are dropped,
+# appended ids are only added if missing and a move of [song, after, before]
+# puts the song right after `after`, right before `before` or at the end.
+PLAYLIST_SONGS_SCRIPT = """
+if (ctx._source.songs == null) { ctx._source.songs = []; }
+List songs = ctx._source.songs;
+if (!params.remove.isEmpty()) {
+  Set removed = new HashSet(params.remove);
+  songs.removeIf(id -> removed.contains(id));
+}
+if (!params.append.isEmpty()) {
+  Set present = new HashSet(songs);
+  for (id in params.append) {
+    if (present.add(id)) { songs.add(id); }
+  }
+}
+for (move in params.moves) {
+  int current = songs.indexOf(move[0]);
+  if (current < 0) { continue; }
+  songs.remove(current);
+  int anchor = songs.indexOf(move[1] != null ? move[1] : move[2]);
+  int target = anchor < 0 ? songs.size() : (move[1] != null ? anchor + 1 : anchor);
+  songs.add(target, move[0]);
+}
+"""
+
+
+def playlist_songs_script(append, remove, moves=()):
+    return {
+        "source": PLAYLIST_SONGS_SCRIPT,
+        "lang": "painless",
+        "params": {
+            "append": list(append),
+            "remove": list(remove),
+            "moves": [list(move) for move in moves],
+        },
+    }
+
+
+def move_song(songs, song_id, after=None, before=None):
+    """
+    A move of `PLAYLIST_SONGS_SCRIPT`, applied to a list of song ids in place.
+    """
+    if song_id not in songs:
+        return
+    songs.remove(song_id)
+    anchor = after if after is not None else before
+    if anchor in songs:
+        songs.insert(songs.index(anchor) + (after is not None), song_id)
+    else:
+        songs.append(song_id)
+
+
+def playlist_documents(db, playlist_ids):
+    """
+    Build playlist documents for `playlist_ids` with two queries.
+    """
+    playlists = (
+        db.query(Models.Playlist).filter(Models.Playlist.id.in_(playlist_ids)).all()
+    )
+    songs = {playlist.id: [] for playlist in playlists}
+    rows = (
+        db.query(Models.PlaylistSong.playlist_id, Models.PlaylistSong.song_id)
+        .filter(Models.PlaylistSong.playlist_id.in_(playlist_ids))
+        .order_by(Models.PlaylistSong.position, Models.PlaylistSong.id)
+    )
+    for playlist_id, song_id in rows:
+        songs[playlist_id].append(song_id)
+    return [playlist_document(playlist, songs[playlist.id]) for playlist in playlists]
+
+
+def document_actions(index_name, documents):
+    for doc in documents:
+        yield {"_index": index_name, "_id": doc["id"], "_source": doc}
+
+
+def bulk_index(actions, chunk_size=ES_BULK_CHUNK_SIZE, workers=ES_BULK_WORKERS):
+    """
+    Send actions through the bulk API and count indexed and failed documents.
+    """
+    if workers > 1:
+        results = parallel_bulk(
+            es,
+            actions,
+            thread_count=workers,
+            chunk_size=chunk_size,
+            raise_on_error=False,
+        )
+    else:
+        results = streaming_bulk(
+            es, actions, chunk_size=chunk_size, raise_on_error=False
+        )
+
+    indexed, errors = 0, []
+    for ok, item in results:
+        if ok:
+            indexed += 1
+        else:
+            errors.append(item)
+    return indexed, errors
+
+
+def versioned_indices(alias):
+    """
+    Existing `{alias}_v{n}` indices as (version, name), oldest first.
+    """
+    pattern = re.compile(rf"^{re.escape(alias)}_v(\d+)$")
+    try:
+        names = es.indices.get(index=f"{alias}_v*").keys()
+    except NotFoundError:
+        return []
+    versions = []
+    for name in names:
+        match = pattern.match(name)
+        if match:
+            versions.append((int(match.group(1)), name))
+    return sorted(versions)
+
+
+def alias_targets(alias):
+    try:
+        return list(es.indices.get_alias(name=alias).keys())
+    except NotFoundError:
+        return []
+
+
+def swap_alias(alias, new_index):
+    """
+    Atomically point `alias` at `new_index`.
+
+    A concrete index still named like the alias (created before indices
+    were versioned) is dropped in the same request.
+    """
+    actions = [
+        {"remove": {"index": index, "alias": alias}}
+        for index in alias_targets(alias)
+    ]
+    if es.indices.exists(index=alias) and not es.indices.exists_alias(name=alias):
+        actions.append({"remove_index": {"index": alias}})
+    actions.append(
+        {"add": {"index": new_index, "alias": alias, "is_write_index": True}}
+    )
+    es.indices.update_aliases(actions=actions)
+
+
+def prune_versions(alias, keep=ES_KEEP_VERSIONS, protect=()):
+    """
+    Delete all but the newest `keep` versions, never touching the live
+    index or the ones in `protect`.
+    """
+    protected = set(alias_targets(alias)) | set(protect)
+    stale = [
+        name
+        for _, name in versioned_indices(alias)[:-keep]
+        if name not in protected
+    ]
+    for name in stale:
+        es.indices.delete(index=name)
+    return stale
+
+
+def rollback_alias(alias=SONGS_INDEX):
+    """
+    Point `alias` back at the version built before the live one.
+    """
+    live = set(alias_targets(alias))
+    versions = [name for _, name in versioned_indices(alias)]
+    live_positions = [i for i, name in enumerate(versions) if name in live]
+    if not live_positions or live_positions[0] == 0:
+        return None
+    previous = versions[live_positions[0] - 1]
+    swap_alias(alias, previous)
+    return previous
+
+
+def reindex_songs(engine, alias=SONGS_INDEX):
+    """
+    Build a new `{alias}_v{n}` index from the database and swap `alias` to it.
+
+    Searches keep reading the previous version until the new one is fully
+    loaded, refreshed and force merged. The previous version is kept around
+    for `rollback_alias`.
+    """
+    versions = versioned_indices(alias)
+    new_index = f"{alias}_v{versions[-1][0] + 1 if versions else 1}"
+    es.indices.create(
+        index=new_index, mappings=SONGS_MAPPINGS, settings=INGEST_SETTINGS
+    )
+
+    started = time.perf_counter()
+    with Session(engine) as db:
+        indexed, errors = bulk_index(
+            document_actions(new_index, iter_song_documents(db))
+        )
+    if errors:
+        es.indices.delete(index=new_index)
+        raise RuntimeError(
+            f"{len(errors)} documents failed to index into {new_index}: {errors[:3]}"
+        )
+
+    es.indices.put_settings(index=new_index, settings=SERVING_SETTINGS)
+    es.indices.refresh(index=new_index)
+    es.options(request_timeout=ES_FORCEMERGE_TIMEOUT).indices.forcemerge(
+        index=new_index, max_num_segments=1
+    )
+    previous = alias_targets(alias)
+    swap_alias(alias, new_index)
+    pruned = prune_versions(alias, protect=previous)
+
+    seconds = time.perf_counter() - started
+    return {
+        "index": new_index,
+        "indexed": indexed,
+        "pruned": pruned,
+        "seconds": round(seconds, 3),
+        "docs_per_sec": round(indexed / seconds, 1) if seconds else 0.0,
+    }
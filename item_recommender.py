@@ -0,0 +1,148 @@
+import threading
+import time
+
+import numpy as np
+from scipy import sparse
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+import metrics
+from configurations import *
+
+
+class NeighborTable:
+    """
+    The `k` most similar songs of every song in at least one playlist.
+
+    Row `i` of `neighbors` holds the row numbers of song `song_ids[i]`'s
+    neighbours, most similar first, padded with -1; `scores` holds their
+    cosine similarities.
+    """
+
+    def __init__(self, song_ids, neighbors, scores):
+        self.song_ids = song_ids
+        self.index = {song_id: row for row, song_id in enumerate(song_ids)}
+        self.neighbors = neighbors
+        self.scores = scores
+
+    def __len__(self):
+        return len(self.song_ids)
+
+    @classmethod
+    def from_memberships(cls, pairs, k=RECOMMEND_NEIGHBORS, block_size=2048):
+        """
+        Build the table from (song id, playlist id) pairs.
+
+        Songs are rows of a binary song x playlist matrix, normalized so the
+        product of two rows is their cosine similarity. Similarities are
+        computed one block of rows at a time, so memory is bounded by the
+        block rather than by songs x songs.
+        """
+        song_index, playlist_index, song_rows, playlist_cols = {}, {}, [], []
+        for song_id, playlist_id in pairs:
+            song_rows.append(song_index.setdefault(song_id, len(song_index)))
+            playlist_cols.append(
+                playlist_index.setdefault(playlist_id, len(playlist_index))
+            )
+        n = len(song_index)
+        neighbors = np.full((n, k), -1, dtype=np.int32)
+        scores = np.zeros((n, k), dtype=np.float32)
+        if n:
+            matrix = sparse.csr_matrix(
+                (np.ones(len(song_rows), np.float32), (song_rows, playlist_cols)),
+                shape=(n, len(playlist_index)),
+            )
+            matrix.data[:] = 1.0
+            norms = np.sqrt(matrix.getnnz(axis=1)).astype(np.float32)
+            matrix = sparse.diags(1.0 / norms) @ matrix
+            transposed = matrix.T.tocsr()
+            for start in range(0, n, block_size):
+                block = (matrix[start : start + block_size] @ transposed).tocsr()
+                for offset in range(block.shape[0]):
+                    row = start + offset
+                    lo, hi = block.indptr[offset], block.indptr[offset + 1]
+                    columns, values = block.indices[lo:hi], block.data[lo:hi]
+                    keep = columns != row
+                    columns, values = columns[keep], values[keep]
+                    if len(values) > k:
+                        top = np.argpartition(-values, k)[:k]
+                        columns, values = columns[top], values[top]
+                    order = np.lexsort((columns, -values))
+                    neighbors[row, : len(order)] = columns[order]
+                    scores[row, : len(order)] = values[order]
+        song_ids = [None] * n
+        for song_id, row in song_index.items():
+            song_ids[row] = song_id
+        return cls(song_ids, neighbors, scores)
+
+    def recommend(self, seed_ids, size):
+        """
+        Up to `size` (song id, score) pairs not among `seed_ids`, scored by
+        the summed similarity to the seeds.
+        """
+        seeds = np.fromiter(
+            (self.index[s] for s in seed_ids if s in self.index), dtype=np.int64
+        )
+        if not len(seeds):
+            return []
+        neighbors = self.neighbors[seeds].ravel()
+        scores = self.scores[seeds].ravel()
+        valid = (neighbors >= 0) & ~np.isin(neighbors, seeds)
+        candidates, inverse = np.unique(neighbors[valid], return_inverse=True)
+        totals = np.bincount(inverse, weights=scores[valid])
+        if len(totals) > size:
+            top = np.argpartition(-totals, size)[:size]
+        else:
+            top = np.arange(len(totals))
+        top = top[np.lexsort((candidates[top], -totals[top]))]
+        return [(self.song_ids[candidates[i]], float(totals[i])) for i in top]
+
+
+class ItemRecommender:
+    """
+    Item-item recommendations from playlist co-occurrence.
+
+    The neighbour table is built from `playlist_songs` in a background
+    thread at startup and rebuilt every RECOMMEND_REBUILD_INTERVAL seconds;
+    requests only merge precomputed neighbour lists.
+    """
+
+    def __init__(self):
+        self.table = NeighborTable([], np.empty((0, 0), np.int32), np.empty((0, 0)))
+        self.ready = False
+        self._thread = None
+        metrics.register_gauge("recommend_item_songs", lambda: len(self.table))
+
+    def start(self, engine):
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(
+            target=self._run, args=(engine,), name="item-recommender", daemon=True
+        )
+        self._thread.start()
+
+    def _run(self, engine):
+        while True:
+            try:
+                self.rebuild(engine)
+            except Exception:
+                metrics.incr("recommend_item_build_failed")
+            time.sleep(RECOMMEND_REBUILD_INTERVAL)
+
+    def rebuild(self, engine):
+        started = time.perf_counter()
+        with Session(engine) as db:
+            pairs = db.execute(
+                select(
+                    Models.PlaylistSong.song_id, Models.PlaylistSong.playlist_id
+                ).execution_options(yield_per=DB_YIELD_PER)
+            )
+            table = NeighborTable.from_memberships(pairs)
+        self.table, self.ready = table, True
+        metrics.observe("recommend_item_build_seconds", time.perf_counter() - started)
+
+    def recommend(self, seed_ids, size):
+        return self.table.recommend(seed_ids, size)
+
+
+item_recommender = ItemRecommender()
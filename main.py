@@ -6,9 +6,19 @@ from routes import (
     populate_routes,
     recommendation_routes,
     search_routes,
-    songs_routes
-
+    songs_routes,
+    metrics_routes,
 )
+from import_jobs import import_worker
+from outbox import outbox_worker
+from playlist_order import playlist_rebalancer
+from search_backends import local_search
+from autocomplete import local_autocomplete
+from spelling import speller
+from item_recommender import item_recommender
+from als_recommender import rating_recommender, training_worker
+from song_features import song_features
+from playlist_similarity import playlist_lsh
 
 Models.Base.metadata.create_all(engine)
 
@@ -18,6 +28,34 @@ app.include_router(playlist_routes.router)
 app.include_router(search_routes.router)
 app.include_router(recommendation_routes.router)
 app.include_router(populate_routes.router)
+app.include_router(metrics_routes.router)
+
+
+@app.on_event("startup")
+def start_workers():
+    import_worker.start()
+    outbox_worker.start()
+    playlist_rebalancer.start()
+    if SEARCH_BACKEND != "elasticsearch":
+        local_search.start(engine)
+    if AUTOCOMPLETE_BACKEND == "local":
+        local_autocomplete.start(engine)
+    if SEARCH_SPELL_CORRECTION:
+        speller.start(engine)
+    if RECOMMEND_BACKEND != "elasticsearch":
+        item_recommender.start(engine)
+    rating_recommender.start()
+    training_worker.start()
+    song_features.start(engine)
+    playlist_lsh.start(engine)
+
+
+@app.on_event("shutdown")
+async def close_clients():
+    await aes.close()
+    await async_engine.dispose()
+    if replica_engine is not async_engine:
+        await replica_engine.dispose()
 
 
 
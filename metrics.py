@@ -0,0 +1,49 @@
+import threading
+
+_lock = threading.Lock()
+_counters = {}
+_timings = {}
+_gauges = {}
+
+
+def incr(name, value=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def observe(name, value):
+    """
+    Record one sample of a timing or size metric.
+    """
+    with _lock:
+        stats = _timings.setdefault(name, {"count": 0, "sum": 0.0, "max": 0.0})
+        stats["count"] += 1
+        stats["sum"] += value
+        stats["max"] = max(stats["max"], value)
+
+
+def register_gauge(name, fn):
+    """
+    Register a callable that is evaluated whenever metrics are read.
+    """
+    _gauges[name] = fn
+
+
+def snapshot():
+    with _lock:
+        counters = dict(_counters)
+        timings = {
+            name: {
+                "count": stats["count"],
+                "avg": stats["sum"] / stats["count"] if stats["count"] else 0.0,
+                "max": stats["max"],
+            }
+            for name, stats in _timings.items()
+        }
+    gauges = {}
+    for name, fn in _gauges.items():
+        try:
+            gauges[name] = fn()
+        except Exception as e:
+            gauges[name] = str(e)
+    return {"counters": counters, "timings": timings, "gauges": gauges}
@@ -0,0 +1,156 @@
+"""
+MinHash signatures of playlist song sets and an LSH index over them.
+
+A signature is SIGNATURE_SIZE minimums of independent hash functions over
+a playlist's song ids; the fraction of positions at which two signatures
+agree estimates the Jaccard similarity of the two song sets. Adding songs
+only lowers minimums, so it updates a signature in place. Removing songs
+only needs a recomputation when a removed song held one of the minimums.
+
+The LSH index cuts signatures into bands and buckets playlists by each
+band; playlists that share any bucket are candidates, so a lookup touches
+only the playlists likely to be similar instead of all of them.
+
+This module only depends on NumPy so migrations can import it.
+"""
+import hashlib
+
+import numpy as np
+
+SIGNATURE_SIZE = 128
+# Largest prime below 2**32; hashes and coefficients are below it, so
+# a * h + b fits in 64 bits.
+PRIME = 4294967291
+EMPTY = np.uint32(0xFFFFFFFF)
+
+_coefficients = np.random.default_rng(20240101).integers(
+    1, PRIME, size=(2, SIGNATURE_SIZE), dtype=np.uint64
+)
+
+
+def song_hashes(song_ids):
+    """
+    Stable 32-bit hashes of song ids, the same in every process.
+    """
+    return np.array(
+        [
+            int.from_bytes(hashlib.blake2b(s.encode(), digest_size=4).digest(), "big")
+            % PRIME
+            for s in song_ids
+        ],
+        dtype=np.uint64,
+    )
+
+
+def _song_minimums(song_ids):
+    """
+    (songs x SIGNATURE_SIZE) hash values of `song_ids`.
+    """
+    a, b = _coefficients
+    return ((song_hashes(song_ids)[:, None] * a + b) % PRIME).astype(np.uint32)
+
+
+def signature(song_ids):
+    """
+    The signature of a song set; all EMPTY for an empty one.
+    """
+    song_ids = list(song_ids)
+    if not song_ids:
+        return np.full(SIGNATURE_SIZE, EMPTY, dtype=np.uint32)
+    return _song_minimums(song_ids).min(axis=0)
+
+
+def add_songs(sig, song_ids):
+    """
+    The signature of the set `sig` was computed for plus `song_ids`.
+    """
+    song_ids = list(song_ids)
+    if not song_ids:
+        return sig
+    return np.minimum(sig, _song_minimums(song_ids).min(axis=0))
+
+
+def holds_minimum(sig, song_ids):
+    """
+    Whether any of `song_ids` provides one of the minimums of `sig`, so
+    removing them changes it.
+    """
+    song_ids = list(song_ids)
+    return bool(song_ids) and bool((_song_minimums(song_ids) == sig).any())
+
+
+def to_bytes(sig):
+    return np.asarray(sig, dtype="<u4").tobytes()
+
+
+def from_bytes(data):
+    if data is None:
+        return np.full(SIGNATURE_SIZE, EMPTY, dtype=np.uint32)
+    return np.frombuffer(data, dtype="<u4").astype(np.uint32)
+
+
+class LSHIndex:
+    """
+    Banded LSH over signatures. With `bands` bands of r rows, two sets of
+    Jaccard similarity s share a bucket with probability 1 - (1 - s^r)^b.
+    Empty playlists are not indexed.
+    """
+
+    def __init__(self, bands=32):
+        if SIGNATURE_SIZE % bands:
+            raise ValueError(f"bands must divide {SIGNATURE_SIZE}")
+        self.bands = bands
+        self.buckets = [{} for _ in range(bands)]
+        self.signatures = {}
+        self.owners = {}
+
+    def __len__(self):
+        return len(self.signatures)
+
+    def _keys(self, sig):
+        data = np.asarray(sig, dtype=np.uint32).tobytes()
+        step = len(data) // self.bands
+        return [data[i : i + step] for i in range(0, len(data), step)]
+
+    def upsert(self, playlist_id, owner_id, sig):
+        self.remove(playlist_id)
+        if (sig == EMPTY).all():
+            return
+        for bucket, key in zip(self.buckets, self._keys(sig)):
+            bucket.setdefault(key, set()).add(playlist_id)
+        self.signatures[playlist_id] = sig
+        self.owners[playlist_id] = owner_id
+
+    def remove(self, playlist_id):
+        sig = self.signatures.pop(playlist_id, None)
+        self.owners.pop(playlist_id, None)
+        if sig is None:
+            return
+        for bucket, key in zip(self.buckets, self._keys(sig)):
+            members = bucket.get(key)
+            members.discard(playlist_id)
+            if not members:
+                del bucket[key]
+
+    def similar(self, sig, size, exclude_owner=None):
+        """
+        Up to `size` (playlist id, estimated Jaccard similarity) pairs among
+        the candidates sharing a bucket with `sig`, best first, leaving out
+        playlists of `exclude_owner`.
+        """
+        if (sig == EMPTY).all():
+            return []
+        candidates = set()
+        for bucket, key in zip(self.buckets, self._keys(sig)):
+            candidates |= bucket.get(key, set())
+        candidates = sorted(
+            playlist_id
+            for playlist_id in candidates
+            if exclude_owner is None or self.owners[playlist_id] != exclude_owner
+        )
+        if not candidates:
+            return []
+        matrix = np.stack([self.signatures[playlist_id] for playlist_id in candidates])
+        scores = (matrix == sig).mean(axis=1)
+        order = np.argsort(-scores, kind="stable")[:size]
+        return [(candidates[i], float(scores[i])) for i in order]
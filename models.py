@@ -1,8 +1,22 @@
-from sqlalchemy import Column, DateTime, ForeignKey, Integer, String
+from sqlalchemy import (
+    JSON,
+    Boolean,
+    Column,
+    DateTime,
+    Float,
+    ForeignKey,
+    Index,
+    Integer,
+    LargeBinary,
+    String,
+    UniqueConstraint,
+    false,
+)
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 import uuid
+from datetime import datetime
 
 
 Base = declarative_base()
@@ -36,6 +50,9 @@ class Genre(Base):
 
 class Album(Base):
     __tablename__ = "albums"
+    __table_args__ = (
+        UniqueConstraint("artist_id", "title", name="uq_albums_artist_id_title"),
+    )
     id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
     title = Column(String, index=True)
     artist_id = Column(String, ForeignKey("artists.id", ondelete="CASCADE"))
@@ -55,6 +72,9 @@ class Song(Base):
     album = relationship("Album", back_populates="songs")
     ratings = relationship("SongRating", back_populates="song")
     playlists = relationship("PlaylistSong", back_populates="song")
+    updated_at = Column(
+        DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True
+    )
 
 
 class Playlist(Base):
@@ -66,15 +86,41 @@ class Playlist(Base):
     songs = relationship(
         "PlaylistSong", back_populates="playlist", cascade="all, delete"
     )
+    # MinHash signature of the playlist's song set, see minhash.py.
+    minhash = Column(LargeBinary, nullable=True)
+    # Set when a position key grows past PLAYLIST_POSITION_MAX_LENGTH and
+    # cleared by the rebalancer, see playlist_order.py.
+    needs_rebalance = Column(
+        Boolean, default=False, server_default=false(), nullable=False, index=True
+    )
+    updated_at = Column(
+        DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True
+    )
 
 
 class PlaylistSong(Base):
     __tablename__ = "playlist_songs"
+    __table_args__ = (
+        Index(
+            "ix_playlist_songs_playlist_id_position", "playlist_id", "position", "id"
+        ),
+        UniqueConstraint(
+            "playlist_id", "song_id", name="uq_playlist_songs_playlist_id_song_id"
+        ),
+    )
     id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
     song_id = Column(String, ForeignKey("songs.id", ondelete="CASCADE"))
     playlist_id = Column(String, ForeignKey("playlists.id", ondelete="CASCADE"))
+    # Fractional index key (see positions.py); entries are listed in
+    # (position, id) order. Compared bytewise, hence the "C" collation.
+    position = Column(
+        String().with_variant(String(collation="C"), "postgresql"), nullable=False
+    )
     playlist = relationship("Playlist", back_populates="songs")
     song = relationship("Song", back_populates="playlists")
+    updated_at = Column(
+        DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True
+    )
 
 
 class SongRating(Base):
@@ -85,6 +131,9 @@ class SongRating(Base):
     user = relationship("User", back_populates="song_ratings")
     song = relationship("Song", back_populates="ratings")
     rating = Column(Integer)
+    updated_at = Column(
+        DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True
+    )
 
 
 class SongShare(Base):
@@ -93,3 +142,56 @@ class SongShare(Base):
     from_user_id = Column(String, ForeignKey("users.id", ondelete="CASCADE"))
     to_user_id = Column(String, ForeignKey("users.id", ondelete="CASCADE"))
     song_id = Column(String, ForeignKey("songs.id", ondelete="CASCADE"))
+
+
+class ImportJob(Base):
+    __tablename__ = "import_jobs"
+    id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
+    filename = Column(String)
+    path = Column(String)
+    status = Column(String, default="queued", index=True)
+    chunk_size = Column(Integer)
+    chunks_done = Column(Integer, default=0)
+    rows_done = Column(Integer, default=0)
+    seconds = Column(Float, default=0.0)
+    error = Column(String, nullable=True)
+    created_at = Column(DateTime, server_default=func.now())
+    updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
+
+
+class TrainingJob(Base):
+    __tablename__ = "training_jobs"
+    id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
+    status = Column(String, default="queued", index=True)
+    version = Column(String, nullable=True)
+    seconds = Column(Float, nullable=True)
+    error = Column(String, nullable=True)
+    created_at = Column(DateTime, server_default=func.now())
+    updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
+
+
+class OutboxEvent(Base):
+    __tablename__ = "search_outbox"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    index_name = Column(String)
+    doc_id = Column(String)
+    op = Column(String)
+    payload = Column(JSON, nullable=True)
+    attempts = Column(Integer, default=0)
+    last_error = Column(String, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+class SyncWatermark(Base):
+    __tablename__ = "sync_watermarks"
+    name = Column(String, primary_key=True)
+    value = Column(DateTime)
+
+
+class SyncTombstone(Base):
+    __tablename__ = "sync_tombstones"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    entity = Column(String)
+    entity_id = Column(String)
+    parent_id = Column(String, nullable=True)
+    deleted_at = Column(DateTime, default=datetime.utcnow, index=True)
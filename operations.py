@@ -1,7 +1,13 @@
 from configurations import *
 
+SONGS_INDEX = "songs"
+PLAYLISTS_INDEX = "playlist-info"
+ALIASED_INDICES = {SONGS_INDEX}
+
 
 def index_exists(index_name):
+    if index_name in ALIASED_INDICES:
+        return es.indices.exists_alias(name=index_name)
     return es.indices.exists(index=index_name)
 
 
@@ -27,4 +33,57 @@ def index_dox_delete(index_name, id):
     es.delete(index=index_name, id=id)
 
 def get_doc(index_name, id):
-    return es.get(index=index_name, id=id)
\ No newline at end of file
+    return es.get(index=index_name, id=id)
+
+
+async def async_index_exists(index_name):
+    if index_name in ALIASED_INDICES:
+        return await aes.indices.exists_alias(name=index_name)
+    return await aes.indices.exists(index=index_name)
+
+
+async def async_index_search(index_name, query, size=None, **params):
+    if size:
+        return await aes.search(index=index_name, body=query, size=size, **params)
+
+    return await aes.search(index=index_name, body=query, **params)
+
+
+async def async_index_elastic(index_name, body, id=None):
+    if id:
+        return await aes.index(index=index_name, body=body, id=id)
+
+    return await aes.index(index=index_name, body=body)
+
+
+async def async_index_update(index_name, id, body):
+    await aes.update(index=index_name, id=id, body=body)
+
+
+async def async_index_dox_delete(index_name, id):
+    await aes.delete(index=index_name, id=id)
+
+
+async def async_get_doc(index_name, id):
+    return await aes.get(index=index_name, id=id)
+
+
+async def async_get_docs(index_name, ids, **params):
+    return await aes.mget(index=index_name, ids=ids, **params)
+
+
+async def async_open_point_in_time(index_name, keep_alive):
+    result = await aes.open_point_in_time(index=index_name, keep_alive=keep_alive)
+    return result["id"]
+
+
+async def async_close_point_in_time(pit_id):
+    await aes.close_point_in_time(id=pit_id)
+
+
+async def async_pit_search(query, size, **params):
+    """
+    Search the point in time given in `query["pit"]`, which already names
+    the index.
+    """
+    return await aes.search(body=query, size=size, **params)
@@ -0,0 +1,395 @@
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+from sqlalchemy import delete, func, select, text, tuple_, update
+from sqlalchemy.orm import Session
+
+import metrics
+from cache import bump_catalog_version
+from indexing import *
+
+
+def enqueue(db, index_name, doc_id, op="refresh", payload=None):
+    """
+    Record a pending search index change in the caller's transaction.
+
+    Ops:
+    - `refresh`: rebuild the document from the database (or delete it if the
+      row is gone) when the event is drained.
+    - `index` / `update`: write `payload` as the full / partial document.
+    - `delete`: remove the document.
+    - `append` / `remove`: add or drop the song ids in `payload["songs"]`
+      to or from a playlist document with a script.
+    - `move`: move `payload["song"]` of a playlist document right after
+      `payload["after"]`, right before `payload["before"]` or to the end.
+    """
+    db.add(
+        Models.OutboxEvent(
+            index_name=index_name, doc_id=doc_id, op=op, payload=payload
+        )
+    )
+
+
+def merge_membership(append, remove, op, songs):
+    """
+    (append, remove) song id lists after a further `op` of `songs`, where
+    `op` is `append` or `remove`.
+
+    The script applies removals before appends. A removal drops the id from
+    `append`. An append keeps it in `remove`, so a song removed and added
+    back leaves its old place and goes to the end, as in the database.
+    """
+    if op == "remove":
+        changed, removed = set(songs), set(remove)
+        append = [song_id for song_id in append if song_id not in changed]
+        return append, remove + [s for s in songs if s not in removed]
+    appended = set(append)
+    return append + [s for s in songs if s not in appended], remove
+
+
+def coalesce(events):
+    """
+    Fold the events of each (index, doc) into the single op that leaves the
+    document in the same final state.
+    """
+    pending = OrderedDict()
+    for event in events:
+        key = (event.index_name, event.doc_id)
+        op, payload = pending.get(key, (None, None))
+        if event.op in ("refresh", "delete"):
+            op, payload = event.op, None
+        elif event.op == "index":
+            op, payload = "index", dict(event.payload)
+        elif event.op == "update":
+            if op in (None, "update", "index"):
+                op, payload = op or "update", {**(payload or {}), **event.payload}
+            elif op == "script":
+                op, payload = "refresh", None
+        elif event.op in ("append", "remove"):
+            songs = event.payload["songs"]
+            if op is None or (op == "script" and not payload["moves"]):
+                append, remove = (
+                    (payload["append"], payload["remove"]) if op else ([], [])
+                )
+                append, remove = merge_membership(append, remove, event.op, songs)
+                payload = {"append": append, "remove": remove, "moves": []}
+                op = "script"
+            elif op == "index":
+                current = payload.get("songs") or []
+                current, _ = merge_membership(current, [], event.op, songs)
+                payload = {**payload, "songs": current}
+            elif op in ("update", "script"):
+                # The script moves songs after changing membership, so
+                # membership changes after a move need the whole document.
+                op, payload = "refresh", None
+        elif event.op == "move":
+            move = [event.payload.get(name) for name in ("song", "after", "before")]
+            if op in (None, "script"):
+                base = payload or {"append": [], "remove": [], "moves": []}
+                op, payload = "script", {**base, "moves": base["moves"] + [move]}
+            elif op == "index":
+                songs = list(payload.get("songs") or [])
+                move_song(songs, *move)
+                payload = {**payload, "songs": songs}
+            elif op == "update":
+                op, payload = "refresh", None
+        pending[key] = (op, payload)
+    return pending
+
+
+def resolve_refreshes(db, pending):
+    """
+    Replace `refresh` ops with the current documents, loaded in one query
+    per index.
+    """
+    builders = {
+        SONGS_INDEX: lambda ids: list(iter_song_documents(db, song_ids=ids)),
+        PLAYLISTS_INDEX: lambda ids: playlist_documents(db, ids),
+    }
+    for index_name, build in builders.items():
+        ids = [
+            doc_id
+            for (index, doc_id), (op, _) in pending.items()
+            if index == index_name and op == "refresh"
+        ]
+        if not ids:
+            continue
+        docs = {doc["id"]: doc for doc in build(ids)}
+        for doc_id in ids:
+            doc = docs.get(doc_id)
+            pending[(index_name, doc_id)] = ("index", doc) if doc else ("delete", None)
+
+
+def bulk_action(index_name, doc_id, op, payload):
+    if op == "index":
+        return {"_op_type": "index", "_index": index_name, "_id": doc_id, "_source": payload}
+    if op == "update":
+        return {"_op_type": "update", "_index": index_name, "_id": doc_id, "doc": payload}
+    if op == "script":
+        return {
+            "_op_type": "update",
+            "_index": index_name,
+            "_id": doc_id,
+            "script": playlist_songs_script(
+                payload["append"], payload["remove"], payload["moves"]
+            ),
+        }
+    return {"_op_type": "delete", "_index": index_name, "_id": doc_id}
+
+
+def notify_pending_songs(pending):
+    """
+    Hand resolved song changes to in-process consumers. They follow the
+    database, so this happens whether or not ES accepts the batch.
+    """
+    songs = [
+        (doc_id, op, payload)
+        for (index_name, doc_id), (op, payload) in pending.items()
+        if index_name == SONGS_INDEX
+    ]
+    notify_song_documents(
+        [{**payload, "id": doc_id} for doc_id, op, payload in songs if op != "delete"],
+        [doc_id for doc_id, op, _ in songs if op == "delete"],
+    )
+
+
+def transient_failure(result):
+    """
+    Whether a failed bulk item is the cluster's fault (rejected under load
+    or a server error) rather than the document's, so it is retried without
+    using up an attempt.
+    """
+    status = result.get("status")
+    return not isinstance(status, int) or status == 429 or status >= 500
+
+
+# Advisory lock class of outbox documents, in the two-key lock space.
+OUTBOX_LOCK_CLASS = 7302
+
+
+def lock_documents(db, keys):
+    """
+    The (index, doc id) pairs among `keys` this transaction got the
+    document's advisory lock for; those held by another drainer are
+    skipped. Without Postgres there is a single drainer and every key is
+    returned.
+    """
+    if db.get_bind().dialect.name != "postgresql" or not keys:
+        return keys
+    locked = set(
+        db.scalars(
+            text(
+                "SELECT k FROM unnest(CAST(:keys AS text[])) AS k "
+                "WHERE pg_try_advisory_xact_lock(:lock_class, hashtext(k))"
+            ),
+            {
+                "keys": [f"{index_name}/{doc_id}" for index_name, doc_id in keys],
+                "lock_class": OUTBOX_LOCK_CLASS,
+            },
+        )
+    )
+    return [key for key in keys if f"{key[0]}/{key[1]}" in locked]
+
+
+def replay_dead(db, index_name=None):
+    """
+    Give dead events, the ones out of attempts, a fresh set of attempts.
+
+    Returns the number of events queued again.
+    """
+    query = update(Models.OutboxEvent).where(
+        Models.OutboxEvent.attempts >= OUTBOX_MAX_ATTEMPTS
+    )
+    if index_name is not None:
+        query = query.where(Models.OutboxEvent.index_name == index_name)
+    return db.execute(query.values(attempts=0)).rowcount
+
+
+def item_ok(ok, item):
+    if ok:
+        return True
+    result = next(iter(item.values()))
+    return result.get("status") == 404 and "delete" in item
+
+
+class OutboxWorker:
+    """
+    Background thread that drains `search_outbox` into Elasticsearch.
+
+    Repeated changes to the same document are coalesced and sent in one bulk
+    request per batch. A batch takes all pending events of the documents it
+    picks, holding a per-document advisory lock, so drainers in other
+    processes never apply one document's events out of order.
+
+    Documents ES rejects stay in the outbox with an increased attempt count;
+    after OUTBOX_MAX_ATTEMPTS their events are dead until `replay_dead`.
+    Rejections under load and server errors do not count as attempts. The
+    worker backs off exponentially while ES is failing.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.wakeup = threading.Event()
+        self.failures = 0
+        self.lag = 0.0
+        self._thread = None
+        metrics.register_gauge("outbox_lag_seconds", self.current_lag)
+        metrics.register_gauge("outbox_pending", self.pending_count)
+        metrics.register_gauge("outbox_dead", self.dead_count)
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(
+            target=self._run, name="outbox-worker", daemon=True
+        )
+        self._thread.start()
+
+    def notify(self):
+        self.wakeup.set()
+
+    def _run(self):
+        while True:
+            try:
+                drained = self.drain_once()
+                self.failures = 0
+            except Exception:
+                drained = 0
+                self.failures += 1
+            if self.failures:
+                delay = min(
+                    OUTBOX_POLL_INTERVAL * 2 ** self.failures, OUTBOX_MAX_BACKOFF
+                )
+            elif drained:
+                continue
+            else:
+                delay = OUTBOX_POLL_INTERVAL
+            self.wakeup.wait(delay)
+            self.wakeup.clear()
+
+    def _pending(self):
+        return Models.OutboxEvent.attempts < OUTBOX_MAX_ATTEMPTS
+
+    def current_lag(self):
+        with Session(self.engine) as db:
+            oldest = db.scalar(
+                select(func.min(Models.OutboxEvent.created_at)).where(self._pending())
+            )
+        self.lag = (datetime.utcnow() - oldest).total_seconds() if oldest else 0.0
+        return self.lag
+
+    def pending_count(self):
+        with Session(self.engine) as db:
+            return db.scalar(
+                select(func.count(Models.OutboxEvent.id)).where(self._pending())
+            )
+
+    def dead_count(self):
+        with Session(self.engine) as db:
+            return db.scalar(
+                select(func.count(Models.OutboxEvent.id)).where(~self._pending())
+            )
+
+    def drain_once(self):
+        """
+        Push one batch of outbox events to Elasticsearch.
+
+        Returns the number of events removed from the outbox.
+        """
+        with Session(self.engine) as db:
+            candidates = db.execute(
+                select(Models.OutboxEvent.index_name, Models.OutboxEvent.doc_id)
+                .where(self._pending())
+                .order_by(Models.OutboxEvent.id)
+                .limit(OUTBOX_BATCH_SIZE)
+            ).all()
+            documents = lock_documents(db, list(dict.fromkeys(map(tuple, candidates))))
+            if not documents:
+                return 0
+            events = db.scalars(
+                select(Models.OutboxEvent)
+                .where(
+                    self._pending(),
+                    tuple_(
+                        Models.OutboxEvent.index_name, Models.OutboxEvent.doc_id
+                    ).in_(documents),
+                )
+                .order_by(Models.OutboxEvent.id)
+                .with_for_update()
+            ).all()
+            if not events:
+                return 0
+
+            pending = coalesce(events)
+            resolve_refreshes(db, pending)
+            notify_pending_songs(pending)
+            keys = list(pending)
+            actions = [
+                bulk_action(index_name, doc_id, *pending[(index_name, doc_id)])
+                for index_name, doc_id in keys
+            ]
+            results = streaming_bulk(
+                es,
+                actions,
+                chunk_size=ES_BULK_CHUNK_SIZE,
+                raise_on_error=False,
+                raise_on_exception=False,
+            )
+            failed, retried = {}, {}
+            for key, (ok, item) in zip(keys, results):
+                if item_ok(ok, item):
+                    continue
+                result = next(iter(item.values()))
+                if result.get("status") == 404 and pending[key][0] == "script":
+                    # Nothing to patch yet; write the whole document instead.
+                    enqueue(db, *key)
+                    continue
+                target = retried if transient_failure(result) else failed
+                target[key] = str(result.get("error"))
+
+            kept = failed.keys() | retried.keys()
+            done_ids = [e.id for e in events if (e.index_name, e.doc_id) not in kept]
+            kept_ids = [e.id for e in events if (e.index_name, e.doc_id) in kept]
+            if done_ids:
+                db.execute(
+                    delete(Models.OutboxEvent).where(Models.OutboxEvent.id.in_(done_ids))
+                )
+            for key in kept:
+                attempts = Models.OutboxEvent.attempts + (key in failed)
+                db.execute(
+                    update(Models.OutboxEvent)
+                    .where(
+                        Models.OutboxEvent.id.in_(kept_ids),
+                        Models.OutboxEvent.index_name == key[0],
+                        Models.OutboxEvent.doc_id == key[1],
+                    )
+                    .values(
+                        attempts=attempts, last_error=failed.get(key, retried.get(key))
+                    )
+                )
+            dead = sum(
+                1
+                for e in events
+                if (e.index_name, e.doc_id) in failed
+                and e.attempts + 1 >= OUTBOX_MAX_ATTEMPTS
+            )
+            now = datetime.utcnow()
+            lags = [(now - e.created_at).total_seconds() for e in events]
+            db.commit()
+
+        for lag in lags:
+            metrics.observe("outbox_event_lag_seconds", lag)
+        metrics.incr("outbox_events_drained", len(done_ids))
+        metrics.incr("outbox_documents_sent", len(actions))
+        metrics.incr("outbox_documents_failed", len(failed))
+        metrics.incr("outbox_documents_retried", len(retried))
+        metrics.incr("outbox_events_dead", dead)
+        if any(index_name == SONGS_INDEX for index_name, _ in keys):
+            bump_catalog_version()
+        if kept:
+            raise RuntimeError(f"{len(kept)} outbox documents failed")
+        return len(done_ids)
+
+
+outbox_worker = OutboxWorker(engine)
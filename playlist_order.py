@@ -0,0 +1,184 @@
+import threading
+
+from sqlalchemy import select, tuple_, update
+from sqlalchemy.orm import Session
+
+import metrics
+from configurations import *
+from positions import keys_between
+
+
+async def entry_position(db, playlist_id, song_id):
+    """
+    (position, entry id) of a song in a playlist, or None if it is not in it.
+    """
+    row = (
+        await db.execute(
+            select(Models.PlaylistSong.position, Models.PlaylistSong.id).where(
+                Models.PlaylistSong.playlist_id == playlist_id,
+                Models.PlaylistSong.song_id == song_id,
+            )
+        )
+    ).first()
+    return tuple(row) if row else None
+
+
+async def _neighbour(db, playlist_id, anchor, after, exclude):
+    """
+    Position of the entry right after (or before) `anchor` in playlist order,
+    skipping the song `exclude`. A None anchor stands for the start (or end).
+    """
+    entry = Models.PlaylistSong
+    order = tuple_(entry.position, entry.id)
+    query = select(entry.position).where(entry.playlist_id == playlist_id)
+    if exclude is not None:
+        query = query.where(entry.song_id != exclude)
+    if anchor is not None:
+        query = query.where(order > anchor if after else order < anchor)
+    if after:
+        query = query.order_by(entry.position, entry.id)
+    else:
+        query = query.order_by(entry.position.desc(), entry.id.desc())
+    return await db.scalar(query.limit(1))
+
+
+async def placement_bounds(db, playlist_id, after=None, before=None, exclude=None):
+    """
+    The (lower, upper) position keys new or moved entries go between: right
+    after the song `after`, right before the song `before`, or at the end.
+    None stands for the start or end of the playlist.
+    `exclude` is the song being moved, which is not its own neighbour.
+
+    Raises a 404 if the anchor song is not in the playlist.
+    """
+    if after is not None and before is not None:
+        raise HTTPException(status_code=400, detail="Give either after or before")
+    anchor_id = after if after is not None else before
+    if anchor_id is None:
+        return await _neighbour(db, playlist_id, None, False, exclude), None
+    anchor = await entry_position(db, playlist_id, anchor_id)
+    if anchor is None or anchor_id == exclude:
+        raise HTTPException(status_code=404, detail="Anchor song not in playlist")
+    if after is not None:
+        return anchor[0], await _neighbour(db, playlist_id, anchor, True, exclude)
+    return await _neighbour(db, playlist_id, anchor, False, exclude), anchor[0]
+
+
+async def placement_keys(db, playlist_id, n, after=None, before=None, exclude=None):
+    """
+    `n` increasing position keys for entries placed as `placement_bounds`
+    describes. Flags the playlist for rebalancing, in the caller's
+    transaction, if the keys got long.
+    """
+    keys = keys_between(
+        *await placement_bounds(db, playlist_id, after, before, exclude), n
+    )
+    if playlist_rebalancer.check(playlist_id, keys):
+        await db.execute(rebalance_flag(playlist_id, True))
+    return keys
+
+
+def rebalance_flag(playlist_id, value):
+    """
+    Statement setting `needs_rebalance`, keeping `updated_at` since the flag
+    is invisible outside the DB.
+    """
+    return (
+        update(Models.Playlist)
+        .where(Models.Playlist.id == playlist_id)
+        .values(needs_rebalance=value, updated_at=Models.Playlist.updated_at)
+    )
+
+
+class PlaylistRebalancer:
+    """
+    Background thread that rewrites a playlist's position keys evenly once
+    any of them grows past PLAYLIST_POSITION_MAX_LENGTH.
+
+    Keys only grow when entries are inserted repeatedly at the same spot, so
+    this is rare and keeps moves and inserts to a single row write. The
+    writes that produce long keys queue the playlist in this process and set
+    its indexed `needs_rebalance` flag, which a periodic scan picks up for
+    playlists flagged by other processes.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.wakeup = threading.Event()
+        self.requested = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(
+            target=self._run, name="playlist-rebalancer", daemon=True
+        )
+        self._thread.start()
+
+    def check(self, playlist_id, keys):
+        """
+        Queue `playlist_id` for rebalancing if any of `keys` is too long.
+        Returns whether it did.
+        """
+        if not any(len(key) > PLAYLIST_POSITION_MAX_LENGTH for key in keys):
+            return False
+        with self._lock:
+            self.requested.add(playlist_id)
+        self.wakeup.set()
+        return True
+
+    def _run(self):
+        while True:
+            self.wakeup.wait(PLAYLIST_REBALANCE_INTERVAL)
+            self.wakeup.clear()
+            with self._lock:
+                playlist_ids, self.requested = self.requested, set()
+            try:
+                playlist_ids |= self.scan()
+                for playlist_id in playlist_ids:
+                    self.rebalance(playlist_id)
+            except Exception:
+                metrics.incr("playlist_rebalance_failed")
+
+    def scan(self):
+        with Session(self.engine) as db:
+            return set(
+                db.scalars(
+                    select(Models.Playlist.id).where(Models.Playlist.needs_rebalance)
+                )
+            )
+
+    def rebalance(self, playlist_id):
+        """
+        Give the entries of `playlist_id` short, evenly spread keys in their
+        current order. `updated_at` is kept so the sync does not reindex
+        the playlist's songs for a change that is invisible outside the DB.
+        """
+        with Session(self.engine) as db:
+            db.scalar(
+                select(Models.Playlist.id)
+                .where(Models.Playlist.id == playlist_id)
+                .with_for_update()
+            )
+            entries = db.execute(
+                select(Models.PlaylistSong.id, Models.PlaylistSong.updated_at)
+                .where(Models.PlaylistSong.playlist_id == playlist_id)
+                .order_by(Models.PlaylistSong.position, Models.PlaylistSong.id)
+            ).all()
+            keys = keys_between(None, None, len(entries))
+            if entries:
+                db.execute(
+                    update(Models.PlaylistSong),
+                    [
+                        {"id": entry_id, "position": key, "updated_at": updated_at}
+                        for (entry_id, updated_at), key in zip(entries, keys)
+                    ],
+                )
+            db.execute(rebalance_flag(playlist_id, False))
+            db.commit()
+        metrics.incr("playlist_rebalanced")
+
+
+playlist_rebalancer = PlaylistRebalancer(engine)
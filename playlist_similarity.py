@@ -0,0 +1,133 @@
+import threading
+import time
+
+from sqlalchemy import select, update
+from sqlalchemy.orm import Session
+
+import metrics
+import minhash
+from configurations import *
+
+
+async def update_signature(db, playlist_id, added=(), removed=()):
+    """
+    Bring the stored MinHash signature of a locked playlist in line with
+    songs just `added` and `removed`, in the caller's transaction. The
+    playlist's songs are only read back when a removed song held one of the
+    signature's minimums.
+
+    Returns the playlist's owner and new signature.
+    """
+    owner_id, data = (
+        await db.execute(
+            select(Models.Playlist.user_id, Models.Playlist.minhash).where(
+                Models.Playlist.id == playlist_id
+            )
+        )
+    ).one()
+    sig = minhash.from_bytes(data)
+    if minhash.holds_minimum(sig, removed):
+        sig = minhash.signature(
+            await db.scalars(
+                select(Models.PlaylistSong.song_id).where(
+                    Models.PlaylistSong.playlist_id == playlist_id
+                )
+            )
+        )
+        metrics.incr("playlist_minhash_recomputed")
+    else:
+        sig = minhash.add_songs(sig, added)
+    await db.execute(
+        update(Models.Playlist)
+        .where(Models.Playlist.id == playlist_id)
+        .values(minhash=minhash.to_bytes(sig))
+    )
+    return owner_id, sig
+
+
+class PlaylistLSH:
+    """
+    "Playlists like yours" from an in-process LSH index of playlist MinHash
+    signatures.
+
+    The index is loaded from `playlists.minhash` in a background thread at
+    startup and every PLAYLIST_LSH_REBUILD_INTERVAL seconds, and updated in
+    between by the playlist changes this process commits. Changes made while
+    it is being loaded are replayed onto it before the swap.
+    """
+
+    def __init__(self):
+        self.index = minhash.LSHIndex(PLAYLIST_LSH_BANDS)
+        self.ready = False
+        self._lock = threading.Lock()
+        self._replay = None
+        self._thread = None
+        metrics.register_gauge("playlist_lsh_playlists", lambda: len(self.index))
+
+    def start(self, engine):
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(
+            target=self._run, args=(engine,), name="playlist-lsh", daemon=True
+        )
+        self._thread.start()
+
+    def _run(self, engine):
+        while True:
+            try:
+                self.rebuild(engine)
+            except Exception:
+                metrics.incr("playlist_lsh_build_failed")
+            time.sleep(PLAYLIST_LSH_REBUILD_INTERVAL)
+
+    def rebuild(self, engine):
+        started = time.perf_counter()
+        with self._lock:
+            self._replay = []
+        index = minhash.LSHIndex(PLAYLIST_LSH_BANDS)
+        try:
+            with Session(engine) as db:
+                rows = db.execute(
+                    select(
+                        Models.Playlist.id,
+                        Models.Playlist.user_id,
+                        Models.Playlist.minhash,
+                    )
+                    .where(Models.Playlist.minhash.isnot(None))
+                    .execution_options(yield_per=DB_YIELD_PER)
+                )
+                for playlist_id, owner_id, data in rows:
+                    index.upsert(playlist_id, owner_id, minhash.from_bytes(data))
+        except Exception:
+            with self._lock:
+                self._replay = None
+            raise
+        with self._lock:
+            for change in self._replay:
+                self._apply(index, *change)
+            self.index, self._replay = index, None
+        self.ready = True
+        metrics.observe("playlist_lsh_build_seconds", time.perf_counter() - started)
+
+    @staticmethod
+    def _apply(index, playlist_id, owner_id, sig):
+        if sig is None:
+            index.remove(playlist_id)
+        else:
+            index.upsert(playlist_id, owner_id, sig)
+
+    def apply(self, playlist_id, owner_id, sig=None):
+        """
+        Record a committed signature change; None removes the playlist.
+        """
+        with self._lock:
+            self._apply(self.index, playlist_id, owner_id, sig)
+            if self._replay is not None:
+                self._replay.append((playlist_id, owner_id, sig))
+
+    def similar(self, sig, size, exclude_owner=None):
+        with self._lock:
+            return self.index.similar(sig, size, exclude_owner)
+
+
+playlist_lsh = PlaylistLSH()
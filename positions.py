@@ -0,0 +1,147 @@
+"""
+Fractional index keys for ordering playlist entries.
+
+A key is a string that sorts (bytewise) between its neighbours, so an entry
+is moved or inserted by giving it a key between the two entries it lands
+between; no other entry is rewritten. Keys are an integer part (a head
+character giving its length, then that many digits) followed by an optional
+fraction. Appending past the end increments the integer part, so keys grow
+only logarithmically for appends and prepends; inserting repeatedly at the
+same spot lengthens the fraction until the playlist is rebalanced.
+
+This module has no dependencies so migrations can import it.
+"""
+
+DIGITS = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+INTEGER_ZERO = "a0"
+SMALLEST_INTEGER = "A" + DIGITS[0] * 26
+
+
+def _midpoint(a, b):
+    """
+    A fraction between the fractions `a` and `b` (None is the upper end).
+    """
+    if b is not None:
+        n = 0
+        while (a[n] if n < len(a) else DIGITS[0]) == b[n]:
+            n += 1
+        if n > 0:
+            return b[:n] + _midpoint(a[n:], b[n:])
+    digit_a = DIGITS.index(a[0]) if a else 0
+    digit_b = DIGITS.index(b[0]) if b is not None else len(DIGITS)
+    if digit_b - digit_a > 1:
+        return DIGITS[(digit_a + digit_b + 1) // 2]
+    if b is not None and len(b) > 1:
+        return b[:1]
+    return DIGITS[digit_a] + _midpoint(a[1:], None)
+
+
+def _integer_length(head):
+    if "a" <= head <= "z":
+        return ord(head) - ord("a") + 2
+    if "A" <= head <= "Z":
+        return ord("Z") - ord(head) + 2
+    raise ValueError(f"Invalid position key head: {head!r}")
+
+
+def _split(key):
+    integer = key[: _integer_length(key[0])]
+    fraction = key[len(integer) :]
+    if len(integer) != _integer_length(key[0]) or fraction.endswith(DIGITS[0]):
+        raise ValueError(f"Invalid position key: {key!r}")
+    return integer, fraction
+
+
+def _increment(integer):
+    head, digits = integer[0], list(integer[1:])
+    for i in reversed(range(len(digits))):
+        digit = DIGITS.index(digits[i]) + 1
+        if digit < len(DIGITS):
+            digits[i] = DIGITS[digit]
+            return head + "".join(digits)
+        digits[i] = DIGITS[0]
+    if head == "Z":
+        return INTEGER_ZERO
+    if head == "z":
+        return None
+    head = chr(ord(head) + 1)
+    if head > "a":
+        digits.append(DIGITS[0])
+    else:
+        digits.pop()
+    return head + "".join(digits)
+
+
+def _decrement(integer):
+    head, digits = integer[0], list(integer[1:])
+    for i in reversed(range(len(digits))):
+        digit = DIGITS.index(digits[i]) - 1
+        if digit >= 0:
+            digits[i] = DIGITS[digit]
+            return head + "".join(digits)
+        digits[i] = DIGITS[-1]
+    if head == "a":
+        return "Z" + DIGITS[-1]
+    if head == "A":
+        return None
+    head = chr(ord(head) - 1)
+    if head < "Z":
+        digits.append(DIGITS[-1])
+    else:
+        digits.pop()
+    return head + "".join(digits)
+
+
+def key_between(a, b):
+    """
+    A key sorting strictly between `a` and `b`, where None stands for the
+    start (for `a`) or end (for `b`) of the list.
+    """
+    if a is not None and b is not None and a >= b:
+        raise ValueError(f"{a!r} does not sort before {b!r}")
+    if a is None and b is None:
+        return INTEGER_ZERO
+    if a is None:
+        integer, fraction = _split(b)
+        if integer == SMALLEST_INTEGER:
+            return integer + _midpoint("", fraction)
+        if fraction:
+            return integer
+        key = _decrement(integer)
+        if key is None:
+            raise ValueError("Cannot prepend before the smallest position key")
+        return key
+    integer, fraction = _split(a)
+    if b is None:
+        key = _increment(integer)
+        return integer + _midpoint(fraction, None) if key is None else key
+    if integer == _split(b)[0]:
+        return integer + _midpoint(fraction, _split(b)[1])
+    key = _increment(integer)
+    if key is None:
+        raise ValueError("Cannot append after the largest position key")
+    return key if key < b else integer + _midpoint(fraction, None)
+
+
+def keys_between(a, b, n):
+    """
+    `n` increasing keys between `a` and `b`, spread out so that none is much
+    longer than a single `key_between` would be.
+    """
+    if n <= 0:
+        return []
+    if n == 1:
+        return [key_between(a, b)]
+    if b is None:
+        keys = [key_between(a, None)]
+        for _ in range(n - 1):
+            keys.append(key_between(keys[-1], None))
+        return keys
+    if a is None:
+        keys = [key_between(None, b)]
+        for _ in range(n - 1):
+            keys.append(key_between(None, keys[-1]))
+        return keys[::-1]
+    middle = n // 2
+    key = key_between(a, b)
+    return keys_between(a, key, middle) + [key] + keys_between(key, b, n - middle - 1)
@@ -6,12 +6,13 @@ from sqlalchemy.orm import Session
 from configurations import *
 import models as Models
 from error_handler import *
+from hashing import hash_password, verify_password
 
 router = APIRouter(tags=["Auth"])
 
 
 @router.post("/login")
-async def login(user: User):
+async def login(user: User, db: AsyncSession = Depends(get_db)):
     """
     Endpoint for user login.
 
@@ -21,17 +22,25 @@ async def login(user: User):
     Returns:
     - A dictionary containing the access token, user ID, and username upon successful login.
     """
-    user_found = (
-        session.query(Models.User).filter(Models.User.username == user.username).first()
+    user_found = await db.scalar(
+        select(Models.User).filter(Models.User.username == user.username)
     )
 
-    if user_found is None or not pwd_context.verify(
+    if user_found is None:
+        handle_unauth()
+    valid, new_hash = await verify_password(
         user.password_hash, user_found.password_hash
-    ):
+    )
+    if not valid:
         handle_unauth()
+    if new_hash:
+        user_found.password_hash = new_hash
+        await db.commit()
 
     access_token_expires = timedelta(minutes=30)
-    access_token = access_token_generate({"sub": user_found.id}, access_token_expires)
+    access_token = access_token_generate(
+        {"sub": user_found.id, "username": user_found.username}, access_token_expires
+    )
     return {
         "access_token": access_token,
         "user_id": user_found.id,
@@ -40,7 +49,7 @@ async def login(user: User):
 
 
 @router.post("/signUp")
-async def sign_up(user: User):
+async def sign_up(user: User, db: AsyncSession = Depends(get_db)):
     """
     Endpoint for user registration.
 
@@ -51,21 +60,19 @@ async def sign_up(user: User):
     - A dictionary indicating successful user creation and the user ID.
     """
     user_found = (
-        session.query(Models.User).filter(Models.User.username == user.username).all()
-    )
+        await db.scalars(
+            select(Models.User).filter(Models.User.username == user.username)
+        )
+    ).all()
     if user_found:
         handle_bad_request()
 
     new_user = Models.User(
-        username=user.username, password_hash=pwd_context.hash(user.password_hash)
+        username=user.username, password_hash=await hash_password(user.password_hash)
     )
-    session.add(new_user)
-    session.commit()
-    session.close()
+    db.add(new_user)
+    await db.commit()
     return {
         "detail": "User Created",
-        "userId": session.query(Models.User)
-        .filter(Models.User.username == user.username)
-        .first()
-        .id,
+        "userId": new_user.id,
     }
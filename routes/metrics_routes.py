@@ -0,0 +1,15 @@
+from fastapi import APIRouter
+import metrics
+
+router = APIRouter(tags=["Metrics"])
+
+
+@router.get("/metrics")
+def read_metrics():
+    """
+    Report in-process counters, timings and gauges.
+
+    Returns:
+    - Counters, timing summaries (count, avg, max) and current gauge values.
+    """
+    return metrics.snapshot()
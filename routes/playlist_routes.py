@@ -1,50 +1,145 @@
+import base64
+import json
+from typing import Optional
+
+from configurations import *
 from schema import *
 import models as Models
-from fastapi import APIRouter, Depends, HTTPException
+
+from fastapi import APIRouter, Depends, HTTPException, Response
+from fastapi.responses import JSONResponse
 from elasticsearch.exceptions import TransportError
 from elasticsearch import exceptions as es_exceptions
 from sqlalchemy.exc import SQLAlchemyError
 
 from operations import *
+from sqlalchemy import delete, select, tuple_, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.orm.exc import NoResultFound
 from error_handler import *
+from outbox import enqueue, outbox_worker
+from playlist_order import entry_position, placement_keys
+from positions import keys_between
+from playlist_similarity import playlist_lsh, update_signature
+import minhash
+from fieldsets import (
+    parse_playlist_fieldset,
+    playlist_dict,
+    playlist_load_options,
+    playlist_song_options,
+)
 
 router = APIRouter(tags=["Playlists"])
 
 
+def encode_entry_cursor(entry):
+    payload = json.dumps([entry.position, entry.id])
+    return base64.urlsafe_b64encode(payload.encode()).decode()
+
+
+def decode_entry_cursor(cursor):
+    try:
+        position, entry_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return position, entry_id
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+async def playlist_entries(db, playlist_id, cursor, limit, song_fields=None):
+    """
+    One page of a playlist's entries after `cursor`, in playlist order, with
+    their songs joined in, in a single query. Pages are keyed on
+    (position, id), so every page costs the same however deep into the
+    playlist it is.
+    """
+    query = select(Models.PlaylistSong).filter(
+        Models.PlaylistSong.playlist_id == playlist_id
+    )
+    if cursor:
+        query = query.filter(
+            tuple_(Models.PlaylistSong.position, Models.PlaylistSong.id)
+            > decode_entry_cursor(cursor)
+        )
+    query = (
+        query.options(*playlist_song_options(song_fields))
+        .order_by(Models.PlaylistSong.position, Models.PlaylistSong.id)
+        .limit(limit)
+    )
+    return (await db.scalars(query)).unique().all()
+
+
 @router.get("/playlistSongs/{pId}", response_model=PlayListDetails)
-async def display_songs_playlist(pId: str, current_user=Depends(active_user)):
+async def display_songs_playlist(
+    pId: str,
+    response: Response,
+    cursor: Optional[str] = None,
+    limit: int = PLAYLIST_PAGE_SIZE,
+    fields: Optional[str] = None,
+    current_user=Depends(active_user),
+    db: AsyncSession = Depends(get_read_db),
+):
     """
-    Retrieve details of a playlist, including its songs.
+    Retrieve details of a playlist, including its songs in playlist order,
+    one page of songs at a time.
+
+    The playlist and a page of its songs are read with two queries whatever
+    the page size. While more songs are left the response carries an
+    `X-Next-Cursor` header to pass back as `cursor`.
 
     Parameters:
     - `pId`: Playlist ID.
+    - `cursor`: Cursor from the previous page's `X-Next-Cursor` header.
+    - `limit`: Number of songs per page, up to PLAYLIST_PAGE_SIZE.
+    - `fields`: Comma separated attributes to return: `id`, `name`, `user`,
+      `songs`, and song attributes as `songs.id`, `songs.title`,
+      `songs.artist`, `songs.genre` and `songs.album`. Only the columns and
+      joins they need are loaded.
     - `current_user`: Dependency to get the current user.
 
     Returns:
-    - Details of the playlist, including its songs.
+    - Details of the playlist, including a page of its songs.
     """
     try:
-        list_songs = (
-            session.query(Models.Playlist)
-            .filter(
-                Models.Playlist.id == pId,
-                Models.Playlist.user_id == current_user["user"].id,
+        top, song_fields = parse_playlist_fieldset(fields)
+        limit = max(1, min(limit, PLAYLIST_PAGE_SIZE))
+        playlist = (
+            await db.scalars(
+                select(Models.Playlist)
+                .filter(
+                    Models.Playlist.id == pId,
+                    Models.Playlist.user_id == current_user["user"].id,
+                )
+                .options(*playlist_load_options(top))
             )
-            .one()
-        )
-
-        return list_songs
+        ).one()
+
+        headers = {}
+        if top is None or "songs" in top:
+            entries = await playlist_entries(db, pId, cursor, limit, song_fields)
+            set_committed_value(playlist, "songs", entries)
+            if len(entries) == limit:
+                headers["X-Next-Cursor"] = encode_entry_cursor(entries[-1])
+
+        if top is not None:
+            return JSONResponse(
+                playlist_dict(playlist, top, song_fields), headers=headers
+            )
+        response.headers.update(headers)
+        return playlist
 
     except NoResultFound:
         handle_not_found()
 
+    except HTTPException as e:
+        handle_http_exception(e)
+
     except Exception as e:
         handle_generic_error(e)
 
 
 @router.get("/displayUserPlaylistES")
-def display_playlist_elastic_search(current_user=Depends(active_user)):
+async def display_playlist_elastic_search(current_user=Depends(active_user)):
     """
     Display playlists using Elasticsearch for the current user.
 
@@ -55,13 +150,13 @@ def display_playlist_elastic_search(current_user=Depends(active_user)):
     - A generator yielding playlist information from Elasticsearch.
     """
     try:
-        if not index_exists("playlist-info"):
+        if not await async_index_exists("playlist-info"):
             handle_not_found()
         query = {
             "query": {"match": {"user": current_user["user"].id}},
             "_source": ["name"],
         }
-        result = index_search(index_name="playlist-info", query=query)
+        result = await async_index_search(index_name="playlist-info", query=query)
         hits = result.get("hits", {}).get("hits", [])
         return hits
 
@@ -73,7 +168,7 @@ def display_playlist_elastic_search(current_user=Depends(active_user)):
 
 
 @router.get("/playlistSongsES/{pId}")
-def display_songs_from_playlist(pId: str, current_user=Depends(active_user)):
+async def display_songs_from_playlist(pId: str, current_user=Depends(active_user)):
     """
     Display songs from a playlist using Elasticsearch.
 
@@ -85,7 +180,7 @@ def display_songs_from_playlist(pId: str, current_user=Depends(active_user)):
     - Songs from the specified playlist.
     """
     try:
-        if not index_exists(index_name="playlist-info"):
+        if not await async_index_exists(index_name="playlist-info"):
             handle_not_found()
         query = {
             "query": {
@@ -99,7 +194,9 @@ def display_songs_from_playlist(pId: str, current_user=Depends(active_user)):
             "_source": ["songs"],
         }
         
-        result = index_search(index_name="playlist-info", query=query, size=100)
+        result = await async_index_search(
+            index_name="playlist-info", query=query, size=100
+        )
         hits = result.get("hits", {}).get("hits", [])
         return hits
     except HTTPException as e:
@@ -110,7 +207,11 @@ def display_songs_from_playlist(pId: str, current_user=Depends(active_user)):
 
 
 @router.post("/createPlaylist")
-async def create_playlist(plist: CreatePlaylist, current_user=Depends(active_user)):
+async def create_playlist(
+    plist: CreatePlaylist,
+    current_user=Depends(active_user),
+    db: AsyncSession = Depends(get_db),
+):
     """
     Create a new playlist for the current user.
 
@@ -123,45 +224,318 @@ async def create_playlist(plist: CreatePlaylist, current_user=Depends(active_use
     """
     try:
         existing_playlist = (
-            session.query(Models.Playlist)
-            .filter(
-                Models.Playlist.name == plist.name,
-                Models.Playlist.user_id == current_user["user"].id,
+            await db.scalars(
+                select(Models.Playlist).filter(
+                    Models.Playlist.name == plist.name,
+                    Models.Playlist.user_id == current_user["user"].id,
+                )
             )
-            .all()
-        )
+        ).all()
         if existing_playlist:
             handle_bad_request()
 
         new_playlist = Models.Playlist(name=plist.name, user_id=current_user["user"].id)
 
-        session.add(new_playlist)
-        session.commit()
+        db.add(new_playlist)
+        await db.flush()
+        enqueue(db, PLAYLISTS_INDEX, new_playlist.id)
+        await db.commit()
+        outbox_worker.notify()
+        return {"Playlist Created"}
 
-        playlist_data = {
-            "id": session.query(Models.Playlist)
-            .filter(
-                Models.Playlist.name == plist.name,
-                Models.Playlist.user_id == current_user["user"].id,
+    except (SQLAlchemyError, es_exceptions.TransportError, Exception) as e:
+        handle_generic_error(e)
+
+
+async def owned_playlist(db, playlist_id, user):
+    """
+    Forbid changes to playlists that do not exist or belong to someone else.
+    The playlist row stays locked until the transaction ends, so changes to
+    one playlist's songs are serialized and never pick the same position.
+    """
+    found = await db.scalar(
+        select(Models.Playlist.id)
+        .filter(Models.Playlist.id == playlist_id, Models.Playlist.user_id == user.id)
+        .with_for_update()
+    )
+    if found is None:
+        handle_forbidden()
+
+
+async def add_playlist_songs(db, playlist_id, song_ids, after=None, before=None):
+    """
+    Add the existing songs among `song_ids` to a playlist, in order, right
+    after the song `after`, right before the song `before` or at the end.
+    Songs already in it are skipped by the unique (playlist_id, song_id)
+    constraint, so concurrent adds cannot create duplicates.
+
+    Returns the ids of the songs actually added.
+    """
+    song_ids = list(dict.fromkeys(song_ids))
+    if not song_ids:
+        return []
+    known = set(
+        await db.scalars(select(Models.Song.id).where(Models.Song.id.in_(song_ids)))
+    )
+    known = [song_id for song_id in song_ids if song_id in known]
+    if not known:
+        return []
+    keys = await placement_keys(db, playlist_id, len(known), after, before)
+    dialect = postgresql if db.get_bind().dialect.name == "postgresql" else sqlite
+    added = set(
+        (
+            await db.scalars(
+                dialect.insert(Models.PlaylistSong)
+                .values(
+                    [
+                        {"playlist_id": playlist_id, "song_id": s, "position": key}
+                        for s, key in zip(known, keys)
+                    ]
+                )
+                .on_conflict_do_nothing(index_elements=["playlist_id", "song_id"])
+                .returning(Models.PlaylistSong.song_id)
             )
-            .first()
-            .id,
-            "name": plist.name,
-            "user": current_user["user"].id,
-            "songs": [],
-        }
+        ).all()
+    )
+    return [song_id for song_id in song_ids if song_id in added]
 
-        index_elastic(
-            index_name="playlist-info", body=playlist_data, id=playlist_data["id"]
+
+async def remove_playlist_songs(db, playlist_id, song_ids):
+    """
+    Remove `song_ids` from a playlist with one statement.
+
+    Returns the ids of the songs actually removed.
+    """
+    if not song_ids:
+        return []
+    rows = (
+        await db.execute(
+            delete(Models.PlaylistSong)
+            .where(
+                Models.PlaylistSong.playlist_id == playlist_id,
+                Models.PlaylistSong.song_id.in_(song_ids),
+            )
+            .returning(Models.PlaylistSong.id, Models.PlaylistSong.song_id)
         )
-        return {"Playlist Created"}
+    ).all()
+    # Bulk deletes skip the flush hook that records tombstones.
+    db.add_all(
+        Models.SyncTombstone(
+            entity="playlist_songs", entity_id=entry_id, parent_id=playlist_id
+        )
+        for entry_id, _ in rows
+    )
+    return [song_id for _, song_id in rows]
+
+
+async def change_playlist_songs(
+    db, playlist_id, add=(), remove=(), after=None, before=None
+):
+    """
+    Apply removals, then additions, to a playlist and queue the matching
+    scripted update of its search document and update its MinHash signature
+    in the same transaction. Added songs are placed as `add_playlist_songs`
+    describes.
+
+    Returns the ids of the songs actually (added, removed).
+    """
+    removed = await remove_playlist_songs(db, playlist_id, remove)
+    added = await add_playlist_songs(db, playlist_id, add, after, before)
+    if removed:
+        enqueue(
+            db, PLAYLISTS_INDEX, playlist_id, op="remove", payload={"songs": removed}
+        )
+    if added:
+        enqueue(
+            db, PLAYLISTS_INDEX, playlist_id, op="append", payload={"songs": added}
+        )
+    if added and (after is not None or before is not None):
+        for song_id in added:
+            move = {"song": song_id, "after": after, "before": before}
+            enqueue(db, PLAYLISTS_INDEX, playlist_id, op="move", payload=move)
+            if after is not None:
+                after = song_id
+    if added or removed:
+        owner_id, sig = await update_signature(db, playlist_id, added, removed)
+    await db.commit()
+    if added or removed:
+        outbox_worker.notify()
+        playlist_lsh.apply(playlist_id, owner_id, sig)
+    return added, removed
+
+
+@router.patch("/playlist/{playlistId}/songs")
+async def change_songs(
+    playlistId: str,
+    changes: PlaylistSongChanges,
+    current_user=Depends(active_user),
+    db: AsyncSession = Depends(get_db),
+):
+    """
+    Add and remove many songs of a playlist in one call.
+
+    Removals are applied before additions. Added songs go to the end, or
+    right after the song `after` or right before the song `before`. Songs
+    already in the playlist and unknown song IDs are skipped rather than
+    failing the batch.
+
+    Parameters:
+    - `playlistId`: Playlist ID.
+    - `changes`: Song IDs to `add` and to `remove`, up to SONG_BATCH_MAX in
+      all, and optionally `after` or `before` to place the added songs.
+    - `current_user`: Dependency to get the current user.
+
+    Returns:
+    - The IDs of the songs that were added and removed.
+    """
+    try:
+        if len(changes.add) + len(changes.remove) > SONG_BATCH_MAX:
+            raise HTTPException(
+                status_code=400, detail=f"At most {SONG_BATCH_MAX} ids per request"
+            )
+        await owned_playlist(db, playlistId, current_user["user"])
+        added, removed = await change_playlist_songs(
+            db,
+            playlistId,
+            changes.add,
+            changes.remove,
+            changes.after,
+            changes.before,
+        )
+        return {"added": added, "removed": removed}
+
+    except HTTPException as e:
+        handle_http_exception(e)
+    except (SQLAlchemyError, es_exceptions.TransportError, Exception) as e:
+        handle_generic_error(e)
+
+
+@router.patch("/playlist/{playlistId}/songs/{sId}/position")
+async def move_song(
+    playlistId: str,
+    sId: str,
+    place: PlaylistSongPlacement,
+    current_user=Depends(active_user),
+    db: AsyncSession = Depends(get_db),
+):
+    """
+    Move a song within a playlist.
+
+    The song gets a position key between its new neighbours, so a move
+    writes that one row however long the playlist is.
+
+    Parameters:
+    - `playlistId`: Playlist ID.
+    - `sId`: Song ID.
+    - `place`: The song to move it right `after` or right `before`; the song
+      moves to the end if neither is given.
+    - `current_user`: Dependency to get the current user.
+
+    Returns:
+    - A message indicating the song was moved.
+    """
+    try:
+        await owned_playlist(db, playlistId, current_user["user"])
+        if await entry_position(db, playlistId, sId) is None:
+            handle_not_found()
+        (position,) = await placement_keys(
+            db, playlistId, 1, place.after, place.before, exclude=sId
+        )
+        await db.execute(
+            update(Models.PlaylistSong)
+            .where(
+                Models.PlaylistSong.playlist_id == playlistId,
+                Models.PlaylistSong.song_id == sId,
+            )
+            .values(position=position)
+        )
+        move = {"song": sId, "after": place.after, "before": place.before}
+        enqueue(db, PLAYLISTS_INDEX, playlistId, op="move", payload=move)
+        await db.commit()
+        outbox_worker.notify()
+        return {"detail": "Song Moved"}
 
+    except HTTPException as e:
+        handle_http_exception(e)
     except (SQLAlchemyError, es_exceptions.TransportError, Exception) as e:
         handle_generic_error(e)
 
 
+@router.get("/playlist/{playlistId}/similar")
+async def similar_playlists(
+    playlistId: str,
+    size: int = 10,
+    current_user=Depends(active_user),
+    db: AsyncSession = Depends(get_read_db),
+):
+    """
+    Find other users' playlists with songs in common with one of yours.
+
+    Candidates come from an LSH index of playlist MinHash signatures, so
+    only playlists likely to overlap are compared, and are ranked by their
+    estimated Jaccard similarity (shared songs over all songs of the two).
+
+    Each server process keeps its own index. It sees its own playlist
+    changes right away but changes made through other processes only after
+    its next reload, up to PLAYLIST_LSH_REBUILD_INTERVAL seconds later.
+
+    Parameters:
+    - `playlistId`: Playlist ID.
+    - `size`: Number of playlists to return, up to RECOMMEND_MAX_SIZE.
+    - `current_user`: Dependency to get the current user.
+
+    Returns:
+    - The most similar playlists with their owner and similarity, best
+      first. 503 while the index is being loaded.
+    """
+    try:
+        if not playlist_lsh.ready:
+            handle_unavailable()
+        user_id = current_user["user"].id
+        row = (
+            await db.execute(
+                select(Models.Playlist.minhash).filter(
+                    Models.Playlist.id == playlistId,
+                    Models.Playlist.user_id == user_id,
+                )
+            )
+        ).first()
+        if row is None:
+            handle_forbidden()
+        size = max(1, min(size, RECOMMEND_MAX_SIZE))
+        scored = playlist_lsh.similar(minhash.from_bytes(row[0]), size, user_id)
+        playlists = {
+            playlist.id: playlist
+            for playlist in await db.scalars(
+                select(Models.Playlist).where(
+                    Models.Playlist.id.in_([p for p, _ in scored])
+                )
+            )
+        }
+        return [
+            {
+                "id": playlist_id,
+                "name": playlists[playlist_id].name,
+                "user_id": playlists[playlist_id].user_id,
+                "similarity": similarity,
+            }
+            for playlist_id, similarity in scored
+            if playlist_id in playlists
+        ]
+
+    except HTTPException as e:
+        handle_http_exception(e)
+    except (SQLAlchemyError, Exception) as e:
+        handle_generic_error(e)
+
+
 @router.patch("/addSongs/playlist")
-async def add_songs(playlistId: str, sId: str, current_user=Depends(active_user)):
+async def add_songs(
+    playlistId: str,
+    sId: str,
+    current_user=Depends(active_user),
+    db: AsyncSession = Depends(get_db),
+):
     """
     Add songs to a playlist.
 
@@ -174,27 +548,12 @@ async def add_songs(playlistId: str, sId: str, current_user=Depends(active_user)
     - A message indicating successful addition of the song to the playlist.
     """
     try:
-        list_songs = (
-            session.query(Models.PlaylistSong)
-            .filter(Models.PlaylistSong.playlist_id == playlistId)
-            .all()
-        )
-        if list_songs:
-            is_present = any(item.song_id == sId for item in list_songs)
-            if is_present:
-                handle_bad_request()
-
-        add_song_playlist = Models.PlaylistSong(song_id=sId, playlist_id=playlistId)
-        session.add(add_song_playlist)
-        session.commit()
-
-        playlist_doc = get_doc(index_name="playlist-info", id=playlistId)
-        songs = playlist_doc["_source"].get("songs", [])
-        if sId not in songs:
-            songs.append(sId)
-            index_update(
-                index_name="playlist-info", id=playlistId, body={"doc": {"songs": songs}}
-            )
+        await owned_playlist(db, playlistId, current_user["user"])
+        added, _ = await change_playlist_songs(db, playlistId, add=[sId])
+        if not added:
+            if await db.get(Models.Song, sId) is None:
+                handle_not_found()
+            handle_bad_request()
 
         return {"detail": "Song Added To Playlist"}
 
@@ -205,7 +564,12 @@ async def add_songs(playlistId: str, sId: str, current_user=Depends(active_user)
 
 
 @router.put("/deleteSong/playlist")
-async def remove_song(playlistId: str, sId: str, current_user=Depends(active_user)):
+async def remove_song(
+    playlistId: str,
+    sId: str,
+    current_user=Depends(active_user),
+    db: AsyncSession = Depends(get_db),
+):
     """
     Remove a song from a playlist.
 
@@ -218,25 +582,9 @@ async def remove_song(playlistId: str, sId: str, current_user=Depends(active_use
     - A message indicating successful removal of the song from the playlist.
     """
     try:
-        playlist_song = (
-            session.query(Models.PlaylistSong)
-            .filter(Models.PlaylistSong.song_id == sId)
-            .first()
-        )
-
-        if playlist_song:
-            session.delete(playlist_song)
-            session.commit()
-            playlist_doc = get_doc(index_name="playlist-info", id=playlistId)
-            songs = playlist_doc["_source"].get("songs", [])
-
-            if sId in songs:
-                songs.remove(sId)
-                index_update(
-                    index_name="playlist-info", id=playlistId, body={"doc": {"songs": songs}}
-                )
-
-        else:
+        await owned_playlist(db, playlistId, current_user["user"])
+        _, removed = await change_playlist_songs(db, playlistId, remove=[sId])
+        if not removed:
             handle_not_found()
 
         return {"detail": "Song Removed From Playlist"}
@@ -249,7 +597,11 @@ async def remove_song(playlistId: str, sId: str, current_user=Depends(active_use
 
 
 @router.delete("/deletePlaylist/{playlistId}")
-async def delete_playlist(playlistId: str, current_user=Depends(active_user)):
+async def delete_playlist(
+    playlistId: str,
+    current_user=Depends(active_user),
+    db: AsyncSession = Depends(get_db),
+):
     """
     Delete a playlist.
 
@@ -261,20 +613,19 @@ async def delete_playlist(playlistId: str, current_user=Depends(active_user)):
     - A message indicating successful deletion of the playlist.
     """
     try:
-        playlist_hit = (
-            session.query(Models.Playlist)
-            .filter(
+        playlist_hit = await db.scalar(
+            select(Models.Playlist).filter(
                 Models.Playlist.id == playlistId,
                 Models.Playlist.user_id == current_user["user"].id,
             )
-            .first()
         )
-        print(playlist_hit)
         if not playlist_hit:
             handle_forbidden()
-        session.delete(playlist_hit)
-        session.commit()
-        index_dox_delete(index_name="playlist-info", id=playlistId)
+        await db.delete(playlist_hit)
+        enqueue(db, PLAYLISTS_INDEX, playlistId, op="delete")
+        await db.commit()
+        outbox_worker.notify()
+        playlist_lsh.apply(playlistId, playlist_hit.user_id)
         return {"detail": "Playlist deleted successfully"}
 
     except HTTPException as e:
@@ -286,7 +637,9 @@ async def delete_playlist(playlistId: str, current_user=Depends(active_user)):
 
 @app.get("/curatePlaylist")
 async def curate_playlist(
-    playlist_details: CuratePlaylist, current_user=Depends(active_user)
+    playlist_details: CuratePlaylist,
+    current_user=Depends(active_user),
+    db: AsyncSession = Depends(get_db),
 ):
     """
     Curate a playlist based on specified criteria.
@@ -318,32 +671,30 @@ async def curate_playlist(
     query = {"query": {"bool": {"should": should_conditions}}}
     # return query
     try:
-        result = index_search(index_name="songs", query=query, size=20)
+        result = await async_index_search(index_name="songs", query=query, size=20)
         hits = result.get("hits", {}).get("hits", [])
         # return hits
         song_list = [hit["_source"] for hit in hits]
+        sig = minhash.signature(song["id"] for song in song_list)
         new_playlist = Models.Playlist(
-            name=playlist_details.name, user_id=current_user["user"].id
+            name=playlist_details.name,
+            user_id=current_user["user"].id,
+            minhash=minhash.to_bytes(sig),
         )
-        session.add(new_playlist)
-        session.commit()
-        songs = []
-        for song in song_list:
-            songs.append(song["id"])
-        playlist_data = {
-            "id": session.query(Models.Playlist)
-            .filter(
-                Models.Playlist.name == playlist_details.name,
-                Models.Playlist.user_id == current_user["user"].id,
+        db.add(new_playlist)
+        await db.flush()
+        db.add_all(
+            Models.PlaylistSong(
+                song_id=song["id"], playlist_id=new_playlist.id, position=position
             )
-            .first()
-            .id,
-            "name": playlist_details.name,
-            "user": current_user["user"].id,
-            "songs": songs,
-        }
-
-        index_elastic(index_name="playlist-info", body=playlist_data, id=playlist_data["id"])
+            for song, position in zip(
+                song_list, keys_between(None, None, len(song_list))
+            )
+        )
+        enqueue(db, PLAYLISTS_INDEX, new_playlist.id)
+        await db.commit()
+        outbox_worker.notify()
+        playlist_lsh.apply(new_playlist.id, new_playlist.user_id, sig)
         return song_list
     except HTTPException as e:
         handle_http_exception(e)
@@ -1,134 +1,274 @@
-import io
 from configurations import *
-from typing import List
+from typing import List, Optional
 from schema import *
 import models as Models
 from fastapi import APIRouter
-import pandas as pd
-from sqlalchemy import func
+from sqlalchemy import delete, insert, update
+from fastapi.concurrency import run_in_threadpool
+from error_handler import *
+from import_jobs import import_worker, job_status, spool_upload
+from catalog_sync import (
+    purge_tombstones,
+    reindex_all_playlists,
+    reindex_all_songs,
+    sync_playlists,
+    sync_songs,
+)
+from cache import bump_catalog_version
+from indexing import rollback_alias
+from song_lookup import song_cache
+from operations import PLAYLISTS_INDEX, SONGS_INDEX
+from als_recommender import training_status, training_worker
+from outbox import enqueue, outbox_worker, replay_dead
+from playlist_similarity import playlist_lsh
 
 router = APIRouter(tags=["Populate Database"])
 
 
-@app.post("/populateDatabase")
-async def populate_tables(file: UploadFile = File(...)):
-    content = await file.read()
-    df = pd.read_csv(io.BytesIO(content))
+@app.post("/populateDatabase", status_code=status.HTTP_202_ACCEPTED)
+async def populate_tables(
+    file: UploadFile = File(...), db: AsyncSession = Depends(get_db)
+):
+    """
+    Queue a catalog CSV for import.
 
-    for row in range(len(df)):
-        artist = (
-            session.query(Models.Artist)
-            .filter_by(name=df.iloc[row].to_dict()["artist"])
-            .first()
-        )
-        if not artist:
-            artist = Models.Artist(name=df.iloc[row].to_dict()["artist"])
-            session.add(artist)
-        genre = (
-            session.query(Models.Genre)
-            .filter_by(name=df.iloc[row].to_dict()["genre"])
-            .first()
-        )
-        if not genre:
-            genre = Models.Genre(name=df.iloc[row].to_dict()["genre"])
-            session.add(genre)
-        album = (
-            session.query(Models.Album)
-            .filter_by(title=df.iloc[row].to_dict()["album"])
-            .first()
-        )
-        if not album:
-            album = Models.Album(
-                title=df.iloc[row].to_dict()["album"], artist_id=artist.id
-            )
-            session.add(album)
-        session.commit()
-        print(album.id)
-        song = Models.Song(
-            title=df.iloc[row].to_dict()["title"],
-            artist_id=artist.id,
-            genre_id=genre.id,
-            album_id=album.id,
-        )
-        session.add(song)
-    session.commit()
-    return {"message": "Database populated successfully"}
-
-
-@app.post("/populate_elastic", response_model=List[SongList])
-async def populate_tables():
-    if not es.indices.exists(index="songs"):
-        es.indices.create(
-            index="songs",
-            body={
-                "mappings": {
-                    "properties": {
-                        "_score": {"type": "float", "store": True},
-                        "id": {"type": "keyword"},
-                        "artist_id": {"type": "keyword"},
-                        "genre_id": {"type": "keyword"},
-                        "album_id": {"type": "keyword"},
-                        "total_ratings": {"type": "float"},
-                    }
-                },
-            },
-        )
+    The upload is spooled to disk and loaded in chunks by the background
+    import worker.
 
-    songs_query = session.query(Models.Song).all()
-    for item in songs_query:
-        tot_rating = (
-            session.query(func.round(func.avg(Models.SongRating.rating), 2))
-            .filter(Models.SongRating.song_id == item.id)
-            .scalar()
-        )
+    Returns:
+    - The import job id and its initial status.
+    """
+    job = Models.ImportJob(filename=file.filename, chunk_size=BULK_CHUNK_SIZE)
+    db.add(job)
+    await db.flush()
+    job.path = await run_in_threadpool(spool_upload, file.file, f"{job.id}.csv")
+    await db.commit()
+    import_worker.submit(job.id)
+    return {"job_id": job.id, "status": job.status}
+
+
+@app.get("/importJobs/{jobId}")
+async def import_job_status(jobId: str, db: AsyncSession = Depends(get_db)):
+    """
+    Report the progress of a catalog import job.
+
+    Parameters:
+    - `jobId`: Import job ID.
+
+    Returns:
+    - Status, rows done, rows/sec and the last error of the job.
+    """
+    job = await db.get(Models.ImportJob, jobId)
+    if job is None:
+        handle_not_found()
+    return job_status(job)
+
+
+@app.post("/importJobs/{jobId}/resume")
+async def resume_import_job(jobId: str, db: AsyncSession = Depends(get_db)):
+    """
+    Resume a failed import job from its last committed chunk.
+
+    Parameters:
+    - `jobId`: Import job ID.
+
+    Returns:
+    - The job status after it was queued again.
+    """
+    job = await db.get(Models.ImportJob, jobId)
+    if job is None:
+        handle_not_found()
+    if job.status != "failed":
+        handle_bad_request()
+    job.status = "queued"
+    await db.commit()
+    import_worker.submit(job.id)
+    return job_status(job)
+
+
+@app.post("/populate_elastic")
+def populate_elastic(incremental: bool = False):
+    """
+    Sync songs into Elasticsearch.
+
+    Parameters:
+    - `incremental`: Only reindex songs changed since the last sync and
+      delete removed ones, instead of rebuilding the songs index as a new
+      version and swapping the `songs` alias to it.
+
+    Returns:
+    - Number of indexed and deleted documents and the time taken.
+    """
+    try:
+        if incremental:
+            stats = sync_songs(engine)
+        else:
+            stats = reindex_all_songs(engine)
+        if not es.indices.exists(index=PLAYLISTS_INDEX):
+            es.indices.create(index=PLAYLISTS_INDEX)
+        purge_tombstones(engine)
+        return stats
+
+    except Exception as e:
+        handle_generic_error(e)
+
+
+@app.post("/populate_elastic/rollback")
+def rollback_elastic():
+    """
+    Point the `songs` alias back at the previous index version.
+
+    Returns:
+    - The index the alias now points to.
+    """
+    previous = rollback_alias(SONGS_INDEX)
+    if previous is None:
+        handle_not_found()
+    bump_catalog_version()
+    song_cache.clear()
+    return {"index": previous}
 
-        it = {
-            "id": item.id,
-            "title": item.title,
-            "artist_name": item.artist.name,
-            "artist_id": item.artist.id,
-            "genre_name": item.genre.name,
-            "genre_id": item.genre.id,
-            "album_name": item.album.title,
-            "album_id": item.album.id,
-            "total_ratings": 0.00 if not tot_rating else tot_rating,
-        }
-        es.index(index="songs", body=it, id=item.id)
-    if not es.indices.exists(index="playlist-info"):
-        es.indices.create(index="playlist-info")
-    return songs_query
-
-
-@app.post("/playlistES", response_model=List[PlayListDetails])
-async def display_all_playlist():
-    all_playlist = session.query(Models.Playlist).all()
-    # return all_playlist
-    playlist_dicts = []
-
-    for playlist in all_playlist:
-        playlist_data = {
-            "id": playlist.id,
-            "name": playlist.name,
-            "user": playlist.user.id,
-            "songs": [],
-        }
-        playlist_data["songs"] = []
-        if playlist.songs:
-            for s in playlist.songs:
-                playlist_data["songs"].append(
-                    s.song.id,
-                )
-
-        playlist_dicts.append(playlist_data)
-    for playlist_data in playlist_dicts:
-        print(playlist_data)
-        es.index(index="playlist-info", body=playlist_data, id=playlist_data["id"])
-    return all_playlist
+
+@app.post("/playlistES")
+def populate_playlists_elastic(incremental: bool = False):
+    """
+    Sync playlists into Elasticsearch.
+
+    Parameters:
+    - `incremental`: Only reindex playlists changed since the last sync and
+      delete removed ones, instead of reindexing every playlist.
+
+    Returns:
+    - Number of indexed and deleted documents and the time taken.
+    """
+    try:
+        if incremental:
+            stats = sync_playlists(engine)
+        else:
+            stats = reindex_all_playlists(engine)
+        purge_tombstones(engine)
+        return stats
+
+    except Exception as e:
+        handle_generic_error(e)
+
+
+@app.post("/outbox/replay")
+async def replay_outbox(
+    index: Optional[str] = None, db: AsyncSession = Depends(get_db)
+):
+    """
+    Retry search outbox events that ran out of attempts.
+
+    Parameters:
+    - `index`: Only retry events for this index.
+
+    Returns:
+    - Number of events queued again.
+    """
+    try:
+        replayed = await db.run_sync(replay_dead, index)
+        await db.commit()
+        outbox_worker.notify()
+        return {"replayed": replayed}
+
+    except Exception as e:
+        handle_generic_error(e)
+
+
+@app.post("/trainRatingModel", status_code=status.HTTP_202_ACCEPTED)
+async def train_rating_model(db: AsyncSession = Depends(get_db)):
+    """
+    Queue training of the ALS rating model on all song ratings.
+
+    The background trainer runs it in a pool of ALS_WORKERS processes and
+    publishes the model. Every server process picks it up within
+    ALS_RELOAD_INTERVAL seconds; the one that trained it switches right
+    away. A job that is still queued is returned instead of a new one.
+
+    Returns:
+    - The training job id and its status.
+    """
+    job = await db.scalar(
+        select(Models.TrainingJob)
+        .where(Models.TrainingJob.status == "queued")
+        .order_by(Models.TrainingJob.created_at)
+        .limit(1)
+    )
+    if job is None:
+        job = Models.TrainingJob(status="queued")
+        db.add(job)
+        await db.commit()
+        training_worker.submit(job.id)
+    return training_status(job)
+
+
+@app.get("/trainingJobs/{jobId}")
+async def training_job_status(jobId: str, db: AsyncSession = Depends(get_db)):
+    """
+    Report the status of a rating model training job.
+
+    Parameters:
+    - `jobId`: Training job ID.
+
+    Returns:
+    - Status, the model version and time taken once completed, and the
+      error of a failed job.
+    """
+    job = await db.get(Models.TrainingJob, jobId)
+    if job is None:
+        handle_not_found()
+    return training_status(job)
 
 
 @app.delete("/deleteTable")
-async def delete_table():
-    delete_statement = delete(Models.PlaylistSong).where(True)
-    session.execute(delete_statement)
-    session.commit()
-    session.close()
+async def delete_table(db: AsyncSession = Depends(get_db)):
+    """
+    Remove every song from every playlist.
+
+    A bulk delete skips the `record_tombstones` flush hook, so the
+    tombstones and a `refresh` outbox event per playlist are written here,
+    in the same transaction, and the playlists' MinHash signatures are
+    cleared.
+
+    Returns:
+    - The number of playlists emptied.
+    """
+    entries = (
+        await db.execute(
+            select(Models.PlaylistSong.id, Models.PlaylistSong.playlist_id)
+        )
+    ).all()
+    playlist_ids = sorted({playlist_id for _, playlist_id in entries})
+    if entries:
+        await db.execute(
+            insert(Models.SyncTombstone),
+            [
+                {
+                    "entity": Models.PlaylistSong.__tablename__,
+                    "entity_id": entry_id,
+                    "parent_id": playlist_id,
+                }
+                for entry_id, playlist_id in entries
+            ],
+        )
+    await db.execute(delete(Models.PlaylistSong))
+    owners = (
+        await db.execute(
+            select(Models.Playlist.id, Models.Playlist.user_id).where(
+                Models.Playlist.minhash.isnot(None)
+            )
+        )
+    ).all()
+    await db.execute(
+        update(Models.Playlist)
+        .where(Models.Playlist.minhash.isnot(None))
+        .values(minhash=None)
+    )
+    for playlist_id in playlist_ids:
+        enqueue(db, PLAYLISTS_INDEX, playlist_id)
+    await db.commit()
+    outbox_worker.notify()
+    for playlist_id, owner_id in owners:
+        playlist_lsh.apply(playlist_id, owner_id)
+    return {"detail": "Playlist songs deleted", "playlists": len(playlist_ids)}
@@ -1,156 +1,185 @@
-from sqlalchemy import func
+from functools import lru_cache
+
+from sqlalchemy import func, select
 from configurations import *
 from typing import List
 from schema import *
 import models as Models
 from fastapi import APIRouter, Depends, HTTPException
 from nltk.corpus import stopwords
-from nltk.tokenize import word_tokenize
 import nltk
 
+import metrics
+from error_handler import *
+from operations import *
+from item_recommender import item_recommender
+from als_recommender import rating_recommender
+from song_lookup import get_songs
+
 nltk.download('stopwords')
 router = APIRouter(tags=["recommend"])
 
 
-def extract_doc_ids(bucket):
-    return [doc["_id"] for doc in bucket["hits"]["hits"]]
+@lru_cache(maxsize=None)
+def more_like_this_stop_words():
+    return list(set(stopwords.words("english"))) + ["feat"]
+
+
+async def user_song_ids(db, user_id):
+    """
+    IDs of the songs in any of the user's playlists.
+    """
+    return (
+        await db.scalars(
+            select(Models.PlaylistSong.song_id)
+            .join(Models.PlaylistSong.playlist)
+            .where(Models.Playlist.user_id == user_id)
+            .distinct()
+        )
+    ).all()
+
+
+async def user_rated_song_ids(db, user_id):
+    """
+    IDs of the songs the user has rated.
+    """
+    return (
+        await db.scalars(
+            select(Models.SongRating.song_id).where(
+                Models.SongRating.user_id == user_id
+            )
+        )
+    ).all()
+
+
+async def scored_songs(scored):
+    """
+    (song id, score) pairs as `{_id, _score, _source}` hits, in order.
+    """
+    docs = {doc["id"]: doc for doc in await get_songs([s for s, _ in scored])}
+    return [
+        {"_id": song_id, "_score": score, "_source": docs[song_id]}
+        for song_id, score in scored
+        if song_id in docs
+    ]
+
+
+async def more_like_this(db, song_ids, size):
+    """
+    Songs like `song_ids` from an ES `more_like_this` query, padded with
+    random songs when the user has too few to go on.
+    """
+    if not await async_index_exists(index_name=SONGS_INDEX):
+        raise HTTPException(status_code=404, detail="Index not found")
+    song_merge = [{"_id": song_id} for song_id in song_ids]
+    if len(song_merge) <= 3:
+        random_songs = (
+            await db.scalars(select(Models.Song).order_by(func.random()).limit(10))
+        ).all()
+        for item in random_songs:
+            song_merge.append({"_id": item.id})
+    mlt_query = {
+        "query": {
+            "function_score": {
+                "query": {
+                    "bool": {
+                        "should": [
+                            {
+                                "more_like_this": {
+                                    "fields": [
+                                        "artist_name",
+                                        "album_name.keyword",
+                                        "genre_name.keyword",
+                                    ],
+                                    "like": song_merge,
+                                    "min_doc_freq": 5,
+                                    "stop_words": more_like_this_stop_words(),
+                                }
+                            }
+                        ]
+                    }
+                },
+                "boost_mode": "replace",
+                "score_mode": "sum",
+            }
+        },
+    }
+    result = await aes.search(index=SONGS_INDEX, body=mlt_query, size=size)
+    return result.get("hits", {}).get("hits", [])
 
 
 @router.post("/songRecommendationES")
-def song_recommend(current_user=Depends(active_user)):
+async def song_recommend(
+    size: int = RECOMMEND_MAX_SIZE,
+    current_user=Depends(active_user),
+    db: AsyncSession = Depends(get_db),
+):
     """
     Get song recommendations for the current user based on their playlists.
 
+    Songs are scored by how often they share playlists with the user's songs,
+    from a neighbour table precomputed from all playlists. ES `more_like_this`
+    is used while the table is building, for users it has nothing for, and
+    when RECOMMEND_BACKEND is `elasticsearch`.
+
     Parameters:
+    - `size`: Number of songs to return, up to RECOMMEND_MAX_SIZE.
     - `current_user`: Dependency to get the current user.
 
     Returns:
     - A list of recommended songs based on the user's playlists.
     """
     try:
-        if not es.indices.exists(index="playlist-info"):
-            raise HTTPException(status_code=404, detail="Index not found")
-        query = {
-            "query": {"match": {"user": current_user["user"].id}},
-            "_source": ["songs"],
-        }
-
-        result = es.search(index="playlist-info", body=query)
-        hits = result.get("hits", {}).get("hits", [])
-
-        all_songs = [hit["_source"]["songs"] for hit in hits]
-        song_merge = []
-
-        for i in all_songs:
-            if i:
-                for j in i:
-                    song_merge.append({"_id": j})
-        if len(song_merge) <= 3:
-            random_songs = (
-                session.query(Models.Song).order_by(func.random()).limit(10).all()
-            )
-            for item in random_songs:
-                song_merge.append({"_id": item.id})
-        # return song_merge
-        english_stopwords = set(stopwords.words("english"))
-        # print(list(english_stopwords))
-        mlt_query = {
-            "query": {
-                "function_score": {
-                    "query": {
-                        "bool": {
-                            "should": [
-                                {
-                                    "more_like_this": {
-                                        "fields": [
-                                            "artist_name",
-                                            "album_name.keyword",
-                                            "genre_name.keyword",
-                                        ],
-                                        "like": song_merge,
-                                   
-                                        "min_doc_freq": 5,
-                                        "stop_words": list(english_stopwords)
-                                        + ["feat"],
-                                    }
-                                }
-                            ]
-                        }
-                    },
-                    "boost_mode": "replace",
-                    "score_mode": "sum",
-                }
-            },
-            # "explain": True,
-            "aggs": {
-                "top_artists": {
-                    "terms": {
-                        "field": "artist_name.keyword",
-                        "order": {"total_score": "desc"},
-                    },
-                    "aggs": {
-                        "total_score": {"sum": {"script": "_score"}},
-                        "order_total_score": {
-                            "bucket_selector": {
-                                "buckets_path": {"totalScore": "total_score"},
-                                "script": "params.totalScore > 0",
-                            }
-                        },
-                    },
-                },
-                "top_genres": {
-                    "terms": {
-                        "field": "genre_name.keyword",
-                        "order": {"total_score": "desc"},
-                    },
-                    "aggs": {
-                        "total_score": {"sum": {"script": "_score"}},
-                        "order_total_score": {
-                            "bucket_selector": {
-                                "buckets_path": {"totalScore": "total_score"},
-                                "script": "params.totalScore > 0",
-                            }
-                        },
-                    },
-                },
-                "top_albums": {
-                    "terms": {
-                        "field": "album_name.keyword",
-                        "order": {"total_score": "desc"},
-                    },
-                    "aggs": {
-                        "total_score": {"sum": {"script": "_score"}},
-                        "order_total_score": {
-                            "bucket_selector": {
-                                "buckets_path": {"totalScore": "total_score"},
-                                "script": "params.totalScore > 0",
-                            }
-                        },
-                    },
-                },
-            },
-        }
-
-        result = es.search(index="songs", body=mlt_query, size=100)
-        top_artists_buckets = result["aggregations"]["top_artists"]["buckets"]
-        top_genres_buckets = result["aggregations"]["top_genres"]["buckets"]
-        top_albums_buckets = result["aggregations"]["top_albums"]["buckets"]
-        # artist_doc_ids = extract_doc_ids(top_artists_buckets)
-        # genre_doc_ids = extract_doc_ids(top_genres_buckets)
-        # album_doc_ids = extract_doc_ids(top_albums_buckets)
-        # return top_albums_buckets
-        return result.get("hits", {}).get("hits", [])
-        explanations = {}
-        for hit in result.get("hits", {}).get("hits", []):
-            # print(hit)
-            doc_id = hit.get("_id")
-            # print("doc")
-            # print(doc_id)
-            explanation = es.explain(index="songs", id=doc_id, body=mlt_query)
-            explanations[doc_id] = explanation
-
-        # result["_explanations"] = explanations
-        return explanations
+        size = max(1, min(size, RECOMMEND_MAX_SIZE))
+        song_ids = await user_song_ids(db, current_user["user"].id)
+        if RECOMMEND_BACKEND != "elasticsearch" and item_recommender.ready:
+            scored = item_recommender.recommend(song_ids, size)
+            if scored:
+                metrics.incr("recommend_backend_item")
+                return await scored_songs(scored)
+        metrics.incr("recommend_backend_elasticsearch")
+        return await more_like_this(db, song_ids, size)
+
+    except HTTPException as e:
+        handle_http_exception(e)
+
+    except Exception as e:
+        handle_generic_error(e)
+
+
+@router.get("/songRecommendationALS")
+async def song_recommend_als(
+    size: int = RECOMMEND_MAX_SIZE,
+    current_user=Depends(active_user),
+    db: AsyncSession = Depends(get_db),
+):
+    """
+    Get song recommendations for the current user based on their ratings.
+
+    Songs are ranked by the rating the current ALS model predicts for the
+    user, leaving out songs they have already rated. The model is trained
+    with `/trainRatingModel`.
+
+    Parameters:
+    - `size`: Number of songs to return, up to RECOMMEND_MAX_SIZE.
+    - `current_user`: Dependency to get the current user.
+
+    Returns:
+    - A list of recommended songs with their predicted ratings, empty for
+      users the model has no ratings of. 503 if no model is loaded yet.
+    """
+    try:
+        if not rating_recommender.ready:
+            handle_unavailable()
+        size = max(1, min(size, RECOMMEND_MAX_SIZE))
+        user_id = current_user["user"].id
+        rated = await user_rated_song_ids(db, user_id)
+        scored = rating_recommender.recommend(user_id, rated, size)
+        metrics.incr("recommend_backend_als")
+        return await scored_songs(scored)
+
+    except HTTPException as e:
+        handle_http_exception(e)
 
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        handle_generic_error(e)
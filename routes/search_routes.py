@@ -1,44 +1,124 @@
+import json
+import time
+from typing import Optional
+from urllib.parse import quote
+
 from configurations import *
 from schema import *
 
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Response
 from error_handler import *
 from operations import *
+import metrics
+from autocomplete import autocomplete_backend
+from fieldsets import SONG_DOC_FIELDS, parse_fieldset
+from search_backends import search_songs
+from search_cache import cached_search, normalize_query
+from spelling import speller
 
 router = APIRouter(tags=["Search"])
 
 
 @router.post("/searchES")
-def search_index(input: Search, current_user=Depends(active_user)):
+async def search_index(
+    input: Search,
+    response: Response,
+    fields: Optional[str] = None,
+    current_user=Depends(active_user),
+):
     """
-    Search for songs in the Elasticsearch index.
+    Search for songs in the Elasticsearch index, or in the in-process
+    index when SEARCH_BACKEND is `local` or ES is down under `auto`.
+
+    With SEARCH_SPELL_CORRECTION misspelled terms are corrected against the
+    catalog vocabulary and the corrected query is matched exactly; the
+    correction is returned URL encoded in the `X-Did-You-Mean` header. Fuzzy
+    matching is only used if the corrected query finds nothing.
 
     Parameters:
-    - `input`: Search input containing the query string.
+    - `input`: Search input containing the query string, the mode (`fast` by
+      default, `debug` for admins to get relevance explanations), the page
+      size and the `sort` values of the last hit of the previous page as
+      `search_after`.
+    - `response`: The response, to set the `X-Did-You-Mean` header on.
+    - `fields`: Comma separated song fields to return in `_source`.
     - `current_user`: Dependency to get the current user.
 
     Returns:
     - A list of search hits containing information about the matched songs.
     """
     try:
-        if not index_exists(index_name="songs"):
-            raise HTTPException(status_code=404, detail="Index not found")
-        query = {
-            "query": {
-                "multi_match": {
-                    "query": input.input,
-                    "type": "best_fields",
-                    "fields": ["title^4", "artist_name^3", "genre_name^2", "album_name"],
-                    "fuzziness": "auto",
-                    
-                }
-                
-            },
-            "explain": True,
-        }
-        result = index_search(index_name="songs", query=query, size=10)
-        hits = result.get("hits", {}).get("hits", [])
-        return hits
+        if input.mode == "debug" and not is_admin(current_user["user"]):
+            handle_forbidden()
+        source = parse_fieldset(fields, SONG_DOC_FIELDS)
+
+        text, fuzzy = input.input, True
+        if SEARCH_SPELL_CORRECTION and speller.ready:
+            text, corrected = speller.correct(input.input)
+            fuzzy = False
+            if corrected:
+                metrics.incr("search_spelling_corrected")
+                response.headers["X-Did-You-Mean"] = quote(text)
+
+        async def fetch():
+            hits, took, backend = await search_songs(input, text, fuzzy, source)
+            if not hits and not fuzzy and not input.search_after:
+                metrics.incr("search_fuzzy_retry")
+                hits, took, backend = await search_songs(input, source=source)
+            metrics.incr(f"search_backend_{backend}")
+            metrics.observe(f"search_{input.mode}_took_ms", took)
+            metrics.observe(
+                f"search_{input.mode}_payload_bytes", len(json.dumps(hits))
+            )
+            return hits
+
+        return await cached_search(
+            (
+                normalize_query(text),
+                fuzzy,
+                input.mode,
+                input.size,
+                json.dumps(input.search_after),
+                tuple(source or ()),
+            ),
+            fetch,
+        )
+
+    except HTTPException as e:
+        handle_http_exception(e)
+
+    except Exception as e:
+        handle_generic_error(e)
+
+
+@router.get("/autocomplete")
+async def autocomplete(q: str, size: int = 10, current_user=Depends(active_user)):
+    """
+    Suggest song titles, artists and albums starting with the typed text.
+
+    Served from an in-process prefix index (or the ES completion suggester
+    when AUTOCOMPLETE_BACKEND is `elasticsearch`), so it is cheap enough to
+    call on every keystroke.
+
+    Parameters:
+    - `q`: The text typed so far.
+    - `size`: Maximum number of suggestions, up to AUTOCOMPLETE_MAX_SIZE.
+    - `current_user`: Dependency to get the current user.
+
+    Returns:
+    - A list of suggestions with their text, type (`song`, `artist` or
+      `album`) and id, most popular first.
+    """
+    try:
+        started = time.perf_counter()
+        suggestions = await autocomplete_backend.suggest(
+            q, max(1, min(size, AUTOCOMPLETE_MAX_SIZE))
+        )
+        metrics.observe("autocomplete_seconds", time.perf_counter() - started)
+        return suggestions
+
+    except HTTPException as e:
+        handle_http_exception(e)
 
     except Exception as e:
         handle_generic_error(e)
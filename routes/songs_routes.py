@@ -1,42 +1,137 @@
-from fastapi import APIRouter, Depends, HTTPException
+import asyncio
+import base64
+import json
+from typing import Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Response
+from fastapi.responses import StreamingResponse
 from configurations import *
 from schema import *
 import models as Models
-from sqlalchemy import func
+from sqlalchemy import func, select
 from sqlalchemy.exc import SQLAlchemyError
 from elasticsearch import exceptions as es_exceptions
 from error_handler import *
 from operations import *
+from outbox import enqueue, outbox_worker
+from fieldsets import SONG_DOC_FIELDS, parse_fieldset, project
+from song_lookup import get_songs
+from song_features import song_features
 
 router = APIRouter(tags=["Songs"])
 
 
+SONG_LIST_SOURCE = ["title", "artist_name", "genre_name", "album_name", "id"]
+
+
+def encode_cursor(pit_id, search_after):
+    payload = json.dumps({"pit": pit_id, "after": search_after})
+    return base64.urlsafe_b64encode(payload.encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return payload["pit"], payload["after"]
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+async def song_page(pit_id, search_after, size, source=SONG_LIST_SOURCE):
+    """
+    One page of the catalog from the point in time `pit_id`, in index order,
+    with the `source` fields of each song.
+
+    Returns the (possibly refreshed) point in time id and the hits.
+    """
+    query = {
+        "query": {"match_all": {}},
+        "_source": source,
+        "pit": {"id": pit_id, "keep_alive": SONGS_PIT_KEEP_ALIVE},
+        "sort": [{"_shard_doc": "asc"}],
+        "track_total_hits": False,
+    }
+    if search_after:
+        query["search_after"] = search_after
+    try:
+        result = await async_pit_search(
+            query,
+            size,
+            filter_path=["pit_id", "hits.hits._source", "hits.hits.sort"],
+        )
+    except es_exceptions.NotFoundError:
+        raise HTTPException(status_code=410, detail="Cursor expired")
+    return result.get("pit_id", pit_id), result.get("hits", {}).get("hits", [])
+
+
+async def stream_songs(source=SONG_LIST_SOURCE):
+    """
+    The whole catalog as NDJSON, one page in memory at a time.
+    """
+    pit_id = await async_open_point_in_time(SONGS_INDEX, SONGS_PIT_KEEP_ALIVE)
+    search_after = None
+    try:
+        while True:
+            pit_id, hits = await song_page(
+                pit_id, search_after, SONGS_PAGE_SIZE, source
+            )
+            for hit in hits:
+                yield json.dumps(hit["_source"]) + "\n"
+            if len(hits) < SONGS_PAGE_SIZE:
+                break
+            search_after = hits[-1]["sort"]
+    finally:
+        await async_close_point_in_time(pit_id)
+
+
 @router.get("/songsES")
-def elastic_query_songs():
+async def elastic_query_songs(
+    response: Response,
+    cursor: Optional[str] = None,
+    size: int = SONGS_PAGE_SIZE,
+    stream: bool = False,
+    fields: Optional[str] = None,
+):
     """
-    Retrieve information about songs from Elasticsearch.
+    Retrieve information about songs from Elasticsearch, one page at a time.
+
+    Pages are read from a point in time, so a listing is consistent even if
+    songs are indexed while it is paged through. While more pages are left
+    the response carries an `X-Next-Cursor` header to pass back as `cursor`.
+
+    Parameters:
+    - `cursor`: Cursor from the previous page's `X-Next-Cursor` header.
+    - `size`: Number of songs per page.
+    - `stream`: Stream the whole catalog as NDJSON instead of paging.
+    - `fields`: Comma separated song fields to return.
 
     Returns:
-    - A generator yielding information about songs.
+    - A list of songs, or an `application/x-ndjson` stream with one song per line.
     """
     try:
-        if not index_exists(index_name="songs"):
-            handle_not_found()
-        query = {
-            "query": {"match_all": {}},
-            "_source": ["title", "artist_name", "genre_name", "album_name", "id"],
-        }
+        source = parse_fieldset(fields, SONG_DOC_FIELDS) or SONG_LIST_SOURCE
+        if stream:
+            if not await async_index_exists(index_name=SONGS_INDEX):
+                handle_not_found()
+            return StreamingResponse(
+                stream_songs(source), media_type="application/x-ndjson"
+            )
+
+        size = max(1, min(size, SONGS_PAGE_SIZE))
+        if cursor:
+            pit_id, search_after = decode_cursor(cursor)
+        else:
+            if not await async_index_exists(index_name=SONGS_INDEX):
+                handle_not_found()
+            pit_id = await async_open_point_in_time(SONGS_INDEX, SONGS_PIT_KEEP_ALIVE)
+            search_after = None
 
-        result = index_search(index_name="songs", query=query, size=1000)
-        hits = result.get("hits", {}).get("hits", [])
+        pit_id, hits = await song_page(pit_id, search_after, size, source)
+        if len(hits) == size:
+            response.headers["X-Next-Cursor"] = encode_cursor(pit_id, hits[-1]["sort"])
+        else:
+            await async_close_point_in_time(pit_id)
         return [hit["_source"] for hit in hits]
-        # hits = result.get("hits", {}).get("hits", [])
-        # scroll_id = result.get("_scroll_id")
-        # while hits:
-        #     songs_info = [hit["_source"] for hit in hits]
-        #     yield songs_info
-        #     result = es.scroll(scroll_id=scroll_id, scroll="1m")
-        #     hits = result.get("hits", {}).get("hits", [])
 
     except HTTPException as e:
         handle_http_exception(e)
@@ -45,7 +140,11 @@ def elastic_query_songs():
 
 
 @router.put("/songRating")
-async def rate_songs(rating: SongRating, current_user=Depends(active_user)):
+async def rate_songs(
+    rating: SongRating,
+    current_user=Depends(active_user),
+    db: AsyncSession = Depends(get_db),
+):
     """
     Rate a song or update the existing rating.
 
@@ -57,13 +156,11 @@ async def rate_songs(rating: SongRating, current_user=Depends(active_user)):
     - A message indicating successful rating update or addition.
     """
     try:
-        existing_rating = (
-            session.query(Models.SongRating)
-            .filter(
+        existing_rating = await db.scalar(
+            select(Models.SongRating).filter(
                 Models.SongRating.user_id == current_user["user"].id,
                 Models.SongRating.song_id == rating.id,
             )
-            .first()
         )
 
         if existing_rating:
@@ -74,23 +171,11 @@ async def rate_songs(rating: SongRating, current_user=Depends(active_user)):
                 song_id=rating.id,
                 rating=rating.rating,
             )
-            session.add(new_rating)
-
-        session.commit()
-
-        index_update(
-            index_name="songs",
-            id=rating.id,
-            body={
-                "doc": {
-                    "total_ratings": session.query(
-                        func.round(func.avg(Models.SongRating.rating), 2)
-                    )
-                    .filter(Models.SongRating.song_id == rating.id)
-                    .scalar()
-                }
-            },
-        )
+            db.add(new_rating)
+
+        enqueue(db, SONGS_INDEX, rating.id)
+        await db.commit()
+        outbox_worker.notify()
 
         return {"detail": "Rating Updated" if existing_rating else "Rating Added"}
 
@@ -102,7 +187,11 @@ async def rate_songs(rating: SongRating, current_user=Depends(active_user)):
 
 
 @router.post("/share")
-async def share_song(share_details: Share, current_user=Depends(active_user)):
+async def share_song(
+    share_details: Share,
+    current_user=Depends(active_user),
+    db: AsyncSession = Depends(get_db),
+):
     """
     Share a song with another user.
 
@@ -119,8 +208,8 @@ async def share_song(share_details: Share, current_user=Depends(active_user)):
             to_user_id=share_details.to_user,
             song_id=share_details.song_id,
         )
-        session.add(share_song)
-        session.commit()
+        db.add(share_song)
+        await db.commit()
         return {"Song shared successfully"}
     except HTTPException as e:
         handle_http_exception(e)
@@ -129,25 +218,90 @@ async def share_song(share_details: Share, current_user=Depends(active_user)):
         handle_generic_error(e)
 
 
+@router.post("/songs/batch")
+async def songs_batch(input: SongIds, fields: Optional[str] = None):
+    """
+    Retrieve information about many songs at once.
+
+    Parameters:
+    - `input`: Up to SONG_BATCH_MAX song IDs.
+    - `fields`: Comma separated song fields to return.
+
+    Returns:
+    - The songs found, in the order they were requested.
+    """
+    try:
+        if len(input.ids) > SONG_BATCH_MAX:
+            raise HTTPException(
+                status_code=400, detail=f"At most {SONG_BATCH_MAX} ids per request"
+            )
+        fields = parse_fieldset(fields, SONG_DOC_FIELDS)
+        return [project(song, fields) for song in await get_songs(input.ids)]
+    except HTTPException as e:
+        handle_http_exception(e)
+
+    except (es_exceptions.TransportError, Exception) as e:
+        handle_generic_error(e)
+
+
 @router.get("/song/{sId}")
-async def about_song(sId: str):
+async def about_song(sId: str, fields: Optional[str] = None):
     """
     Retrieve information about a specific song from Elasticsearch.
 
     Parameters:
     - `sId`: Song ID.
+    - `fields`: Comma separated song fields to return.
 
     Returns:
     - Information about the specified song.
     """
     try:
-        if not index_exists(index_name="songs"):
+        fields = parse_fieldset(fields, SONG_DOC_FIELDS)
+        songs = await get_songs([sId])
+        if not songs:
             handle_not_found()
-        query = {"query": {"term": {"_id": sId}}}
-        response = index_search(index_name="songs", query=query)
-        song_data = response["hits"]["hits"][0]["_source"]
+        return project(songs[0], fields)
+    except HTTPException as e:
+        handle_http_exception(e)
 
-        return song_data
+    except (es_exceptions.TransportError, Exception) as e:
+        handle_generic_error(e)
+
+
+@router.get("/song/{sId}/similar")
+async def similar_songs(sId: str, size: int = 10, fields: Optional[str] = None):
+    """
+    Find the songs most similar to a song.
+
+    Songs are ranked by the cosine similarity of their feature rows (artist,
+    genre, album, average rating and popularity) in the song feature store.
+
+    Parameters:
+    - `sId`: Song ID.
+    - `size`: Number of songs to return, up to RECOMMEND_MAX_SIZE.
+    - `fields`: Comma separated song fields to return.
+
+    Returns:
+    - The most similar songs with their similarity, best first.
+    - 503 while the feature store is being built.
+    """
+    try:
+        if not song_features.ready:
+            handle_unavailable()
+        fields = parse_fieldset(fields, SONG_DOC_FIELDS)
+        size = max(1, min(size, RECOMMEND_MAX_SIZE))
+        (scored,) = await asyncio.get_running_loop().run_in_executor(
+            None, song_features.similar, [sId], size
+        )
+        if scored is None:
+            handle_not_found()
+        docs = {doc["id"]: doc for doc in await get_songs([s for s, _ in scored])}
+        return [
+            {"_id": song_id, "_score": score, "_source": project(docs[song_id], fields)}
+            for song_id, score in scored
+            if song_id in docs
+        ]
     except HTTPException as e:
         handle_http_exception(e)
 
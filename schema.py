@@ -1,6 +1,6 @@
 # build a schema using pydantic
 from pydantic import BaseModel
-from typing import Optional, List
+from typing import Any, List, Literal, Optional
 
 
 class User(BaseModel):
@@ -122,5 +122,22 @@ class Share(BaseModel):
     class Config:
         orm_mode = True
         
+class SongIds(BaseModel):
+    ids: List[str]
+
+
+class PlaylistSongPlacement(BaseModel):
+    after: Optional[str] = None
+    before: Optional[str] = None
+
+
+class PlaylistSongChanges(PlaylistSongPlacement):
+    add: List[str] = []
+    remove: List[str] = []
+
+
 class Search(BaseModel):
-    input: str
\ No newline at end of file
+    input: str
+    mode: Literal["fast", "debug"] = "fast"
+    size: int = 10
+    search_after: Optional[List[Any]] = None
\ No newline at end of file
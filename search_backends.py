@@ -0,0 +1,541 @@
+import asyncio
+import math
+import re
+import threading
+import time
+from collections import defaultdict
+
+import numpy as np
+from sqlalchemy.orm import Session
+
+import metrics
+from error_handler import handle_unavailable
+from fastapi import HTTPException
+from indexing import *
+
+SEARCH_FIELDS = ["title^4", "artist_name^3", "genre_name^2", "album_name"]
+SEARCH_SOURCE = ["id", "title", "artist_name", "genre_name", "album_name", "total_ratings"]
+FAST_FILTER_PATH = [
+    "took",
+    "hits.hits._id",
+    "hits.hits._score",
+    "hits.hits._source",
+    "hits.hits.sort",
+]
+
+# BM25 parameters and fuzzy expansion limit, as Elasticsearch defaults them.
+BM25_K1 = 1.2
+BM25_B = 0.75
+FUZZY_MAX_EXPANSIONS = 50
+FUZZY_CACHE_SIZE = 10000
+
+_TOKEN = re.compile(r"\w+")
+_ALPHABET = {c: i for i, c in enumerate("abcdefghijklmnopqrstuvwxyz0123456789")}
+
+
+def parse_fields(fields):
+    """
+    [("title", 4.0), ...] from ES style `field^boost` strings.
+    """
+    parsed = []
+    for field in fields:
+        name, _, boost = field.partition("^")
+        parsed.append((name, float(boost) if boost else 1.0))
+    return parsed
+
+
+def tokenize(text):
+    """
+    Lowercased word tokens, close to what ES's standard analyzer produces.
+    """
+    return _TOKEN.findall(str(text or "").lower())
+
+
+def auto_fuzziness(term):
+    """
+    Edits allowed for `term` under `fuzziness: auto`.
+    """
+    if len(term) <= 2:
+        return 0
+    return 1 if len(term) <= 5 else 2
+
+
+def char_counts(term):
+    counts = [0] * (len(_ALPHABET) + 1)
+    for char in term:
+        counts[_ALPHABET.get(char, len(_ALPHABET))] += 1
+    return counts
+
+
+def edit_distance(a, b, limit):
+    """
+    Optimal string alignment distance between `a` and `b` (adjacent
+    transpositions count as one edit, like ES fuzzy queries), or
+    `limit + 1` once it is known to exceed `limit`.
+    """
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous2 = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            current[j] = min(
+                previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost
+            )
+            if (
+                previous2 is not None
+                and i > 1
+                and j > 1
+                and a[i - 1] == b[j - 2]
+                and a[i - 2] == b[j - 1]
+            ):
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        if min(current) > limit:
+            return limit + 1
+        previous2, previous = previous, current
+    return previous[-1]
+
+
+class InvertedIndex:
+    """
+    In-memory BM25 index over song documents.
+
+    Each document gets a slot; per field the index keeps postings
+    (term -> {slot: term frequency}) and a NumPy array of field lengths, so
+    scoring a term is a handful of vectorized operations over its postings.
+    Queries are scored like the ES `multi_match` `best_fields` query used by
+    /searchES: per field the BM25 scores of the (fuzzily expanded) query
+    terms are summed, and a document scores its best boosted field.
+    """
+
+    def __init__(self, fields=SEARCH_FIELDS):
+        self.fields = parse_fields(fields)
+        self.slots = {}
+        self.ids = []
+        self.docs = []
+        self.free = []
+        self.postings = {name: defaultdict(dict) for name, _ in self.fields}
+        self.lengths = {name: np.zeros(0, dtype=np.float32) for name, _ in self.fields}
+        self.total_length = {name: 0.0 for name, _ in self.fields}
+        self.vocabulary = defaultdict(int)
+        self._terms = None
+        self._compiled = {}
+        self._expansions = {}
+
+    def __len__(self):
+        return len(self.slots)
+
+    def _allocate(self, doc_id):
+        if self.free:
+            slot = self.free.pop()
+            self.ids[slot] = doc_id
+        else:
+            slot = len(self.ids)
+            self.ids.append(doc_id)
+            self.docs.append(None)
+            if slot >= len(self.lengths[self.fields[0][0]]):
+                capacity = max(1024, 2 * slot)
+                for name in self.lengths:
+                    grown = np.zeros(capacity, dtype=np.float32)
+                    grown[: len(self.lengths[name])] = self.lengths[name]
+                    self.lengths[name] = grown
+        self.slots[doc_id] = slot
+        return slot
+
+    def _add_term(self, name, term):
+        self._compiled.pop((name, term), None)
+        self.vocabulary[term] += 1
+        if self.vocabulary[term] == 1:
+            self._terms = None
+            self._expansions.clear()
+
+    def _drop_term(self, name, term):
+        self._compiled.pop((name, term), None)
+        self.vocabulary[term] -= 1
+        if self.vocabulary[term] == 0:
+            del self.vocabulary[term]
+            self._terms = None
+            self._expansions.clear()
+
+    def _posting_arrays(self, name, term):
+        """
+        (slots, term frequencies) of a posting list as arrays, cached until
+        the term is next added to or removed from a document.
+        """
+        key = (name, term)
+        arrays = self._compiled.get(key)
+        if arrays is None:
+            posting = self.postings[name].get(term)
+            if not posting:
+                return None
+            arrays = (
+                np.fromiter(posting.keys(), dtype=np.int64, count=len(posting)),
+                np.fromiter(posting.values(), dtype=np.float32, count=len(posting)),
+            )
+            self._compiled[key] = arrays
+        return arrays
+
+    def _term_matrix(self):
+        """
+        Vocabulary terms with their lengths and character counts, rebuilt
+        when the vocabulary changes. The counts give a cheap lower bound on
+        the edit distance that prunes most candidates before the exact check.
+        """
+        if self._terms is None:
+            terms = list(self.vocabulary)
+            self._terms = (
+                terms,
+                np.array([len(term) for term in terms], dtype=np.int16),
+                np.array([char_counts(term) for term in terms], dtype=np.int16).reshape(
+                    len(terms), len(_ALPHABET) + 1
+                ),
+            )
+        return self._terms
+
+    def _unindex(self, slot):
+        doc = self.docs[slot]
+        for name, _ in self.fields:
+            for term in set(tokenize(doc.get(name))):
+                postings = self.postings[name]
+                postings[term].pop(slot, None)
+                if not postings[term]:
+                    del postings[term]
+                self._drop_term(name, term)
+            self.total_length[name] -= self.lengths[name][slot]
+            self.lengths[name][slot] = 0
+
+    def upsert(self, doc):
+        """
+        Index `doc`, merging it into the stored document when it is partial.
+        """
+        doc_id = doc["id"]
+        slot = self.slots.get(doc_id)
+        if slot is None:
+            slot = self._allocate(doc_id)
+        else:
+            doc = {**self.docs[slot], **doc}
+            self._unindex(slot)
+        self.docs[slot] = doc
+        for name, _ in self.fields:
+            tokens = tokenize(doc.get(name))
+            counts = defaultdict(int)
+            for term in tokens:
+                counts[term] += 1
+            for term, tf in counts.items():
+                self.postings[name][term][slot] = tf
+                self._add_term(name, term)
+            self.lengths[name][slot] = len(tokens)
+            self.total_length[name] += len(tokens)
+
+    def remove(self, doc_id):
+        slot = self.slots.pop(doc_id, None)
+        if slot is None:
+            return
+        self._unindex(slot)
+        self.docs[slot] = None
+        self.ids[slot] = None
+        self.free.append(slot)
+
+    def expand(self, term):
+        """
+        Index terms within `auto` edit distance of `term`, with the weight
+        ES gives a fuzzy match (1 - edits / shorter term length). Cached
+        until the vocabulary changes.
+        """
+        if term not in self._expansions:
+            if len(self._expansions) >= FUZZY_CACHE_SIZE:
+                self._expansions.clear()
+            self._expansions[term] = self._expand(term)
+        return self._expansions[term]
+
+    def _expand(self, term):
+        limit = auto_fuzziness(term)
+        if limit == 0:
+            return [(term, 1.0)] if term in self.vocabulary else []
+        terms, lengths, counts = self._term_matrix()
+        if not terms:
+            return []
+        difference = counts - np.array(char_counts(term), dtype=np.int16)
+        bound = np.maximum(
+            np.clip(difference, 0, None).sum(axis=1),
+            np.clip(-difference, 0, None).sum(axis=1),
+        )
+        close = np.flatnonzero(
+            (np.abs(lengths - len(term)) <= limit) & (bound <= limit)
+        )
+        matches = []
+        for i in close:
+            candidate = terms[i]
+            edits = edit_distance(term, candidate, limit)
+            if edits <= limit:
+                matches.append(
+                    (edits, candidate, 1.0 - edits / min(len(term), len(candidate)))
+                )
+        matches.sort()
+        return [(candidate, weight) for _, candidate, weight in matches[:FUZZY_MAX_EXPANSIONS]]
+
+    def _field_scores(self, name, expansions):
+        size = len(self.ids)
+        scores = np.zeros(size, dtype=np.float32)
+        count = len(self.slots)
+        if not count:
+            return scores
+        lengths = self.lengths[name][:size]
+        average = self.total_length[name] / count or 1.0
+        for terms in expansions:
+            term_scores = np.zeros(size, dtype=np.float32)
+            for term, weight in terms:
+                arrays = self._posting_arrays(name, term)
+                if arrays is None:
+                    continue
+                slots, tf = arrays
+                idf = math.log(1 + (count - len(slots) + 0.5) / (len(slots) + 0.5))
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths[slots] / average)
+                contribution = weight * idf * tf * (BM25_K1 + 1) / (tf + norm)
+                term_scores[slots] = np.maximum(term_scores[slots], contribution)
+            scores += term_scores
+        return scores
+
+    def score(self, text, fuzzy=True):
+        """
+        (scores, per field boosted scores) for every slot.
+        """
+        expansions = [
+            self.expand(term) if fuzzy else [(term, 1.0)] for term in tokenize(text)
+        ]
+        best = np.zeros(len(self.ids), dtype=np.float32)
+        fields = {}
+        for name, boost in self.fields:
+            fields[name] = self._field_scores(name, expansions) * boost
+            np.maximum(best, fields[name], out=best)
+        return best, fields
+
+    def search(
+        self, text, size=10, search_after=None, explain=False, fuzzy=True, source=None
+    ):
+        """
+        Top `size` hits for `text` sorted by score then id, in the shape of
+        ES search hits. `source` limits the fields of `_source`.
+        """
+        scores, fields = self.score(text, fuzzy)
+        slots = np.flatnonzero(scores > 0)
+        if search_after:
+            after_score, after_id = float(search_after[0]), str(search_after[1])
+            slots = np.array(
+                [
+                    slot
+                    for slot in slots
+                    if scores[slot] < after_score
+                    or (scores[slot] == after_score and self.ids[slot] > after_id)
+                ],
+                dtype=np.int64,
+            )
+        if len(slots) > size:
+            cutoff = np.partition(scores[slots], -size)[-size]
+            slots = slots[scores[slots] >= cutoff]
+        ids = np.array([self.ids[slot] for slot in slots], dtype=str)
+        order = np.lexsort((ids, -scores[slots]))[:size]
+
+        hits = []
+        for slot in slots[order]:
+            score = float(scores[slot])
+            doc = self.docs[slot]
+            hit = {"_index": SONGS_INDEX, "_id": doc["id"], "_score": score}
+            if explain:
+                hit["_source"] = {k: doc.get(k) for k in source} if source else doc
+                hit["_explanation"] = {
+                    "value": score,
+                    "description": "max of boosted per field BM25 scores",
+                    "fields": {name: float(value[slot]) for name, value in fields.items()},
+                }
+            else:
+                hit["_source"] = {key: doc.get(key) for key in source or SEARCH_SOURCE}
+                hit["sort"] = [score, doc["id"]]
+            hits.append(hit)
+        return hits
+
+
+class ElasticsearchBackend:
+    name = "elasticsearch"
+
+    def build_query(self, input, text, fuzzy=True, source=None):
+        """
+        Build the ES request for `input`, searching for `text`.
+
+        `fast` skips explanations and total hit counting, returns only the
+        `source` fields (SEARCH_SOURCE by default) and sorts on score then id
+        so pages can be fetched with `search_after`. `debug` returns full
+        hits with explanations. Without `fuzzy` only exact terms match.
+        """
+        query = {
+            "query": {
+                "multi_match": {
+                    "query": text,
+                    "type": "best_fields",
+                    "fields": SEARCH_FIELDS,
+                }
+            },
+        }
+        if fuzzy:
+            query["query"]["multi_match"]["fuzziness"] = "auto"
+        if input.mode == "debug":
+            query.update({"explain": True, "track_total_hits": True})
+            if source:
+                query["_source"] = source
+            return query
+
+        query.update(
+            {
+                "explain": False,
+                "track_total_hits": False,
+                "_source": source or SEARCH_SOURCE,
+                "sort": ["_score", {"id": "asc"}],
+            }
+        )
+        if input.search_after:
+            query["search_after"] = input.search_after
+        return query
+
+    async def search(self, input, text, fuzzy=True, source=None):
+        """
+        (hits, took in ms) for `input`.
+        """
+        if not await async_index_exists(index_name=SONGS_INDEX):
+            raise HTTPException(status_code=404, detail="Index not found")
+        params = {} if input.mode == "debug" else {"filter_path": FAST_FILTER_PATH}
+        result = await async_index_search(
+            index_name=SONGS_INDEX,
+            query=self.build_query(input, text, fuzzy, source),
+            size=input.size,
+            **params,
+        )
+        return result.get("hits", {}).get("hits", []), result.get("took", 0)
+
+
+class LocalSearchBackend:
+    """
+    Songs search served from an in-process `InvertedIndex`.
+
+    The index is built from the database in a background thread at startup,
+    kept current from the song documents the outbox worker and the
+    incremental sync send to ES, and rebuilt after a full reindex.
+    """
+
+    name = "local"
+
+    def __init__(self):
+        self.index = InvertedIndex()
+        self.ready = False
+        self._lock = threading.Lock()
+        self._replay = None
+        metrics.register_gauge("search_local_documents", lambda: len(self.index))
+
+    @classmethod
+    def from_documents(cls, docs):
+        """
+        A ready backend over `docs`, e.g. for benchmarks without a database
+        or cluster.
+        """
+        backend = cls()
+        backend.apply(docs, ())
+        backend.ready = True
+        return backend
+
+    def start(self, engine):
+        threading.Thread(
+            target=self.rebuild, args=(engine,), name="local-search-build", daemon=True
+        ).start()
+
+    def rebuild(self, engine):
+        """
+        Build a fresh index from the database and swap it in. Changes applied
+        while it is being built are replayed onto it before the swap.
+        """
+        started = time.perf_counter()
+        with self._lock:
+            self._replay = []
+        index = InvertedIndex()
+        try:
+            with Session(engine) as db:
+                for doc in iter_song_documents(db):
+                    index.upsert(doc)
+        except Exception:
+            with self._lock:
+                self._replay = None
+            metrics.incr("search_local_build_failed")
+            raise
+        with self._lock:
+            for docs, deleted_ids in self._replay:
+                self._apply(index, docs, deleted_ids)
+            self.index, self._replay = index, None
+        self.ready = True
+        metrics.observe("search_local_build_seconds", time.perf_counter() - started)
+
+    @staticmethod
+    def _apply(index, docs, deleted_ids):
+        for doc in docs:
+            index.upsert(doc)
+        for doc_id in deleted_ids:
+            index.remove(doc_id)
+
+    def apply(self, docs, deleted_ids):
+        with self._lock:
+            self._apply(self.index, docs, deleted_ids)
+            if self._replay is not None:
+                self._replay.append((list(docs), list(deleted_ids)))
+
+    def _search(self, input, text, fuzzy, source):
+        with self._lock:
+            return self.index.search(
+                text,
+                size=input.size,
+                search_after=input.search_after if input.mode == "fast" else None,
+                explain=input.mode == "debug",
+                fuzzy=fuzzy,
+                source=source,
+            )
+
+    async def search(self, input, text, fuzzy=True, source=None):
+        """
+        (hits, took in ms) for `input`, scored off the event loop.
+        """
+        if not self.ready:
+            handle_unavailable()
+        started = time.perf_counter()
+        hits = await asyncio.get_running_loop().run_in_executor(
+            None, self._search, input, text, fuzzy, source
+        )
+        return hits, round((time.perf_counter() - started) * 1000)
+
+
+elasticsearch_backend = ElasticsearchBackend()
+local_search = LocalSearchBackend()
+if SEARCH_BACKEND != "elasticsearch":
+    add_song_listener(local_search)
+
+
+async def search_songs(input, text=None, fuzzy=True, source=None):
+    """
+    (hits, took in ms, backend name) for a /searchES request, searching for
+    `text` (the request's own query by default) and returning the `source`
+    fields of each song.
+
+    SEARCH_BACKEND picks the backend: `elasticsearch`, `local`, or `auto`,
+    which uses Elasticsearch and falls back to the local index while the
+    cluster or the songs index is unavailable.
+    """
+    text = input.input if text is None else text
+    if SEARCH_BACKEND == "local":
+        hits, took = await local_search.search(input, text, fuzzy, source)
+        return hits, took, local_search.name
+    try:
+        hits, took = await elasticsearch_backend.search(input, text, fuzzy, source)
+        return hits, took, elasticsearch_backend.name
+    except Exception:
+        if SEARCH_BACKEND != "auto" or not local_search.ready:
+            raise
+    metrics.incr("search_local_fallback")
+    hits, took = await local_search.search(input, text, fuzzy, source)
+    return hits, took, local_search.name
@@ -0,0 +1,47 @@
+import asyncio
+import time
+
+import metrics
+from cache import TTLCache, catalog_version
+from configurations import *
+
+search_cache = TTLCache(SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL, name="search")
+_inflight = {}
+
+
+def normalize_query(text):
+    return " ".join(text.lower().split())
+
+
+async def _fetch(key, fetch):
+    started = time.perf_counter()
+    result = await fetch()
+    latency = time.perf_counter() - started
+    metrics.observe("search_backend_seconds", latency)
+    if key[0] == catalog_version():
+        search_cache.set(key, (result, latency))
+    return result
+
+
+async def cached_search(key_parts, fetch):
+    """
+    Return the cached result for `key_parts` under the current catalog
+    version, or await `fetch()` for it.
+
+    Concurrent misses for the same key share a single `fetch()` call.
+    """
+    key = (catalog_version(),) + tuple(key_parts)
+    hit = search_cache.get(key)
+    if hit is not None:
+        result, latency = hit
+        metrics.observe("search_cache_saved_seconds", latency)
+        return result
+
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_fetch(key, fetch))
+        _inflight[key] = task
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+    else:
+        metrics.incr("search_cache_collapsed")
+    return await asyncio.shield(task)
@@ -0,0 +1,336 @@
+"""
+Song feature store for "similar songs".
+
+Every song is a float32 row holding its average rating and popularity
+followed by one-hot artist, genre and album blocks. Songs are compared by
+the cosine similarity of their rows. The rows live in `.npy` files under
+FEATURE_STORE_DIR that every process memory maps read-write, so all workers
+share one copy and see each other's updates through the page cache.
+
+A version directory is built from the database and published through a
+manifest, like the ALS model. Song changes are written into the current
+version in place, one row each. A song with an artist, genre or album that
+has no column yet, or a new song once the spare rows are used up, queues a
+rebuild into a new version. Writers take an exclusive `flock` on the store,
+so only one process writes at a time. Readers do not lock the files: a
+query that runs during a write may see that one row half updated.
+"""
+import fcntl
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+from sqlalchemy.orm import Session
+
+import metrics
+from als_recommender import MANIFEST, publish
+from indexing import *
+
+# Weight of each one-hot block in a row. Songs by the same artist or on the
+# same album are more alike than songs that only share a genre.
+CATEGORY_WEIGHTS = {"artist": 1.0, "album": 1.0, "genre": 0.5}
+STAT_COLUMNS = ("total_ratings", "popularity")
+STAT_WEIGHT = 0.5
+ID_DTYPE = "<U64"
+
+
+def stat_values(doc):
+    """
+    Rating statistics of a song document scaled to [0, 1], by column, for
+    the statistics `doc` has.
+    """
+    values = {}
+    if "total_ratings" in doc:
+        values["total_ratings"] = STAT_WEIGHT * (doc["total_ratings"] or 0) / 5
+    if "popularity" in doc:
+        popularity = np.log1p(doc["popularity"] or 0)
+        values["popularity"] = STAT_WEIGHT * popularity / (1 + popularity)
+    return values
+
+
+class FeatureStore:
+    """
+    One version of the store, memory mapped.
+
+    Row `i` of `features` belongs to `song_ids[i]`; rows of deleted songs
+    and spare rows have an empty id and a zero norm. `header` holds the
+    number of rows in use and a generation number bumped by every write
+    that adds or deletes a song, so other processes know when to refresh
+    their id lookup. Within a process the lookup is guarded by a lock
+    shared by writers and queries.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "columns.json")) as f:
+            self.columns = json.load(f)
+        self.blocks = {
+            category: [
+                i for name, i in self.columns.items() if name.startswith(category + ":")
+            ]
+            for category in CATEGORY_WEIGHTS
+        }
+        for name in ("features", "norms", "song_ids", "header"):
+            array = np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r+")
+            setattr(self, name, array)
+        self.generation = None
+        self.index = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def create(cls, path, docs):
+        """
+        Write a store for `docs` to `path`, with a column for every artist,
+        genre and album among them and spare rows for new songs.
+        """
+        columns = {name: i for i, name in enumerate(STAT_COLUMNS)}
+        for category in CATEGORY_WEIGHTS:
+            for value in sorted({doc[f"{category}_id"] for doc in docs}):
+                columns[f"{category}:{value}"] = len(columns)
+        capacity = len(docs) + max(1024, len(docs) // 4)
+        features = np.zeros((capacity, len(columns)), dtype=np.float32)
+        rows = np.arange(len(docs))
+        for name in STAT_COLUMNS:
+            features[rows, columns[name]] = [stat_values(doc)[name] for doc in docs]
+        for category, weight in CATEGORY_WEIGHTS.items():
+            features[
+                rows, [columns[f"{category}:{doc[f'{category}_id']}"] for doc in docs]
+            ] = weight
+        song_ids = np.zeros(capacity, ID_DTYPE)
+        song_ids[rows] = [doc["id"] for doc in docs]
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, "columns.json"), "w") as f:
+            json.dump(columns, f)
+        np.save(os.path.join(path, "features.npy"), features)
+        np.save(os.path.join(path, "norms.npy"), np.linalg.norm(features, axis=1))
+        np.save(os.path.join(path, "song_ids.npy"), song_ids)
+        np.save(os.path.join(path, "header.npy"), np.array([len(docs), 0], np.int64))
+        return cls(path)
+
+    def flush(self):
+        for array in (self.features, self.norms, self.song_ids, self.header):
+            array.flush()
+
+    def _sync_index(self):
+        """
+        Refresh the song id to row lookup if any process added or deleted
+        songs since. Callers hold `_lock`.
+        """
+        generation = int(self.header[1])
+        if generation != self.generation:
+            used = self.song_ids[: int(self.header[0])]
+            self.index = {
+                song_id: row for row, song_id in enumerate(used.tolist()) if song_id
+            }
+            self.generation = generation
+
+    def _set_row(self, row, doc):
+        """
+        Write the features `doc` has into `row`, keeping the others. Returns
+        False, leaving the row alone, if a category has no column.
+        """
+        updates = {self.columns[name]: v for name, v in stat_values(doc).items()}
+        for category, weight in CATEGORY_WEIGHTS.items():
+            if f"{category}_id" not in doc:
+                continue
+            column = self.columns.get(f"{category}:{doc[f'{category}_id']}")
+            if column is None:
+                return False
+            updates.update(dict.fromkeys(self.blocks[category], 0.0))
+            updates[column] = weight
+        features = self.features[row]
+        for column, value in updates.items():
+            features[column] = value
+        self.norms[row] = np.linalg.norm(features)
+        return True
+
+    def write(self, docs, deleted_ids):
+        """
+        Apply song changes in place. Returns False if some of them need a
+        rebuild: new categories, or new songs with no spare rows left.
+        """
+        with self._lock:
+            return self._write(docs, deleted_ids)
+
+    def _write(self, docs, deleted_ids):
+        self._sync_index()
+        complete, moved = True, False
+        for doc in docs:
+            row = self.index.get(doc["id"])
+            if row is None:
+                row = int(self.header[0])
+                if row == len(self.song_ids) or not all(
+                    f"{category}_id" in doc for category in CATEGORY_WEIGHTS
+                ):
+                    complete = False
+                    continue
+                self.features[row] = 0
+            if not self._set_row(row, doc):
+                complete = False
+                continue
+            if self.song_ids[row] != doc["id"]:
+                self.song_ids[row] = doc["id"]
+                self.header[0] = row + 1
+                self.index[doc["id"]] = row
+                moved = True
+        for song_id in deleted_ids:
+            row = self.index.pop(song_id, None)
+            if row is not None:
+                self.features[row] = 0
+                self.norms[row] = 0
+                self.song_ids[row] = ""
+                moved = True
+        if moved:
+            self.header[1] += 1
+            self.generation = int(self.header[1])
+        return complete
+
+    def similar(self, song_ids, size, block_rows=FEATURE_BLOCK_ROWS):
+        """
+        For each of `song_ids`, up to `size` (song id, cosine similarity)
+        pairs of the most similar other songs, best first, or None if the
+        song is not in the store.
+
+        All queries are scored together against one block of rows at a
+        time, keeping the best `size` per query between blocks.
+        """
+        with self._lock:
+            self._sync_index()
+            rows = [self.index.get(song_id) for song_id in song_ids]
+        known = np.array([row for row in rows if row is not None], dtype=np.int64)
+        queries = np.asarray(self.features[known])
+        query_norms = np.asarray(self.norms[known])
+        best_rows = np.empty((len(known), 0), dtype=np.int64)
+        best_scores = np.empty((len(known), 0), dtype=np.float32)
+        for start in range(0, int(self.header[0]), block_rows):
+            norms = np.asarray(self.norms[start : start + block_rows])
+            block = np.asarray(self.features[start : start + len(norms)])
+            with np.errstate(divide="ignore", invalid="ignore"):
+                scores = (queries @ block.T) / (query_norms[:, None] * norms)
+            scores[:, norms == 0] = -np.inf
+            own = (known >= start) & (known < start + len(norms))
+            scores[own, known[own] - start] = -np.inf
+            in_block = np.broadcast_to(start + np.arange(len(norms)), scores.shape)
+            candidates = np.concatenate([best_rows, in_block], axis=1)
+            scores = np.concatenate([best_scores, scores], axis=1)
+            if scores.shape[1] > size:
+                top = np.argpartition(-scores, size - 1, axis=1)[:, :size]
+                candidates = np.take_along_axis(candidates, top, axis=1)
+                scores = np.take_along_axis(scores, top, axis=1)
+            best_rows, best_scores = candidates, scores
+        order = np.argsort(-best_scores, axis=1, kind="stable")
+        best_rows = np.take_along_axis(best_rows, order, axis=1)
+        best_scores = np.take_along_axis(best_scores, order, axis=1)
+        results, found = [], iter(range(len(known)))
+        for row in rows:
+            if row is None:
+                results.append(None)
+                continue
+            i = next(found)
+            results.append(
+                [
+                    (str(self.song_ids[r]), float(s))
+                    for r, s in zip(best_rows[i], best_scores[i])
+                    if np.isfinite(s)
+                ]
+            )
+        return results
+
+
+class SongFeatures:
+    """
+    Keeps the current `FeatureStore` of FEATURE_STORE_DIR mapped and up to
+    date with song changes.
+
+    A background thread builds the store if there is none yet, rebuilds it
+    when changes did not fit, and every FEATURE_RELOAD_INTERVAL seconds
+    switches to a version another process published.
+    """
+
+    def __init__(self, store_dir=FEATURE_STORE_DIR):
+        self.store_dir = store_dir
+        self.store = None
+        self.version = None
+        self.engine = None
+        self.wakeup = threading.Event()
+        self._thread = None
+        metrics.register_gauge(
+            "song_features_rows",
+            lambda: int(self.store.header[0]) if self.store else 0,
+        )
+
+    @property
+    def ready(self):
+        return self.store is not None
+
+    @contextmanager
+    def locked(self):
+        os.makedirs(self.store_dir, exist_ok=True)
+        with open(os.path.join(self.store_dir, ".lock"), "w") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+    def load(self):
+        try:
+            with open(os.path.join(self.store_dir, MANIFEST)) as f:
+                version = json.load(f)["version"]
+        except FileNotFoundError:
+            return
+        if version != self.version:
+            self.store = FeatureStore(os.path.join(self.store_dir, version))
+            self.version = version
+
+    def start(self, engine):
+        self.engine = engine
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(
+            target=self._run, name="song-features", daemon=True
+        )
+        self._thread.start()
+
+    def _run(self):
+        rebuild = False
+        while True:
+            try:
+                with self.locked():
+                    self.load()
+                    rebuild = rebuild or self.store is None
+                if rebuild:
+                    self.rebuild(self.engine)
+            except Exception:
+                metrics.incr("song_features_build_failed")
+            rebuild = self.wakeup.wait(FEATURE_RELOAD_INTERVAL)
+            self.wakeup.clear()
+
+    def rebuild(self, engine):
+        started = time.perf_counter()
+        with self.locked(), Session(engine) as db:
+            docs = list(iter_song_documents(db))
+            version = datetime.utcnow().strftime("%Y%m%d%H%M%S%f")
+            FeatureStore.create(os.path.join(self.store_dir, version), docs)
+            publish(self.store_dir, version)
+            self.load()
+        metrics.observe("song_features_build_seconds", time.perf_counter() - started)
+
+    def apply(self, docs, deleted_ids):
+        with self.locked():
+            self.load()
+            store = self.store
+            if store is None:
+                return
+            complete = store.write(docs, deleted_ids)
+            store.flush()
+        if not complete:
+            metrics.incr("song_features_rebuild_queued")
+            self.wakeup.set()
+
+    def similar(self, song_ids, size):
+        store = self.store
+        return store.similar(song_ids, size)
+
+
+song_features = add_song_listener(SongFeatures())
@@ -0,0 +1,69 @@
+from elasticsearch import NotFoundError
+
+import metrics
+from cache import TTLCache
+from indexing import *
+
+song_cache = TTLCache(SONG_CACHE_SIZE, SONG_CACHE_TTL, name="song")
+
+# Fields every full song document has, and the ones left out of the ES
+# `_source`.
+SONG_FIELDS = {"id", "title", "artist_name", "genre_name", "album_name"}
+SOURCE_EXCLUDES = {"suggest"}
+
+
+class SongCacheListener:
+    """
+    Keeps `song_cache` in step with the songs index: cached songs are
+    replaced with their new documents as changes are indexed, deleted songs
+    are dropped and a full reindex empties the cache.
+    """
+
+    def apply(self, docs, deleted_ids):
+        for doc in docs:
+            if SONG_FIELDS <= doc.keys():
+                song_cache.refresh(
+                    doc["id"],
+                    {k: v for k, v in doc.items() if k not in SOURCE_EXCLUDES},
+                )
+            else:
+                song_cache.pop(doc["id"])
+        for doc_id in deleted_ids:
+            song_cache.pop(doc_id)
+
+    def rebuild(self, engine):
+        song_cache.clear()
+
+
+add_song_listener(SongCacheListener())
+
+
+async def get_songs(ids):
+    """
+    Song documents for `ids` in request order, skipping unknown ids.
+
+    Hot songs come from `song_cache`; the rest are fetched with a single
+    realtime `mget` and cached.
+    """
+    found, missing = {}, []
+    for song_id in dict.fromkeys(ids):
+        doc = song_cache.get(song_id)
+        if doc is None:
+            missing.append(song_id)
+        else:
+            found[song_id] = doc
+
+    if missing:
+        metrics.incr("song_lookup_fetched", len(missing))
+        try:
+            result = await async_get_docs(
+                SONGS_INDEX, missing, filter_path=["docs._id", "docs._source"]
+            )
+        except NotFoundError:
+            # No songs index yet.
+            result = {}
+        for doc in result.get("docs", []):
+            if "_source" in doc:
+                found[doc["_id"]] = doc["_source"]
+                song_cache.set(doc["_id"], doc["_source"])
+    return [found[song_id] for song_id in ids if song_id in found]
@@ -0,0 +1,194 @@
+import sys
+import threading
+import time
+from collections import defaultdict
+
+from sqlalchemy.orm import Session
+
+import metrics
+from indexing import *
+from search_backends import (
+    SEARCH_FIELDS,
+    auto_fuzziness,
+    edit_distance,
+    parse_fields,
+    tokenize,
+)
+
+# Longest edit distance any term is corrected by (what `fuzziness: auto`
+# allows for long terms), and the prefix deletes are generated from.
+MAX_EDIT_DISTANCE = 2
+PREFIX_LENGTH = 7
+
+
+def deletes(term, distance=MAX_EDIT_DISTANCE):
+    """
+    `term`'s prefix with every combination of up to `distance` characters
+    removed, including the prefix itself.
+    """
+    variants = {term[:PREFIX_LENGTH]}
+    level = variants
+    for _ in range(distance):
+        level = {
+            variant[:i] + variant[i + 1 :]
+            for variant in level
+            for i in range(len(variant))
+        }
+        variants |= level
+    return variants
+
+
+class SymSpell:
+    """
+    Symmetric delete spelling correction over the catalog vocabulary.
+
+    Every vocabulary term is stored under each variant of its prefix with up
+    to MAX_EDIT_DISTANCE characters deleted. A misspelled term is corrected
+    by generating its own delete variants and checking the terms stored
+    under them, so a lookup costs a few dictionary probes instead of a scan
+    of the vocabulary. Among candidates within `fuzziness: auto` distance,
+    the closest and then most frequent term wins.
+    """
+
+    def __init__(self, fields=SEARCH_FIELDS):
+        self.fields = [name for name, _ in parse_fields(fields)]
+        self.counts = defaultdict(int)
+        self.variants = defaultdict(set)
+
+    def __len__(self):
+        return len(self.counts)
+
+    def doc_terms(self, doc):
+        """
+        Distinct terms of `doc`'s searchable fields, as a compact tuple of
+        interned strings.
+        """
+        return tuple(
+            {sys.intern(term) for name in self.fields for term in tokenize(doc.get(name))}
+        )
+
+    def add_terms(self, terms):
+        for term in terms:
+            self.counts[term] += 1
+            if self.counts[term] == 1:
+                for variant in deletes(term):
+                    self.variants[variant].add(term)
+
+    def remove_terms(self, terms):
+        for term in terms:
+            self.counts[term] -= 1
+            if self.counts[term] > 0:
+                continue
+            del self.counts[term]
+            for variant in deletes(term):
+                stored = self.variants.get(variant)
+                if stored is not None:
+                    stored.discard(term)
+                    if not stored:
+                        del self.variants[variant]
+
+    def lookup(self, term):
+        """
+        The vocabulary term closest to `term`, or None if there is none
+        within `fuzziness: auto` distance.
+        """
+        if term in self.counts:
+            return term
+        limit = auto_fuzziness(term)
+        if limit == 0:
+            return None
+        best = None
+        for variant in deletes(term, limit):
+            for candidate in self.variants.get(variant, ()):
+                distance = edit_distance(term, candidate, limit)
+                if distance > limit:
+                    continue
+                rank = (distance, -self.counts[candidate], candidate)
+                if best is None or rank < best:
+                    best = rank
+        return best[2] if best else None
+
+    def correct(self, text):
+        """
+        `text` normalized with every misspelled term replaced by its
+        correction. Unknown terms without a close match are kept.
+        """
+        return " ".join(self.lookup(term) or term for term in tokenize(text))
+
+
+class CatalogSpeller:
+    """
+    `SymSpell` over the song catalog, built from the database at startup and
+    kept current from song document changes.
+    """
+
+    def __init__(self):
+        self.dictionary = SymSpell()
+        self.docs = {}
+        self.ready = False
+        self._lock = threading.Lock()
+        self._replay = None
+        metrics.register_gauge("spelling_vocabulary", lambda: len(self.dictionary))
+
+    def start(self, engine):
+        threading.Thread(
+            target=self.rebuild, args=(engine,), name="spelling-build", daemon=True
+        ).start()
+
+    def rebuild(self, engine):
+        started = time.perf_counter()
+        with self._lock:
+            self._replay = []
+        dictionary, docs = SymSpell(), {}
+        try:
+            with Session(engine) as db:
+                for doc in iter_song_documents(db):
+                    docs[doc["id"]] = dictionary.doc_terms(doc)
+                    dictionary.add_terms(docs[doc["id"]])
+        except Exception:
+            with self._lock:
+                self._replay = None
+            metrics.incr("spelling_build_failed")
+            raise
+        with self._lock:
+            for changes in self._replay:
+                self._apply(dictionary, docs, *changes)
+            self.dictionary, self.docs, self._replay = dictionary, docs, None
+        self.ready = True
+        metrics.observe("spelling_build_seconds", time.perf_counter() - started)
+
+    @staticmethod
+    def _apply(dictionary, docs, changed, deleted_ids):
+        for doc in changed:
+            if not any(name in doc for name in dictionary.fields):
+                # Partial update that leaves the searchable text alone.
+                continue
+            old = docs.get(doc["id"])
+            if old is not None:
+                dictionary.remove_terms(old)
+            docs[doc["id"]] = dictionary.doc_terms(doc)
+            dictionary.add_terms(docs[doc["id"]])
+        for doc_id in deleted_ids:
+            old = docs.pop(doc_id, None)
+            if old is not None:
+                dictionary.remove_terms(old)
+
+    def apply(self, docs, deleted_ids):
+        with self._lock:
+            self._apply(self.dictionary, self.docs, docs, deleted_ids)
+            if self._replay is not None:
+                self._replay.append((list(docs), list(deleted_ids)))
+
+    def correct(self, text):
+        """
+        (corrected query, whether it differs from `text`).
+        """
+        normalized = " ".join(tokenize(text))
+        with self._lock:
+            corrected = self.dictionary.correct(text)
+        return corrected, corrected != normalized
+
+
+speller = CatalogSpeller()
+if SEARCH_SPELL_CORRECTION:
+    add_song_listener(speller)
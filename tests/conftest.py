@@ -0,0 +1,97 @@
+import os
+import sys
+import tempfile
+
+# configurations reads the environment at import time, so point it at a
+# throwaway SQLite database before any app module is imported.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+WORKDIR = tempfile.mkdtemp()
+os.environ.setdefault("DATABASE_URI", f"sqlite:///{os.path.join(WORKDIR, 'test.db')}")
+os.environ.setdefault("FEATURE_STORE_DIR", os.path.join(WORKDIR, "features"))
+os.environ.setdefault("ALS_MODEL_DIR", os.path.join(WORKDIR, "als"))
+os.environ.setdefault("IMPORT_SPOOL_DIR", os.path.join(WORKDIR, "import_spool"))
+os.environ.setdefault("SECRET_KEY", "test")
+os.environ.setdefault("ALGORITHM", "HS256")
+os.environ.setdefault("ACCESS_TOKEN_EXPIRE_MINUTES", "30")
+os.environ.setdefault("SEARCH_BACKEND", "elasticsearch")
+os.environ.setdefault("AUTOCOMPLETE_BACKEND", "elasticsearch")
+os.environ.setdefault("SEARCH_SPELL_CORRECTION", "false")
+os.environ.setdefault("ES_BULK_WORKERS", "1")
+
+from datetime import timedelta
+
+import pytest
+from sqlalchemy.orm import Session
+
+from configurations import *
+from positions import keys_between
+
+
+@pytest.fixture
+def db_engine():
+    Models.Base.metadata.drop_all(engine)
+    Models.Base.metadata.create_all(engine)
+    yield engine
+    Models.Base.metadata.drop_all(engine)
+
+
+@pytest.fixture
+def catalog(db_engine):
+    """
+    Ten songs by one artist, with their ids.
+    """
+    with Session(db_engine) as db:
+        artist = Models.Artist(name="Queen")
+        genre = Models.Genre(name="Rock")
+        db.add_all([artist, genre])
+        db.flush()
+        album = Models.Album(title="A Night at the Opera", artist_id=artist.id)
+        db.add(album)
+        db.flush()
+        songs = [
+            Models.Song(
+                title=f"Song {i}",
+                artist_id=artist.id,
+                genre_id=genre.id,
+                album_id=album.id,
+            )
+            for i in range(10)
+        ]
+        db.add_all(songs)
+        db.commit()
+        return [song.id for song in songs]
+
+
+@pytest.fixture
+def playlist(catalog):
+    """
+    A user and a playlist of 250 songs, with a token for the user.
+    """
+    with Session(engine) as db:
+        user = Models.User(username="freddie", password_hash="x")
+        song = db.get(Models.Song, catalog[0])
+        songs = [
+            Models.Song(
+                title=f"Track {i}",
+                artist_id=song.artist_id,
+                genre_id=song.genre_id,
+                album_id=song.album_id,
+            )
+            for i in range(250)
+        ]
+        db.add(user)
+        db.add_all(songs)
+        db.flush()
+        playlist = Models.Playlist(name="Mix", user_id=user.id)
+        db.add(playlist)
+        db.flush()
+        db.add_all(
+            Models.PlaylistSong(
+                playlist_id=playlist.id, song_id=song.id, position=position
+            )
+            for song, position in zip(songs, keys_between(None, None, len(songs)))
+        )
+        db.commit()
+        token = access_token_generate({"sub": user.id}, timedelta(minutes=5))
+        return playlist.id, token
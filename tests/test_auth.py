@@ -0,0 +1,9 @@
+from jose import jwt
+
+from configurations import *
+
+
+def test_token_without_expiry_is_accepted_and_cached():
+    token = jwt.encode({"sub": "user-1"}, SECRET_KEY, algorithm=ALGORITHM)
+    assert verify_claims(token) == {"sub": "user-1"}
+    assert token_cache.get(token) == {"sub": "user-1"}
@@ -0,0 +1,30 @@
+from fastapi.testclient import TestClient
+
+from configurations import *
+from main import app
+from minhash import signature, to_bytes
+from operations import PLAYLISTS_INDEX
+
+
+def test_delete_table_leaves_tombstones_and_outbox_events(playlist):
+    playlist_id, _ = playlist
+    with Session(engine) as db:
+        db.get(Models.Playlist, playlist_id).minhash = to_bytes(signature(["s"]))
+        db.commit()
+
+    response = TestClient(app).delete("/deleteTable")
+    assert response.status_code == 200
+    assert response.json()["playlists"] == 1
+
+    with Session(engine) as db:
+        assert not db.scalars(select(Models.PlaylistSong)).all()
+        tombstones = db.scalars(select(Models.SyncTombstone)).all()
+        assert len(tombstones) == 250
+        assert {t.parent_id for t in tombstones} == {playlist_id}
+        events = db.scalars(select(Models.OutboxEvent)).all()
+        assert [(e.index_name, e.doc_id, e.op) for e in events][-1] == (
+            PLAYLISTS_INDEX,
+            playlist_id,
+            "refresh",
+        )
+        assert db.get(Models.Playlist, playlist_id).minhash is None
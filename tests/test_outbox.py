@@ -0,0 +1,51 @@
+import pytest
+
+from configurations import *
+from indexing import move_song
+from operations import PLAYLISTS_INDEX
+from outbox import coalesce
+
+
+def run_script(songs, append, remove, moves):
+    """
+    PLAYLIST_SONGS_SCRIPT on a list of song ids.
+    """
+    songs = [song_id for song_id in songs if song_id not in set(remove)]
+    songs += [song_id for song_id in append if song_id not in songs]
+    for move in moves:
+        move_song(songs, *move)
+    return songs
+
+
+def events(*changes):
+    return [
+        Models.OutboxEvent(
+            index_name=PLAYLISTS_INDEX, doc_id="p1", op=op, payload={"songs": songs}
+        )
+        for op, songs in changes
+    ]
+
+
+def replay(songs, changes):
+    for op, changed in changes:
+        songs = [song_id for song_id in songs if song_id not in changed]
+        if op == "append":
+            songs += changed
+    return songs
+
+
+@pytest.mark.parametrize(
+    "changes",
+    [
+        [("remove", ["a"]), ("append", ["a"])],
+        [("append", ["d"]), ("remove", ["d"])],
+        [("remove", ["a"]), ("append", ["a"]), ("remove", ["a"])],
+        [("append", ["d"]), ("remove", ["a", "d"]), ("append", ["a", "d"])],
+    ],
+)
+def test_coalesced_membership_matches_replay(changes):
+    before = ["a", "b", "c"]
+    ((op, payload),) = coalesce(events(*changes)).values()
+    assert op == "script"
+    after = run_script(before, payload["append"], payload["remove"], payload["moves"])
+    assert after == replay(before, changes)
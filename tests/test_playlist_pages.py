@@ -0,0 +1,35 @@
+from fastapi.testclient import TestClient
+from sqlalchemy import event
+
+from configurations import *
+from main import app
+
+
+def test_statements_per_page_do_not_grow_with_limit(playlist):
+    playlist_id, token = playlist
+    client = TestClient(app)
+    headers = {"Authorization": f"Bearer {token}"}
+    # Warm the auth cache so every counted request does the same work.
+    client.get(f"/playlistSongs/{playlist_id}?limit=1", headers=headers)
+
+    statements = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    counts = {}
+    event.listen(replica_engine.sync_engine, "before_cursor_execute", count)
+    try:
+        for limit in (1, 10, 100):
+            statements.clear()
+            response = client.get(
+                f"/playlistSongs/{playlist_id}?limit={limit}", headers=headers
+            )
+            assert response.status_code == 200
+            assert len(response.json()["songs"]) == limit
+            counts[limit] = len(statements)
+    finally:
+        event.remove(replica_engine.sync_engine, "before_cursor_execute", count)
+
+    assert counts[1] == counts[10] == counts[100]
+    assert counts[1] <= 2
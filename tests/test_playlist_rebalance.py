@@ -0,0 +1,42 @@
+from fastapi.testclient import TestClient
+
+from configurations import *
+from main import app
+from playlist_order import playlist_rebalancer
+
+
+def test_long_keys_flag_the_playlist_until_it_is_rebalanced(playlist):
+    playlist_id, token = playlist
+    client = TestClient(app)
+    headers = {"Authorization": f"Bearer {token}"}
+    with Session(engine) as db:
+        first, second, *rest = db.scalars(
+            select(Models.PlaylistSong.song_id)
+            .where(Models.PlaylistSong.playlist_id == playlist_id)
+            .order_by(Models.PlaylistSong.position)
+        ).all()
+        updated_at = db.get(Models.Playlist, playlist_id).updated_at
+
+    # Moving songs to the same spot over and over keeps lengthening keys.
+    for song_id in rest[:120]:
+        response = client.patch(
+            f"/playlist/{playlist_id}/songs/{song_id}/position",
+            json={"after": first},
+            headers=headers,
+        )
+        assert response.status_code == 200
+    with Session(engine) as db:
+        flagged = db.get(Models.Playlist, playlist_id)
+        assert flagged.needs_rebalance
+        assert flagged.updated_at == updated_at
+
+    assert playlist_rebalancer.scan() == {playlist_id}
+    playlist_rebalancer.rebalance(playlist_id)
+    assert playlist_rebalancer.scan() == set()
+    with Session(engine) as db:
+        positions = db.scalars(
+            select(Models.PlaylistSong.position).where(
+                Models.PlaylistSong.playlist_id == playlist_id
+            )
+        ).all()
+    assert max(map(len, positions)) <= PLAYLIST_POSITION_MAX_LENGTH
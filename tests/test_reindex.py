@@ -0,0 +1,102 @@
+import fnmatch
+
+import catalog_sync
+import indexing
+from indexing import *
+
+
+class FakeIndices:
+    def __init__(self, cluster):
+        self.cluster = cluster
+
+    def create(self, index, **kwargs):
+        self.cluster.docs[index] = {}
+
+    def get(self, index):
+        return {name: {} for name in self.cluster.docs if fnmatch.fnmatch(name, index)}
+
+    def get_alias(self, name):
+        return {index: {} for index in self.cluster.aliases.get(name, ())}
+
+    def exists(self, index):
+        return index in self.cluster.docs or index in self.cluster.aliases
+
+    def exists_alias(self, name):
+        return name in self.cluster.aliases
+
+    def update_aliases(self, actions):
+        for action in actions:
+            (op, args), = action.items()
+            targets = self.cluster.aliases.setdefault(args.get("alias"), set())
+            if op == "add":
+                targets.add(args["index"])
+            elif op == "remove":
+                targets.discard(args["index"])
+
+    def delete(self, index):
+        del self.cluster.docs[index]
+
+    def put_settings(self, index, settings):
+        self.cluster.on_loaded()
+
+    def refresh(self, index):
+        pass
+
+    def forcemerge(self, index, **kwargs):
+        pass
+
+
+class FakeCluster:
+    """
+    Just enough of Elasticsearch for versioned reindexing through an alias.
+    """
+
+    def __init__(self):
+        self.docs = {}
+        self.aliases = {}
+        self.indices = FakeIndices(self)
+        self.on_loaded = lambda: None
+
+    def options(self, **kwargs):
+        return self
+
+    def resolve(self, name):
+        (index,) = self.aliases.get(name) or {name}
+        return self.docs[index]
+
+    def bulk_index(self, actions, **kwargs):
+        count = 0
+        for action in actions:
+            docs = self.resolve(action["_index"])
+            if action.get("_op_type") == "delete":
+                docs.pop(action["_id"], None)
+            else:
+                docs[action["_id"]] = action["_source"]
+            count += 1
+        return count, []
+
+
+def test_change_during_reindex_survives_swap(catalog, monkeypatch):
+    cluster = FakeCluster()
+    monkeypatch.setattr(indexing, "es", cluster)
+    monkeypatch.setattr(indexing, "bulk_index", cluster.bulk_index)
+    monkeypatch.setattr(catalog_sync, "bulk_index", cluster.bulk_index)
+    catalog_sync.reindex_all_songs(engine)
+    assert cluster.resolve(SONGS_INDEX)[catalog[0]]["title"] == "Song 0"
+
+    def rename_song():
+        # A change committed after the new index was loaded and before the
+        # swap; the outbox writes it through the alias to the old index.
+        with Session(engine) as db:
+            song = db.get(Models.Song, catalog[0])
+            song.title = "Renamed"
+            db.commit()
+            (doc,) = indexing.iter_song_documents(db, song_ids=[song.id])
+        cluster.resolve(SONGS_INDEX)[doc["id"]] = doc
+
+    cluster.on_loaded = rename_song
+    stats = catalog_sync.reindex_all_songs(engine)
+
+    assert cluster.aliases[SONGS_INDEX] == {stats["index"]}
+    assert cluster.resolve(SONGS_INDEX)[catalog[0]]["title"] == "Renamed"
+    assert stats["replayed"] >= 1